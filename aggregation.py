@@ -0,0 +1,66 @@
+import pandas as pd
+import stations
+
+######################################### SETTINGS #####################################################################
+
+#  pandas resample rules of the download aggregation periods, weeks start on monday
+AGGREGATION_RULES = {'Daily': 'D', 'Weekly': 'W-MON', 'Monthly': 'MS'}
+
+#  periods a data frequency can be aggregated to
+AGGREGATION_PERIODS = {'Hourly': ['Daily', 'Weekly', 'Monthly'], 'Daily': ['Weekly', 'Monthly'], 'Monthly': []}
+
+AGGREGATION_STATS = ['mean', 'min', 'max', 'sum']
+
+#  station columns copied from the first row into every aggregated row
+STATION_COLUMNS = ('Latitude', 'Station Name', 'Climate ID')
+
+######################################### AGGREGATION ##################################################################
+
+
+#  accumulated variables (precipitation, rain, snow and degree days) are the only ones a sum is meaningful for. shared by
+#  the download aggregation, the compare page resampling and the climatology monthly totals
+def is_accumulated(variable_name):
+
+    return variable_name.startswith(('Total', 'Precip')) or 'Deg Days' in variable_name
+
+
+#  function to aggregate station data to a coarser period with one vectorized resample per statistic. every numeric
+#  variable gets a '{variable} {stat}' column per requested statistic, sums only for accumulated variables, plus a
+#  '{variable} count' of the observations behind each value. flag columns are dropped. the first row of the station
+#  columns and the index (longitude) are kept so the file has the same leading columns as a raw download
+def aggregate_station_data(df, period, stats=AGGREGATION_STATS):
+
+    dates = pd.to_datetime(df['Date/Time'], errors='coerce')
+    value_cols = [c for c in df.columns if not c.endswith('Flag') and not c.startswith(stations.ROW_COLUMNS)]
+    values = df[value_cols].apply(pd.to_numeric, errors='coerce')
+    values.index = dates
+    values = values[values.index.notna()].dropna(how='all', axis=1)
+
+    resampled = values.resample(AGGREGATION_RULES[period], closed='left', label='left')
+    columns = {}
+    for stat in [s for s in AGGREGATION_STATS if s in stats]:
+        stat_cols = [c for c in values.columns if stat != 'sum' or is_accumulated(c)]
+        if not stat_cols:
+            continue
+        if stat == 'sum':
+            result = resampled[stat_cols].sum(min_count=1)
+        else:
+            result = getattr(resampled[stat_cols], stat)()
+        for c in stat_cols:
+            columns['{} {}'.format(c, stat)] = result[c]
+    counts = resampled.count()
+    for c in values.columns:
+        columns['{} count'.format(c)] = counts[c]
+
+    #  order the statistics of each variable together, in the order the variables appear in the station file
+    order = ['{} {}'.format(c, stat) for c in values.columns for stat in AGGREGATION_STATS + ['count']]
+    df_agg = pd.DataFrame(columns, index=counts.index)[[c for c in order if c in columns]]
+    df_agg = df_agg[counts.sum(axis=1) > 0]  # periods without a single observation are left out
+
+    leading = [c for c in df.columns if c.startswith(STATION_COLUMNS)]
+    for i, c in enumerate(leading):
+        df_agg.insert(i, c, df[c].iloc[0] if len(df) else None)
+    df_agg.insert(len(leading), 'Date/Time', df_agg.index.strftime('%Y-%m-%d'))
+    df_agg.index = pd.Index([df.index[0] if len(df) else None] * len(df_agg))
+
+    return df_agg
@@ -0,0 +1,264 @@
+import os
+import json
+import hashlib
+import pandas as pd
+import stations
+import output_formats
+import scheduling
+import extraction
+import interpolation
+
+from flask import Response, request, abort
+from app import app
+from connections import get_s3_client
+
+######################################### SETTINGS #####################################################################
+
+#  most stations returned by one nearest station query
+MAX_NEAREST_STATIONS = 500
+
+#  largest extract the data api streams directly, bigger requests go through the download page and the bulk lane
+API_MAX_ROWS = int(os.environ.get('API_MAX_ROWS', scheduling.FAST_LANE_MAX_ROWS))
+
+######################################### HELPER FUNCTIONS #############################################################
+
+
+def json_response(data, status=200):
+
+    return Response(json.dumps(data, separators=(',', ':')), status=status, mimetype='application/json')
+
+
+def json_error(message, status=400):
+
+    return json_response({'error': message}, status)
+
+######################################### STATION TILES ################################################################
+
+
+#  flask route for geojson tiles of the weather station layer. each feature carries the first and last year of every
+#  data frequency so map clients can filter stations with layer filter expressions instead of dash callbacks
+@app.server.route('/tiles/stations/<int:z>/<int:x>/<int:y>.geojson')
+def serve_station_tile(z, x, y):
+
+    if z < 0 or z > 22 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        abort(404)
+
+    body, etag = stations.get_station_tile(z, x, y)
+
+    response = Response(body, mimetype='application/geo+json')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 24 * 60 * 60
+
+    return response.make_conditional(request)
+
+######################################### NEAREST STATIONS #############################################################
+
+
+#  flask route for the k stations nearest a point, e.g. /api/stations/nearest?lat=45.4&lon=-75.7&k=5&frequency=Daily&
+#  start_year=1950&end_year=2000. coverage=full (default) keeps stations whose record spans the years, coverage=any
+#  keeps stations with any data in them. answered from the prebuilt spatial index without touching s3
+@app.server.route('/api/stations/nearest')
+def serve_nearest_stations():
+
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        k = int(request.args.get('k', 10))
+        start_year = int(request.args['start_year']) if 'start_year' in request.args else None
+        end_year = int(request.args['end_year']) if 'end_year' in request.args else None
+        max_distance_km = float(request.args['max_distance_km']) if 'max_distance_km' in request.args else None
+    except KeyError as e:
+        return json_error('missing parameter {}'.format(e))
+    except ValueError as e:
+        return json_error('invalid parameter: {}'.format(e))
+
+    frequency = request.args.get('frequency')
+    coverage = request.args.get('coverage', 'full')
+
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return json_error('lat must be within [-90, 90] and lon within [-180, 180]')
+    if not 1 <= k <= MAX_NEAREST_STATIONS:
+        return json_error('k must be between 1 and {}'.format(MAX_NEAREST_STATIONS))
+    if frequency and frequency not in stations.FREQUENCY_COLUMNS:
+        return json_error('frequency must be one of {}'.format(', '.join(stations.FREQUENCY_COLUMNS)))
+    if coverage not in ('full', 'any'):
+        return json_error('coverage must be full or any')
+    if (start_year is None) != (end_year is None) or (start_year is not None and start_year > end_year):
+        return json_error('start_year and end_year must be given together with start_year <= end_year')
+
+    mask = stations.coverage_mask(frequency, start_year, end_year, coverage == 'full', request.args.get('province'))
+    df_nearest = stations.nearest_stations(lat, lon, k, mask=mask, max_distance_km=max_distance_km)
+
+    #  dates are returned as iso strings, missing dates as null
+    date_cols = [c for c in df_nearest.columns if c.endswith('_data')]
+    df_nearest[date_cols] = df_nearest[date_cols].apply(lambda x: x.dt.strftime('%Y-%m-%d'))
+    df_nearest = df_nearest.astype(object).where(df_nearest.notna(), None)
+    df_nearest['distance_km'] = df_nearest['distance_km'].astype(float).round(3)
+
+    return json_response(df_nearest.to_dict('records'))
+
+######################################### STATION DATA #################################################################
+
+
+#  function to return the entity tag of a station data extract. archive files only change when a refresh publishes a
+#  new generation, so the tag is derived from the request and the current generation without reading the data
+def extract_etag(station_id, frequency, start_date, end_date, fmt, variables=None):
+
+    generation = stations.get_archive_manifest().get('generation', '')
+    key = '|'.join([str(station_id), frequency, start_date.isoformat(), end_date.isoformat(), fmt, generation] +
+                   sorted(variables or []))
+
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+#  flask route streaming a station data extract, e.g. /api/stations/5051/data?frequency=Daily&start=1950-01-01&
+#  end=2000-12-31&format=ndjson&variables=Max Temp (°C),Total Precip (mm). formats are csv (default), ndjson and arrow
+#  (ipc stream), without variables every column is returned. plain requests are streamed in chunks as rows are
+#  encoded, range requests are answered from the same bytes so interrupted transfers can resume
+@app.server.route('/api/stations/<int:station_id>/data')
+def serve_station_data(station_id):
+
+    frequency = request.args.get('frequency', 'Daily')
+    fmt = request.args.get('format', 'csv')
+    variables = [variable for variable in request.args.get('variables', '').split(',') if variable] or None
+
+    try:
+        start_date = pd.Timestamp(request.args['start'])
+        end_date = pd.Timestamp(request.args['end'])
+    except KeyError as e:
+        return json_error('missing parameter {}'.format(e))
+    except ValueError as e:
+        return json_error('invalid date: {}'.format(e))
+
+    if frequency not in stations.FREQUENCY_COLUMNS:
+        return json_error('frequency must be one of {}'.format(', '.join(stations.FREQUENCY_COLUMNS)))
+    if fmt not in output_formats.STREAM_FORMATS:
+        return json_error('format must be one of {}'.format(', '.join(output_formats.STREAM_FORMATS)))
+    if start_date > end_date:
+        return json_error('start must not be after end')
+
+    n_rows = scheduling.estimate_job_rows(station_id, frequency, start_date, end_date)
+    if n_rows > API_MAX_ROWS:
+        return json_error('about {} rows requested, the api returns at most {}, use a shorter date range or the '
+                          'download page'.format(n_rows, API_MAX_ROWS), 413)
+
+    #  revalidation of a cached copy is answered before any data is read
+    etag = extract_etag(station_id, frequency, start_date, end_date, fmt, variables)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    s3 = get_s3_client()
+    try:
+        df = extraction.extract_station_data(s3, station_id, frequency, start_date, end_date, columns=variables)
+    except s3.exceptions.NoSuchKey:
+        return json_error('no {} data for station {}'.format(frequency.lower(), station_id), 404)
+
+    #  the first archive column is read as the index, it is returned as a regular column
+    df = df.rename_axis(stations.ROW_COLUMNS[0]).reset_index()
+    chunks = output_formats.iter_dataframe(df, fmt)
+
+    if request.range is None:
+        response = Response(chunks, mimetype=output_formats.STREAM_FORMATS[fmt]['content_type'], direct_passthrough=True)
+    else:
+        response = Response(b''.join(chunks), mimetype=output_formats.STREAM_FORMATS[fmt]['content_type'])
+
+    filename = '{}_{}_{}_{}{}'.format(station_id, frequency.lower(), start_date.strftime('%Y%m%d'),
+                                      end_date.strftime('%Y%m%d'), output_formats.STREAM_FORMATS[fmt]['extension'])
+    response.headers['Content-Disposition'] = 'inline; filename="{}"'.format(filename)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = stations.MANIFEST_REFRESH_SECONDS
+
+    if request.range is None:
+        return response
+
+    return response.make_conditional(request, accept_ranges=True, complete_length=response.content_length)
+
+######################################### INTERPOLATION ################################################################
+
+
+#  function to read the locations of an interpolation request: points=lat,lon;lat,lon, a single lat and lon, or a grid
+#  over bbox=south,west,north,east with step degrees between locations
+def request_points():
+
+    if 'points' in request.args:
+        points = [tuple(float(v) for v in point.split(',')) for point in request.args['points'].split(';') if point]
+    elif 'bbox' in request.args:
+        south, west, north, east = [float(v) for v in request.args['bbox'].split(',')]
+        step = float(request.args.get('step', 0.1))
+        if step <= 0 or south > north or west > east:
+            raise ValueError('bbox must be south,west,north,east with a positive step')
+        #  rough size check before the grid is built, the exact count is checked with the other location inputs
+        if ((north - south) / step + 1) * ((east - west) / step + 1) > interpolation.MAX_INTERPOLATION_POINTS * 2:
+            raise ValueError('grid has more than {} locations'.format(interpolation.MAX_INTERPOLATION_POINTS))
+        points = interpolation.grid_points(south, west, north, east, step)
+    else:
+        points = [(float(request.args['lat']), float(request.args['lon']))]
+
+    if any(len(point) != 2 or not (-90 <= point[0] <= 90 and -180 <= point[1] <= 180) for point in points):
+        raise ValueError('locations must be lat,lon pairs within [-90, 90] and [-180, 180]')
+
+    return points
+
+
+#  flask route interpolating a variable to locations from the nearest stations, e.g. /api/interpolate?lat=45.4&
+#  lon=-75.7&variable=Max Temp (°C)&frequency=Daily&start=2000-01-01&end=2009-12-31&method=idw&k=4. method idw
+#  (default) weights neighbours by 1 / distance ** power, nearest takes the closest neighbour with a value. the
+#  neighbours of every location are found in one pass over the spatial index and their files are read in parallel
+@app.server.route('/api/interpolate')
+def serve_interpolation():
+
+    frequency = request.args.get('frequency', 'Daily')
+    fmt = request.args.get('format', 'csv')
+    method = request.args.get('method', 'idw')
+
+    try:
+        variable = request.args['variable']
+        start_date = pd.Timestamp(request.args['start'])
+        end_date = pd.Timestamp(request.args['end'])
+        points = request_points()
+        k = int(request.args.get('k', 4))
+        power = float(request.args.get('power', 2))
+        max_distance_km = float(request.args['max_distance_km']) if 'max_distance_km' in request.args else None
+    except KeyError as e:
+        return json_error('missing parameter {}'.format(e))
+    except ValueError as e:
+        return json_error('invalid parameter: {}'.format(e))
+
+    if frequency not in stations.FREQUENCY_COLUMNS:
+        return json_error('frequency must be one of {}'.format(', '.join(stations.FREQUENCY_COLUMNS)))
+    if fmt not in output_formats.STREAM_FORMATS:
+        return json_error('format must be one of {}'.format(', '.join(output_formats.STREAM_FORMATS)))
+    if method not in interpolation.INTERPOLATION_METHODS:
+        return json_error('method must be one of {}'.format(', '.join(interpolation.INTERPOLATION_METHODS)))
+    if start_date > end_date:
+        return json_error('start must not be after end')
+    if not 1 <= len(points) <= interpolation.MAX_INTERPOLATION_POINTS:
+        return json_error('between 1 and {} locations can be interpolated at once'.format(interpolation.MAX_INTERPOLATION_POINTS))
+    if not 1 <= k <= interpolation.MAX_NEIGHBOURS:
+        return json_error('k must be between 1 and {}'.format(interpolation.MAX_NEIGHBOURS))
+
+    neighbours = interpolation.interpolation_neighbours(points, frequency, start_date, end_date, k, max_distance_km)
+    if neighbours[0].empty:
+        return json_error('no station with {} data within reach of the locations'.format(frequency.lower()), 404)
+
+    #  every neighbour file is read, so the limit applies to the rows of all of them together
+    n_rows = sum(scheduling.estimate_job_rows(station_id, frequency, start_date, end_date) for station_id in neighbours[0].station_id)
+    if n_rows > API_MAX_ROWS:
+        return json_error('about {} station rows needed, the api reads at most {}, use a shorter date range, fewer '
+                          'neighbours or a coarser frequency'.format(n_rows, API_MAX_ROWS), 413)
+
+    df = interpolation.interpolate_locations(get_s3_client(), points, neighbours, frequency, variable, start_date,
+                                             end_date, method, power)
+
+    response = Response(output_formats.iter_dataframe(df, fmt), mimetype=output_formats.STREAM_FORMATS[fmt]['content_type'],
+                        direct_passthrough=True)
+    filename = 'interpolated_{}_{}_{}_{}{}'.format(method, frequency.lower(), start_date.strftime('%Y%m%d'),
+                                                   end_date.strftime('%Y%m%d'), output_formats.STREAM_FORMATS[fmt]['extension'])
+    response.headers['Content-Disposition'] = 'inline; filename="{}"'.format(filename)
+
+    return response
@@ -1,8 +1,13 @@
 import dash
 import os
 
+from caching import cache
+
 app = dash.Dash(__name__)
 server=app.server
 server.secret_key = os.environ.get('secret_key', 'secret')
 app.config.suppress_callback_exceptions = True
-app.title = 'Weather History Canada'
\ No newline at end of file
+app.title = 'Weather History Canada'
+
+#  memoized callback results shared by every gunicorn worker through redis
+cache.init_app(server)
@@ -0,0 +1,391 @@
+/* Clientside callbacks
+––––––––––––––––––––––––––––––––––––––––––––––––––
+Download dropdown options and the download message only depend on the selected
+table row, so they are computed in the browser instead of on the web dyno.
+The home page station map is drawn here from the geojson station tiles of the
+visible area and filtered in the browser.
+Graph page figures are decoded here from the compact array encoding of
+figure_encoding.py.
+Written in ES5 so the home page keeps working in IE11.
+*/
+
+window.dash_clientside = window.dash_clientside || {};
+window.dash_clientside.clientside = {
+
+    //  download options based on selected station
+    update_download_dropdowns: function(selected_station, selected_station_row, selected_frequency, false_trigger, station_availability) {
+
+        var no_station_selected = [{'label': 'Select A Station', 'value': 'Select A Station'}];
+        var station = selectedStation(selected_station, selected_station_row);
+
+        if (!station) {
+            return [no_station_selected, no_station_selected, no_station_selected, no_station_selected, no_station_selected];
+        }
+
+        //  populate dropdown tab with available frequency of data to download
+        var download_frequency = availableFrequencies(station).map(function(freq) {
+            return {'label': freq, 'value': freq};
+        });
+
+        if (availableFrequencies(station).indexOf(selected_frequency) === -1) {
+            selected_frequency = null;
+        }
+
+        //  populate dropdown tab with available months of data to download
+        var download_month = [];
+        for (var month = 1; month <= 12; month++) {
+            download_month.push({'label': month, 'value': month});
+        }
+
+        //  populate dropdown tab with years of data to download, only populated years when the station is indexed
+        var indexed_years = ((station_availability || {})[String(station.station_id)] || {})[selected_frequency];
+        var download_year = (indexed_years || yearsAvailable(station, selected_frequency)).map(function(year) {
+            return {'label': year, 'value': year};
+        });
+
+        return [download_frequency, download_month, download_month, download_year, download_year];
+    },
+
+    //  download message based on download settings selected
+    update_download_message: function(selected_station, download_start_year, download_end_year, download_start_month,
+                                      download_end_month, selected_frequency, selected_station_row, false_trigger) {
+
+        var no_message_style = {'width': '100%', 'margin-right': '1rem', 'margin-top': '1rem'};
+        var message_style = {'width': '100%', 'margin-right': '1rem', 'margin-top': '1rem', 'border': '2px red dashed'};
+        var station = selectedStation(selected_station, selected_station_row);
+
+        //  if no station is selected or any download setting is missing remove message
+        if (!station || !selected_frequency || !download_start_year || !download_start_month || !download_end_year || !download_end_month) {
+            return [[], no_message_style, null];
+        }
+
+        //  if the same start and end data are chosen advise user to select something else
+        if (download_start_year === download_end_year && download_start_month === download_end_month) {
+            return ['Download dates must be different', message_style, null];
+        }
+
+        //  if the start date is after the end date advise the user to select something else
+        if (download_start_year > download_end_year ||
+            (download_start_year === download_end_year && download_start_month > download_end_month)) {
+            return ['Download start date must preceed download end date', message_style, null];
+        }
+
+        //  reset message status if frequency is not in available frequency, otherwise error in download
+        if (availableFrequencies(station).indexOf(selected_frequency) === -1) {
+            return [[], no_message_style, null];
+        }
+
+        //  if all the options are correct and present then provide the download message
+        var start_date = new Date(Date.UTC(download_start_year, download_start_month - 1, 1));
+        var end_date = new Date(Date.UTC(download_end_year, download_end_month - 1, 1) - 24 * 60 * 60 * 1000);
+        var message = 'First select GENERATE DATA and once loading is complete select DOWNLOAD DATA to begin downloading ' +
+            selected_frequency + ' data from ' + isoDate(start_date) + ' to ' + isoDate(end_date) + ' for station ' +
+            station.station_name + ' (station ID ' + station.station_id + ')';
+
+        return [message, message_style, 'PROCEED'];
+    },
+
+    //  station map of the stations in the visible tiles that pass the map filters, the stations of the selected station
+    //  table are highlighted in red. the nearest station filter is ranked on the server, nearest_ids lists its stations
+    update_station_map: function(province, frequency, first_year, last_year, latitude, longitude, radius, station_name,
+                                 nearest_ids, selected_station, relayout, map_layout) {
+
+        var view = mapView(relayout, map_layout);
+        var filters = {
+            'province': province, 'frequency': frequency ? frequency.toLowerCase() : null,
+            'first_year': first_year && last_year ? parseInt(first_year, 10) : null,
+            'last_year': first_year && last_year ? parseInt(last_year, 10) : null,
+            'latitude': parseFloat(latitude), 'longitude': parseFloat(longitude), 'radius': radius ? parseFloat(radius) : null,
+            'station_name': station_name ? station_name.toUpperCase() : null,
+            'nearest_ids': nearest_ids
+        };
+
+        var lat = [], lon = [], text = [];
+        visibleTiles(view).forEach(function(tile) {
+            loadStationTile(tile[0], tile[1], tile[2]).forEach(function(feature) {
+                if (passesMapFilters(feature.properties, feature.geometry.coordinates, filters)) {
+                    lon.push(feature.geometry.coordinates[0]);
+                    lat.push(feature.geometry.coordinates[1]);
+                    text.push(feature.properties.station_name);
+                }
+            });
+        });
+
+        var selected = selected_station || [];
+
+        return {
+            'data': [
+                {'type': 'scattermapbox', 'lat': lat, 'lon': lon, 'name': '', 'text': text, 'marker': {'color': 'blue'}},
+                {'type': 'scattermapbox', 'name': '', 'marker': {'color': 'red'},
+                 'lat': selected.map(function(row) { return row.latitude; }),
+                 'lon': selected.map(function(row) { return row.longitude; }),
+                 'text': selected.map(function(row) { return row.station_name; })}
+            ],
+            'layout': map_layout
+        };
+    },
+
+    //  graph page figures, arrays sent as base64 typed arrays by figure_encoding.py are decoded before plotly sees them
+    decode_figures: function(figures) {
+
+        return figures.map(decodeFigure);
+    }
+};
+
+var FREQUENCIES = ['Hourly', 'Daily', 'Monthly'];
+
+//  station tiles are loaded at the map zoom level, up to the deepest zoom the server keeps generated tiles for
+var MAX_TILE_ZOOM = 10;
+var MAP_TILE_SIZE = 512;
+var EARTH_RADIUS_KM = 6371;
+
+//  features of every station tile loaded on this page, keyed by z/x/y
+var stationTiles = {};
+
+//  this function returns the table row of the selected station or null
+function selectedStation(selected_station, selected_station_row) {
+
+    if (!selected_station || !selected_station_row || !selected_station_row.length) {
+        return null;
+    }
+
+    return selected_station[selected_station_row[0]] || null;
+}
+
+//  this function parses a yyyy-mm-dd table date to [year, month, day], null if missing
+function parseDate(value) {
+
+    if (!value || typeof value !== 'string') {
+        return null;
+    }
+
+    var parts = value.split('T')[0].split('-');
+
+    return [parseInt(parts[0], 10), parseInt(parts[1], 10), parseInt(parts[2], 10)];
+}
+
+function isoDate(date) {
+
+    return date.toISOString().split('T')[0];
+}
+
+//  this function lists the data frequencies a station has records for
+function availableFrequencies(station) {
+
+    return FREQUENCIES.filter(function(freq) {
+        return parseDate(station['first_' + freq.toLowerCase() + '_data']) !== null;
+    });
+}
+
+//  this function lists the years holding at least one month start between the first and last record of a frequency,
+//  or between the first and last record of any frequency when none is selected
+function yearsAvailable(station, frequency) {
+
+    var first_year, last_year;
+
+    if (frequency) {
+        var first = parseDate(station['first_' + frequency.toLowerCase() + '_data']);
+        var last = parseDate(station['last_' + frequency.toLowerCase() + '_data']);
+
+        if (!first || !last) {
+            return [];
+        }
+
+        //  first month start on or after the first record
+        var first_month_start = first[2] === 1 ? [first[0], first[1]] : (first[1] === 12 ? [first[0] + 1, 1] : [first[0], first[1] + 1]);
+        if (first_month_start[0] > last[0] || (first_month_start[0] === last[0] && first_month_start[1] > last[1])) {
+            return [];
+        }
+
+        first_year = first_month_start[0];
+        last_year = last[0];
+
+    } else {
+        var first_years = [], last_years = [];
+        FREQUENCIES.forEach(function(freq) {
+            var first = parseDate(station['first_' + freq.toLowerCase() + '_data']);
+            var last = parseDate(station['last_' + freq.toLowerCase() + '_data']);
+            if (first) { first_years.push(first[0]); }
+            if (last) { last_years.push(last[0]); }
+        });
+
+        if (!first_years.length || !last_years.length) {
+            return [];
+        }
+
+        first_year = Math.min.apply(null, first_years);
+        last_year = Math.max.apply(null, last_years);
+    }
+
+    var years = [];
+    for (var year = first_year; year <= last_year; year++) {
+        years.push(year);
+    }
+
+    return years;
+}
+
+//  this function decodes an encoded figure array (figure_encoding.py) to a plain array: float32 values are rounded back
+//  to the digits they were sent with, timestamps become epoch milliseconds and label codes their labels
+function decodeArray(encoded) {
+
+    var binary = window.atob(encoded.bdata);
+    var view = new DataView(new ArrayBuffer(binary.length));
+    for (var i = 0; i < binary.length; i++) {
+        view.setUint8(i, binary.charCodeAt(i));
+    }
+
+    var size = encoded.dtype === 'i1' ? 1 : 4;
+    var values = new Array(binary.length / size);
+    for (var j = 0; j < values.length; j++) {
+        if (encoded.dtype === 'f4') {
+            values[j] = parseFloat(view.getFloat32(j * 4, true).toPrecision(7));
+        } else {
+            var code = size === 1 ? view.getInt8(j) : view.getInt32(j * 4, true);
+            values[j] = encoded.categories ? encoded.categories[code] : encoded.start + code * encoded.step;
+        }
+    }
+
+    return values;
+}
+
+//  this function returns a copy of a figure with its encoded trace arrays decoded, plain figures are returned as they are
+function decodeFigure(figure) {
+
+    if (!figure || !figure.data) {
+        return figure;
+    }
+
+    var data = figure.data.map(function(trace) {
+        var decoded = {};
+        for (var key in trace) {
+            if (trace.hasOwnProperty(key)) {
+                decoded[key] = trace[key] && trace[key].bdata !== undefined ? decodeArray(trace[key]) : trace[key];
+            }
+        }
+        return decoded;
+    });
+
+    return {'data': data, 'layout': figure.layout};
+}
+
+//  this function returns the centre, zoom and pixel size of the map, from the last pan or zoom or the initial layout
+function mapView(relayout, map_layout) {
+
+    var graph = document.getElementById('station-map');
+    var view = {
+        'lat': map_layout.mapbox.center.lat, 'lon': map_layout.mapbox.center.lon, 'zoom': map_layout.mapbox.zoom,
+        'width': (graph && graph.offsetWidth) || 1000, 'height': map_layout.height
+    };
+
+    if (relayout && relayout['mapbox.center'] && relayout['mapbox.zoom'] !== undefined) {
+        view.lat = relayout['mapbox.center'].lat;
+        view.lon = relayout['mapbox.center'].lon;
+        view.zoom = relayout['mapbox.zoom'];
+    }
+
+    return view;
+}
+
+//  this function lists the [z, x, y] web mercator tiles covering the map view, x wraps around the antimeridian
+function visibleTiles(view) {
+
+    var z = Math.max(0, Math.min(MAX_TILE_ZOOM, Math.floor(view.zoom)));
+    var n = Math.pow(2, z);
+    var lat = Math.max(-85.0511, Math.min(85.0511, view.lat)) * Math.PI / 180;
+    var center_x = (view.lon + 180) / 360 * n;
+    var center_y = (1 - Math.log(Math.tan(lat) + 1 / Math.cos(lat)) / Math.PI) / 2 * n;
+
+    //  half of the view in tiles of zoom z, the map draws 512 pixel tiles at its own fractional zoom
+    var scale = MAP_TILE_SIZE * Math.pow(2, view.zoom - z);
+    var half_x = Math.min(n / 2, view.width / 2 / scale), half_y = view.height / 2 / scale;
+
+    var tiles = [], seen = {};
+    for (var x = Math.floor(center_x - half_x); x <= Math.floor(center_x + half_x); x++) {
+        for (var y = Math.max(0, Math.floor(center_y - half_y)); y <= Math.min(n - 1, Math.floor(center_y + half_y)); y++) {
+            var wrapped = ((x % n) + n) % n;
+            if (!seen[wrapped + '/' + y]) {
+                seen[wrapped + '/' + y] = true;
+                tiles.push([z, wrapped, y]);
+            }
+        }
+    }
+
+    return tiles;
+}
+
+//  this function returns the station features of a tile, loaded once per page. dash 1.9 clientside callbacks must
+//  return their result, so the tile is requested synchronously, the browser answers repeat requests from its cache
+//  (the tiles carry an etag and a one day max age). a tile that fails to load is tried again on the next update
+function loadStationTile(z, x, y) {
+
+    var key = z + '/' + x + '/' + y;
+
+    if (!stationTiles.hasOwnProperty(key)) {
+        var request = new XMLHttpRequest();
+        try {
+            request.open('GET', '/tiles/stations/' + key + '.geojson', false);
+            request.send();
+        } catch (e) {
+            return [];
+        }
+        if (request.status !== 200) {
+            return [];
+        }
+        stationTiles[key] = JSON.parse(request.responseText).features;
+    }
+
+    return stationTiles[key];
+}
+
+//  this function applies the map filters to the properties of a station feature, the same filters as filter_stations in
+//  home_page.py: province, data frequency, records overlapping the years, distance from a location and station name
+function passesMapFilters(station, coordinates, filters) {
+
+    if (filters.nearest_ids) {
+        return filters.nearest_ids.indexOf(station.station_id) !== -1;
+    }
+
+    if (filters.province && station.province !== filters.province) {
+        return false;
+    }
+
+    if (filters.frequency && !station['has_' + filters.frequency]) {
+        return false;
+    }
+
+    if (filters.first_year !== null) {
+        var prefixes = filters.frequency ? [filters.frequency] : FREQUENCIES.map(function(freq) { return freq.toLowerCase(); });
+        var first = null, last = null;
+        prefixes.forEach(function(prefix) {
+            if (station['has_' + prefix]) {
+                first = first === null ? station['first_' + prefix + '_year'] : Math.min(first, station['first_' + prefix + '_year']);
+                last = last === null ? station['last_' + prefix + '_year'] : Math.max(last, station['last_' + prefix + '_year']);
+            }
+        });
+        if (first === null || first > filters.last_year || last < filters.first_year) {
+            return false;
+        }
+    }
+
+    if (!isNaN(filters.latitude) && !isNaN(filters.longitude) && filters.radius &&
+        greatCircleDistance(filters.latitude, filters.longitude, coordinates[1], coordinates[0]) > filters.radius) {
+        return false;
+    }
+
+    if (filters.station_name && String(station.station_name).indexOf(filters.station_name) === -1) {
+        return false;
+    }
+
+    return true;
+}
+
+//  this function returns the haversine distance in km between two locations, as compute_great_circle_distance
+function greatCircleDistance(lat1, lon1, lat2, lon2) {
+
+    var radians = Math.PI / 180;
+    var a = Math.pow(Math.sin((lat2 - lat1) * radians / 2), 2) +
+        Math.cos(lat1 * radians) * Math.cos(lat2 * radians) * Math.pow(Math.sin((lon2 - lon1) * radians / 2), 2);
+
+    return EARTH_RADIUS_KM * 2 * Math.asin(Math.sqrt(a));
+}
@@ -0,0 +1,169 @@
+import os
+import json
+import base64
+import threading
+import numpy as np
+import pandas as pd
+import extraction
+import stations
+
+from concurrent.futures import ThreadPoolExecutor
+from connections import get_s3_client
+
+######################################### SETTINGS #####################################################################
+
+FREQUENCIES = ('Hourly', 'Daily', 'Monthly')
+
+######################################### HELPER FUNCTIONS #############################################################
+
+
+#  month number of a date counted from year 0, so consecutive months differ by one
+def month_number(date):
+
+    return date.year * 12 + date.month - 1
+
+
+def month_start(number):
+
+    return pd.Timestamp(year=int(number // 12), month=int(number % 12 + 1), day=1)
+
+
+#  function to pack a sorted array of populated month numbers into a bitset starting at the first populated month
+def encode_months(months):
+
+    months = np.unique(np.asarray(months, dtype=np.int64))
+    if not len(months):
+        return None
+
+    bits = np.zeros(months[-1] - months[0] + 1, dtype=np.uint8)
+    bits[months - months[0]] = 1
+
+    return {'first': int(months[0]), 'length': len(bits), 'bits': base64.b64encode(np.packbits(bits).tobytes()).decode()}
+
+
+#  function to unpack a bitset back to the array of populated month numbers
+def decode_months(entry):
+
+    bits = np.unpackbits(np.frombuffer(base64.b64decode(entry['bits']), dtype=np.uint8))[:entry['length']]
+
+    return np.flatnonzero(bits) + entry['first']
+
+######################################### INDEX BUILD ##################################################################
+
+
+#  function to find the months of a station archive that hold at least one observation
+def station_populated_months(s3, station_id, frequency):
+
+    df = extraction.query_station_data(s3, station_id, frequency, pd.Timestamp('1800-01-01'), pd.Timestamp.now())
+
+    return observed_months(df)
+
+
+#  function to return the month numbers of the rows of a station dataframe that hold at least one observation
+def observed_months(df):
+
+    value_cols = [c for c in df.columns if not c.endswith('Flag') and not c.startswith(stations.ROW_COLUMNS)]
+    populated = df[value_cols].notna().any(axis=1)
+    dates = pd.to_datetime(df.loc[populated, 'Date/Time'], errors='coerce').dropna()
+
+    return dates.dt.year.values * 12 + dates.dt.month.values - 1
+
+
+#  function to build the availability index of every station and frequency and store it on s3
+def build_availability_index(station_ids, max_workers=16):
+
+    s3 = get_s3_client()
+
+    def index_station(station_id):
+        entry = {}
+        for frequency in FREQUENCIES:
+            try:
+                months = station_populated_months(s3, station_id, frequency)
+            except s3.exceptions.NoSuchKey:
+                continue
+            encoded = encode_months(months)
+            if encoded:
+                entry[frequency] = encoded
+        return str(station_id), entry
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        index = dict(pool.map(index_station, station_ids))
+
+    publish_availability_index(s3, index)
+
+    return index
+
+
+#  function to store a new generation of the availability index and point the archive manifest at it
+def publish_availability_index(s3, index):
+
+    key = 'archive/{}/env-can-wx-availability-index.json'.format(pd.Timestamp.now().strftime('%Y%m%dT%H%M%S'))
+    s3.put_object(Bucket=os.environ['S3_BUCKET'], Key=key, Body=json.dumps(index, separators=(',', ':')),
+                  ContentType='application/json')
+    stations.publish_archive_keys(s3, availability=key)
+
+######################################### INDEX LOOKUP #################################################################
+
+
+_lock = threading.Lock()
+_index = (None, None)
+
+
+#  function to load the availability index, an empty index if it has not been built yet. the index is cached with the
+#  key it was read from and reloaded when the archive manifest points at a new generation
+def get_availability_index():
+
+    global _index
+
+    key = stations.archive_key('availability')
+    if _index[0] != key:
+        with _lock:
+            if _index[0] != key:
+                s3 = get_s3_client()
+                try:
+                    obj = s3.get_object(Bucket=os.environ['S3_BUCKET'], Key=key)
+                    _index = (key, json.loads(obj['Body'].read()))
+                except s3.exceptions.NoSuchKey:
+                    _index = (key, {})
+
+    return _index[1]
+
+
+#  function to return the sorted populated month numbers of a station, None if the station is not indexed
+def populated_months(station_id, frequency):
+
+    entry = get_availability_index().get(str(station_id), {}).get(frequency)
+    if entry is None:
+        return None
+
+    return decode_months(entry)
+
+
+#  function to return the years with at least one populated month, None if the station is not indexed
+def available_years(station_id, frequency):
+
+    months = populated_months(station_id, frequency)
+    if months is None:
+        return None
+
+    return sorted(set((months // 12).tolist()))
+
+
+#  function to narrow a requested date range to its first and last populated month. returns the requested range when
+#  the station is not indexed and None when the range holds no data at all
+def populated_range(station_id, frequency, start_date, end_date):
+
+    months = populated_months(station_id, frequency)
+    if months is None:
+        return start_date, end_date
+
+    months = months[(months >= month_number(start_date)) & (months <= month_number(end_date))]
+    if not len(months):
+        return None
+
+    return max(start_date, month_start(months[0])), min(end_date, month_start(months[-1] + 1))
+
+
+if __name__ == '__main__':
+
+    build_availability_index(stations.get_station_metadata().station_id.tolist())
@@ -0,0 +1,50 @@
+import os
+
+from flask_caching import Cache
+from flask_caching.backends.rediscache import RedisCache
+from connections import get_redis
+
+######################################### SETTINGS #####################################################################
+
+#  seconds a memoized callback result is kept. every entry is written with a ttl, so with the redis maxmemory-policy set
+#  to volatile-lru the least recently used results are evicted first and scheduler keys are never touched
+CACHE_DEFAULT_TIMEOUT = int(os.environ.get('CACHE_DEFAULT_TIMEOUT', 60 * 60))
+
+#  results larger than this are not cached, large figures would crowd out the popular small ones
+CACHE_MAX_VALUE_BYTES = int(os.environ.get('CACHE_MAX_VALUE_BYTES', 2 * 1024 * 1024))
+
+CACHE_CONFIG = {
+    'CACHE_TYPE': 'caching.size_limited_redis',
+    'CACHE_KEY_PREFIX': 'whc:cache:',
+    'CACHE_DEFAULT_TIMEOUT': CACHE_DEFAULT_TIMEOUT,
+}
+
+######################################### CACHE BACKEND ################################################################
+
+
+#  redis cache that skips values over the size limit instead of storing them
+class SizeLimitedRedisCache(RedisCache):
+
+    def __init__(self, max_value_bytes=CACHE_MAX_VALUE_BYTES, **kwargs):
+
+        super(SizeLimitedRedisCache, self).__init__(**kwargs)
+        self.max_value_bytes = max_value_bytes
+
+    def set(self, key, value, timeout=None):
+
+        if len(self.dump_object(value)) > self.max_value_bytes:
+            return False
+
+        return super(SizeLimitedRedisCache, self).set(key, value, timeout)
+
+
+#  flask-caching backend factory, the cache shares the process redis client and its connection limit
+def size_limited_redis(app, config, args, kwargs):
+
+    kwargs.update(host=get_redis(), key_prefix=config['CACHE_KEY_PREFIX'])
+
+    return SizeLimitedRedisCache(*args, **kwargs)
+
+
+#  shared cache of the web processes, bound to the flask server in app.py
+cache = Cache(config=CACHE_CONFIG)
@@ -0,0 +1,123 @@
+import os
+import json
+import hashlib
+import pandas as pd
+import extraction
+import output_formats
+import stations
+
+from concurrent.futures import ThreadPoolExecutor
+
+######################################### SETTINGS #####################################################################
+
+#  intermediate results of running downloads, kept apart from the generated files in tmp/
+CHECKPOINT_PREFIX = 'checkpoints/'
+
+#  times a download that runs out of time is resumed from its checkpoints before it fails
+MAX_RESUMES = int(os.environ.get('CHECKPOINT_MAX_RESUMES', 10))
+
+#  checkpoints older than this belong to jobs that failed for good or to an older archive generation and are deleted by
+#  clear_stale_checkpoints, a job resumes for well under an hour
+CHECKPOINT_MAX_AGE = int(os.environ.get('CHECKPOINT_MAX_AGE', 24 * 60 * 60))
+
+######################################### CHECKPOINTS ##################################################################
+
+
+#  function to return the key of a download job from everything that decides its output, so a resubmitted job with the
+#  same settings finds the checkpoints of an earlier attempt. segments of an older archive generation are never loaded
+def job_key(*params):
+
+    params = (stations.get_archive_manifest().get('generation', ''),) + params
+
+    return hashlib.md5(json.dumps(params, default=str, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def segment_key(key, index):
+
+    return '{}{}/{:04d}.parquet'.format(CHECKPOINT_PREFIX, key, index)
+
+
+#  function to load a finished segment, None if it has not been checkpointed
+def load_segment(s3, key, index):
+
+    try:
+        obj = s3.get_object(Bucket=os.environ['S3_BUCKET'], Key=segment_key(key, index))
+    except s3.exceptions.NoSuchKey:
+        return None
+
+    return output_formats.read_dataframe(obj['Body'], 'parquet')
+
+
+#  segments are stored as parquet like the prefetched extracts, so nothing read back from the bucket is unpickled
+def save_segment(s3, key, index, df):
+
+    buffer = output_formats.write_dataframe(df, 'parquet')
+    s3.upload_fileobj(buffer, os.environ['S3_BUCKET'], segment_key(key, index))
+    buffer.close()
+
+
+#  function to delete the checkpoints of a job once its file has been uploaded
+def clear_checkpoints(s3, key):
+
+    resp = s3.list_objects_v2(Bucket=os.environ['S3_BUCKET'], Prefix='{}{}/'.format(CHECKPOINT_PREFIX, key))
+    objects = [{'Key': obj['Key']} for obj in resp.get('Contents', [])]
+    if objects:
+        s3.delete_objects(Bucket=os.environ['S3_BUCKET'], Delete={'Objects': objects})
+
+
+#  function to delete the checkpoints left behind by jobs that never finished, returns the number of objects deleted
+def clear_stale_checkpoints(s3, max_age=CHECKPOINT_MAX_AGE):
+
+    cutoff = pd.Timestamp.now(tz='UTC') - pd.Timedelta(seconds=max_age)
+    deleted = 0
+
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=os.environ['S3_BUCKET'], Prefix=CHECKPOINT_PREFIX):
+        objects = [{'Key': obj['Key']} for obj in page.get('Contents', []) if pd.Timestamp(obj['LastModified']) < cutoff]
+        if objects:
+            s3.delete_objects(Bucket=os.environ['S3_BUCKET'], Delete={'Objects': objects})
+            deleted += len(objects)
+
+    return deleted
+
+
+#  function to list the indexes of the segments an earlier attempt of a job checkpointed, one list request per job
+def saved_segments(s3, key):
+
+    resp = s3.list_objects_v2(Bucket=os.environ['S3_BUCKET'], Prefix='{}{}/'.format(CHECKPOINT_PREFIX, key))
+
+    return {int(obj['Key'].rsplit('/', 1)[-1].split('.')[0]) for obj in resp.get('Contents', [])}
+
+
+#  function to query station data in batches of archive files (year partitions, or the single csv of a station that is
+#  not partitioned). the files of a batch are queried at the same time like extraction.query_station_data does, every
+#  finished batch is checkpointed to s3 as one segment and batches checkpointed by an earlier attempt are loaded instead
+#  of queried again. every file is queried with the requested dates, the dates in the files are compared as text so
+#  bounds cut at year boundaries would drop the first day or month of each year. progress(done, total) is called with
+#  the files finished after each batch
+def extract_with_checkpoints(s3, key, station_id, frequency, start_date, end_date, columns=None, progress=None):
+
+    partitions = extraction.list_year_partitions(s3, station_id, frequency)
+    file_headers = extraction.query_station_headers(s3, station_id, frequency, partitions)
+    sql_stmt, col_names, file_header_info = extraction.station_select_sql(file_headers, start_date, end_date, columns)
+    file_keys = extraction.station_file_keys(station_id, frequency, start_date, end_date, partitions)
+
+    batch_size = extraction.PARTITION_QUERY_WORKERS
+    batches = [file_keys[start:start + batch_size] for start in range(0, len(file_keys), batch_size)]
+    saved = saved_segments(s3, key) if batches else set()
+
+    frames = []
+    with ThreadPoolExecutor(max_workers=batch_size) as pool:
+        for index, batch in enumerate(batches):
+            df = load_segment(s3, key, index) if index in saved else None
+            if df is None:
+                df = pd.concat(pool.map(lambda file_key: extraction.query_data_s3(s3, file_key, sql_stmt, col_names,
+                                                                                  file_header_info), batch), sort=False)
+                save_segment(s3, key, index, df)
+            frames.append(df)
+            if progress:
+                progress(min((index + 1) * batch_size, len(file_keys)), len(file_keys))
+
+    if not frames:
+        return pd.DataFrame(columns=list(col_names))
+
+    return pd.concat(frames, sort=False)
@@ -0,0 +1,168 @@
+import os
+import io
+import time
+import threading
+import pandas as pd
+import stations
+import extraction
+import aggregation
+
+from concurrent.futures import ThreadPoolExecutor
+from connections import get_s3_client
+
+######################################### SETTINGS #####################################################################
+
+#  climatology tables are built from these archives, daily first so hourly only adds the variables daily files lack
+SOURCE_FREQUENCIES = ('Daily', 'Hourly')
+
+#  base temperature of heating and cooling degree days
+DEGREE_DAY_BASE = 18.0
+
+CLIMATOLOGY_STATS = ['mean', 'min', 'max', 'p05', 'p50', 'p95', 'monthly_total', 'n_years']
+
+#  stations whose climatology tables are built at the same time
+CLIMATOLOGY_WORKERS = int(os.environ.get('CLIMATOLOGY_WORKERS', 8))
+
+#  climatology tables kept in memory per web process, and seconds before a kept table is checked against s3 again so
+#  rebuilt tables reach running web workers
+CLIMATOLOGY_CACHE_SIZE = 256
+CLIMATOLOGY_REFRESH_SECONDS = int(os.environ.get('CLIMATOLOGY_REFRESH_SECONDS', 600))
+
+######################################### HELPER FUNCTIONS #############################################################
+
+
+#  key of the climatology table stored next to a station's archive
+def climatology_key(station_id):
+
+    return '{}_climatology.csv'.format(station_id)
+
+
+#  function to compute calendar month statistics of every numeric variable of a station dataframe. monthly_total is the
+#  mean over years of each month's sum, only for accumulated variables (precipitation, snow and degree days) and nan for
+#  the others
+def monthly_climatology(df):
+
+    dates = pd.to_datetime(df['Date/Time'], errors='coerce')
+    value_cols = [c for c in df.columns if not c.endswith('Flag') and not c.startswith(stations.ROW_COLUMNS)]
+    values = df[value_cols].apply(pd.to_numeric, errors='coerce')
+    values.index = dates
+    values = values[values.index.notna()].dropna(how='all', axis=1)
+
+    #  degree days are derived from the daily mean temperature when the archive does not carry them
+    if 'Mean Temp (°C)' in values and 'Heat Deg Days (°C)' not in values:
+        values['Heat Deg Days (°C)'] = (DEGREE_DAY_BASE - values['Mean Temp (°C)']).clip(lower=0)
+        values['Cool Deg Days (°C)'] = (values['Mean Temp (°C)'] - DEGREE_DAY_BASE).clip(lower=0)
+
+    if values.empty:
+        return pd.DataFrame(columns=['variable', 'month'] + CLIMATOLOGY_STATS)
+
+    long = values.stack().rename('value').reset_index()
+    long.columns = ['date', 'variable', 'value']
+    long['month'] = long['date'].dt.month
+    long['year'] = long['date'].dt.year
+
+    grouped = long.groupby(['variable', 'month'])['value']
+    table = grouped.agg(['mean', 'min', 'max'])
+    percentiles = grouped.quantile([0.05, 0.5, 0.95]).unstack()
+    percentiles.columns = ['p05', 'p50', 'p95']
+    monthly_sums = long.groupby(['variable', 'year', 'month'])['value'].sum()
+    totals = monthly_sums.groupby(level=['variable', 'month']).agg(['mean', 'count'])
+    totals.columns = ['monthly_total', 'n_years']
+    totals['monthly_total'] = totals['monthly_total'].where(
+        [aggregation.is_accumulated(variable) for variable in totals.index.get_level_values('variable')])
+
+    return table.join(percentiles).join(totals).reset_index()
+
+######################################### PRECOMPUTATION ###############################################################
+
+
+#  function to build and store the climatology table of one station, returns False if it has no daily or hourly data
+def build_station_climatology(s3, station_id):
+
+    tables = []
+    for frequency in SOURCE_FREQUENCIES:
+        try:
+            df = extraction.query_station_data(s3, station_id, frequency, pd.Timestamp('1800-01-01'), pd.Timestamp.now())
+        except s3.exceptions.NoSuchKey:
+            continue
+        table = monthly_climatology(df)
+        table['source'] = frequency
+        tables.append(table)
+
+    if not tables:
+        return False
+
+    table = pd.concat(tables, ignore_index=True, sort=False).drop_duplicates(subset=['variable', 'month'], keep='first')
+    s3.put_object(Bucket=os.environ['S3_BUCKET'], Key=climatology_key(station_id), Body=table.to_csv(index=False),
+                  ContentType='text/csv')
+
+    return True
+
+
+#  function to build the climatology tables of many stations in parallel, returns the number of tables written
+def build_climatologies(station_ids, max_workers=CLIMATOLOGY_WORKERS):
+
+    s3 = get_s3_client()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return sum(pool.map(lambda station_id: build_station_climatology(s3, station_id), station_ids))
+
+######################################### LOOKUP #######################################################################
+
+
+_lock = threading.Lock()
+_tables = {}
+
+
+#  function to load a station's climatology table with its s3 etag, (None, None) if it has not been built. tables stay
+#  in memory until the cache is full, then the oldest is dropped. a kept table is checked with a conditional get every
+#  CLIMATOLOGY_REFRESH_SECONDS and replaced when it was rebuilt, missing tables are not kept so new ones show up at once
+def station_climatology(station_id):
+
+    station_id = str(station_id)
+    entry = _tables.get(station_id)
+    if entry is not None and time.time() - entry[2] < CLIMATOLOGY_REFRESH_SECONDS:
+        return entry[0], entry[1]
+
+    s3 = get_s3_client()
+    try:
+        obj = s3.get_object(Bucket=os.environ['S3_BUCKET'], Key=climatology_key(station_id),
+                            **({'IfNoneMatch': entry[0]} if entry is not None else {}))
+        etag, table = obj['ETag'], pd.read_csv(io.BytesIO(obj['Body'].read()))
+    except s3.exceptions.NoSuchKey:
+        with _lock:
+            _tables.pop(station_id, None)
+        return None, None
+    except s3.exceptions.ClientError as e:
+        if entry is None or e.response['Error']['Code'] not in ('304', 'NotModified'):
+            raise
+        etag, table = entry[0], entry[1]
+
+    with _lock:
+        _tables.pop(station_id, None)
+        if len(_tables) >= CLIMATOLOGY_CACHE_SIZE:
+            _tables.pop(next(iter(_tables)))
+        _tables[station_id] = (etag, table, time.time())
+
+    return etag, table
+
+
+#  function to load a station's climatology table, None if it has not been built
+def get_station_climatology(station_id):
+
+    return station_climatology(station_id)[1]
+
+
+#  function to list the variables of a station's climatology table
+def climatology_variables(station_id):
+
+    table = get_station_climatology(station_id)
+    if table is None:
+        return []
+
+    return list(table['variable'].unique())
+
+
+if __name__ == '__main__':
+
+    print('Built {} climatology tables'.format(build_climatologies(stations.get_station_metadata().station_id.tolist())))
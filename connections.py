@@ -0,0 +1,96 @@
+import os
+import threading
+import redis
+
+######################################### SETTINGS #####################################################################
+
+#  connection pool and retry settings shared by every s3 client in the process
+S3_REGION = 'us-east-1'
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 50))
+S3_MAX_ATTEMPTS = int(os.environ.get('S3_MAX_ATTEMPTS', 5))
+S3_CONNECT_TIMEOUT = int(os.environ.get('S3_CONNECT_TIMEOUT', 10))
+S3_READ_TIMEOUT = int(os.environ.get('S3_READ_TIMEOUT', 60))
+
+#  s3 compatible endpoint (e.g. a local minio server for load tests), aws when not set
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None
+
+#  redis connections shared by the scheduler and caches of the web and worker processes
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 10))
+
+######################################### CLIENT MANAGER ###############################################################
+
+#  clients are created once per process and reused by every task and callback. boto3 clients are thread safe once
+#  created but sessions are not, so creation is guarded by a lock (a green lock when gevent has monkey patched
+#  threading). the pid is stored so a forked gunicorn or celery child never reuses its parent's sockets
+_lock = threading.Lock()
+_clients = {}
+_pid = None
+
+
+#  boto3 and botocore are slow to import, so they are loaded when the first client is created instead of at startup
+def _s3_config():
+
+    from botocore.config import Config
+
+    return Config(
+        region_name=S3_REGION,
+        max_pool_connections=S3_MAX_POOL_CONNECTIONS,  # one pooled keep-alive connection per concurrent greenlet
+        connect_timeout=S3_CONNECT_TIMEOUT,
+        read_timeout=S3_READ_TIMEOUT,
+        retries={'max_attempts': S3_MAX_ATTEMPTS},
+    )
+
+
+def _create_session():
+
+    import boto3
+
+    return boto3.session.Session(aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+                                 aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
+                                 region_name=S3_REGION)
+
+
+#  function to return the shared client for an aws service, creating it on first use
+def get_client(service_name='s3'):
+
+    global _pid
+
+    if _pid == os.getpid() and service_name in _clients:
+        return _clients[service_name]
+
+    with _lock:
+        if _pid != os.getpid():
+            _clients.clear()
+            _pid = os.getpid()
+
+        if service_name not in _clients:
+            _clients[service_name] = _create_session().client(service_name, config=_s3_config(),
+                                                                      endpoint_url=S3_ENDPOINT_URL if service_name == 's3' else None)
+
+    return _clients[service_name]
+
+
+def get_s3_client():
+
+    return get_client('s3')
+
+
+#  function to return the shared redis client, its blocking pool makes greenlets wait for a free connection instead of
+#  opening more than the redis plan allows
+def get_redis():
+
+    global _pid
+
+    if _pid == os.getpid() and 'redis' in _clients:
+        return _clients['redis']
+
+    with _lock:
+        if _pid != os.getpid():
+            _clients.clear()
+            _pid = os.getpid()
+
+        if 'redis' not in _clients:
+            pool = redis.BlockingConnectionPool.from_url(os.environ['REDIS_URL'], max_connections=REDIS_MAX_CONNECTIONS, timeout=20)
+            _clients['redis'] = redis.Redis(connection_pool=pool)
+
+    return _clients['redis']
@@ -0,0 +1,137 @@
+import os
+import sys
+import pickle
+import struct
+import threading
+
+######################################### SETTINGS #####################################################################
+
+#  processes parsing s3 select results for a gevent worker, 0 parses inline. pandas parsing holds the gil and would stop
+#  every other greenlet of the worker for as long as it runs
+CPU_POOL_PROCESSES = int(os.environ.get('CPU_POOL_PROCESSES', 0))
+
+#  calls are sent to the pool processes as length prefixed pickles of (function, args), functions are pickled by
+#  reference so they must be module level functions the pool process can import
+_header = struct.Struct('>Q')
+
+######################################### POOL PROCESSES ###############################################################
+
+
+def _send(stream, obj):
+
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    stream.write(_header.pack(len(data)))
+    stream.write(data)
+    stream.flush()
+
+
+def _receive(stream):
+
+    header = stream.read(_header.size)
+    if len(header) < _header.size:
+        raise EOFError('cpu pool process exited')
+
+    return pickle.loads(stream.read(_header.unpack(header)[0]))
+
+
+#  one pool process, started with gevent's subprocess module so waiting for a result only blocks the calling greenlet
+class PoolProcess(object):
+
+    def __init__(self):
+
+        from gevent import subprocess
+        self.proc = subprocess.Popen([sys.executable, os.path.abspath(__file__)], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    #  sends a call and reads its reply, returns (True, result) or (False, exception raised by fn)
+    def call(self, fn, args):
+
+        _send(self.proc.stdin, (fn, args))
+
+        return _receive(self.proc.stdout)
+
+    def close(self):
+
+        self.proc.kill()
+
+######################################### POOL MANAGER #################################################################
+
+#  the pool is started on first use in each worker process, never in the web processes
+_lock = threading.Lock()
+_idle = None
+_processes = []
+_pid = None
+
+
+def _get_pool():
+
+    global _idle, _pid
+
+    if _pid == os.getpid():
+        return _idle
+
+    with _lock:
+        if _pid != os.getpid():
+            from gevent.queue import Queue
+            del _processes[:]
+            _processes.extend(PoolProcess() for _ in range(CPU_POOL_PROCESSES))
+            _idle = Queue()
+            for process in _processes:
+                _idle.put(process)
+            _pid = os.getpid()
+
+    return _idle
+
+
+#  function to run fn(*args) in a pool process, inline when the pool is turned off. only a process that sent back its
+#  whole reply goes back to the pool. one that died, or whose call was cut short by a task time limit or a killed
+#  greenlet, may still have a reply in its pipe, so it is closed and replaced before the error is raised
+def run(fn, *args):
+
+    if CPU_POOL_PROCESSES <= 0:
+        return fn(*args)
+
+    idle = _get_pool()
+    process = idle.get()
+
+    try:
+        ok, result = process.call(fn, args)
+    except BaseException:
+        _processes.remove(process)
+        process.close()
+        process = PoolProcess()
+        _processes.append(process)
+        idle.put(process)
+        raise
+
+    idle.put(process)
+    if not ok:
+        raise result
+
+    return result
+
+
+#  function to list the pool process ids of this worker, their memory counts against the worker memory budget
+def worker_pids():
+
+    if _pid != os.getpid():
+        return []
+
+    return [process.proc.pid for process in _processes]
+
+
+if __name__ == '__main__':
+
+    #  pool process loop, answers calls until the worker closes its pipe
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    sys.stdout = sys.stderr  # keep prints of called functions out of the result pipe
+
+    while True:
+        try:
+            fn, args = _receive(stdin)
+        except EOFError:
+            break
+        try:
+            _send(stdout, (True, fn(*args)))
+        except Exception as e:
+            _send(stdout, (False, e))
@@ -0,0 +1,114 @@
+import os
+import numpy as np
+import pandas as pd
+import stations
+import extraction
+import availability
+import output_formats
+import cpu_pool
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+######################################### SETTINGS #####################################################################
+
+#  comparisons an extreme event search can use
+SEARCH_OPERATORS = {'>': np.greater, '>=': np.greater_equal, '<': np.less, '<=': np.less_equal}
+
+#  variables offered in the search form for each data frequency
+SEARCH_VARIABLES = {
+    'Hourly': ['Temp (°C)', 'Dew Point Temp (°C)', 'Rel Hum (%)', 'Wind Spd (km/h)', 'Stn Press (kPa)', 'Hmdx', 'Wind Chill'],
+    'Daily': ['Max Temp (°C)', 'Min Temp (°C)', 'Mean Temp (°C)', 'Total Rain (mm)', 'Total Snow (cm)', 'Total Precip (mm)',
+              'Snow on Grnd (cm)', 'Spd of Max Gust (km/h)'],
+    'Monthly': ['Mean Max Temp (°C)', 'Mean Min Temp (°C)', 'Mean Temp (°C)', 'Extr Max Temp (°C)', 'Extr Min Temp (°C)',
+                'Total Rain (mm)', 'Total Snow (cm)', 'Total Precip (mm)'],
+}
+
+#  stations scanned at the same time by one search, the s3 select queries wait on the network so a search runs many
+#  more of them than the worker has cpu pool processes to evaluate the results
+SCAN_QUERY_WORKERS = int(os.environ.get('SCAN_QUERY_WORKERS', 16))
+
+#  most stations one search may scan
+MAX_SCAN_STATIONS = int(os.environ.get('MAX_SCAN_STATIONS', 2000))
+
+#  columns of the search result, the value column is named after the variable
+STATION_COLUMNS = ['station_id', 'climate_id', 'province', 'station_name']
+
+######################################### STATION SCAN #################################################################
+
+
+#  function to evaluate the search on the select records of one station file in a single vectorized comparison. runs in
+#  a cpu pool process, only the matching dates and values are sent back to the worker
+def match_records(file_str, col_names, variable, operator, threshold):
+
+    df = output_formats.read_select_records(file_str, col_names)
+    values = pd.to_numeric(df[variable], errors='coerce').values
+    with np.errstate(invalid='ignore'):
+        matched = SEARCH_OPERATORS[operator](values, threshold)
+
+    return pd.DataFrame({'Date/Time': df['Date/Time'].values[matched], variable: values[matched]},
+                        columns=['Date/Time', variable])
+
+
+#  function to build the s3 select statement of a search between two dates, only the date and variable columns are
+#  selected (the first column is still selected to be read as the index, as in extraction.station_select_sql)
+def search_select_sql(file_headers, variable, start_date, end_date):
+
+    position = {name: i + 2 for i, name in enumerate(file_headers)}
+
+    return "SELECT s._1, s._{0}, s._{1} FROM s3object s WHERE s._{0} BETWEEN '{2}' AND '{3}'".format(
+        position['Date/Time'], position[variable], start_date, end_date)
+
+
+#  function to return the stations a search scans: stations of the province with any data of the frequency between the
+#  years, in station table order
+def search_stations(frequency, start_year, end_year, province=None):
+
+    mask = stations.coverage_mask(frequency, int(start_year), int(end_year), full_coverage=False, province=province or None)
+
+    return stations.get_station_metadata()[mask]
+
+
+#  function to scan the files of one station between two dates, the months the availability index knows to be empty
+#  are skipped. returns the matching rows with the station columns, none for a station without an archive file
+def scan_station(s3, station, frequency, variable, operator, threshold, start_date, end_date):
+
+    columns = ['Date/Time', variable]
+    empty = pd.DataFrame(columns=STATION_COLUMNS + columns)
+
+    data_range = availability.populated_range(station['station_id'], frequency, start_date, end_date)
+    if data_range is None:
+        return empty
+
+    try:
+        partitions = extraction.list_year_partitions(s3, station['station_id'], frequency)
+        file_headers = extraction.query_station_headers(s3, station['station_id'], frequency, partitions)
+        if variable not in file_headers:
+            return empty
+
+        sql_stmt = search_select_sql(file_headers, variable, data_range[0], data_range[1])
+        frames = [cpu_pool.run(match_records, extraction.select_records_s3(s3, key, sql_stmt, 'Ignore'), columns, variable,
+                               operator, threshold)
+                  for key in extraction.station_file_keys(station['station_id'], frequency, data_range[0], data_range[1], partitions)]
+    except s3.exceptions.NoSuchKey:
+        return empty
+    df = pd.concat(frames, sort=False) if frames else empty[columns]
+
+    for i, column in enumerate(STATION_COLUMNS):
+        df.insert(i, column, station[column])
+
+    return df
+
+
+#  function to scan many stations in parallel, yields (stations done, stations total, matching rows) as each station
+#  finishes so the matches can be written out while the scan runs
+def scan_stations(s3, df_stations, frequency, variable, operator, threshold, start_date, end_date):
+
+    records = df_stations[STATION_COLUMNS].to_dict('records')
+    if not records:
+        return
+
+    with ThreadPoolExecutor(max_workers=min(len(records), SCAN_QUERY_WORKERS)) as pool:
+        futures = [pool.submit(scan_station, s3, station, frequency, variable, operator, float(threshold), start_date, end_date)
+                   for station in records]
+        for done, future in enumerate(as_completed(futures), 1):
+            yield done, len(futures), future.result()
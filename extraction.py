@@ -0,0 +1,189 @@
+import os
+import json
+import pandas as pd
+import output_formats
+import availability
+import stations
+import cpu_pool
+
+from io import StringIO
+from connections import get_redis
+from concurrent.futures import ThreadPoolExecutor
+
+#  year partitions of a station archive queried at the same time by one task
+PARTITION_QUERY_WORKERS = 8
+
+#  seconds the column names of an unregistered station archive are kept in redis after reading them from s3
+HEADER_CACHE_SECONDS = 24 * 60 * 60
+
+######################################### HELPER FUNCTIONS #############################################################
+
+#  function to query column names of s3 file
+def query_header_name_s3(s3, filename):
+
+    resp = s3.select_object_content(
+        Bucket=os.environ['S3_BUCKET'],
+        Key=filename,
+        ExpressionType='SQL',
+        Expression='SELECT * FROM s3object s LIMIT 1',
+        InputSerialization={'CSV': {"FileHeaderInfo": "None"}},
+        OutputSerialization={'CSV': {}},
+    )
+
+    records = []
+    for event in resp['Payload']:
+        if 'Records' in event:
+            records.append(event['Records']['Payload'])
+
+    file_str = ''.join(req.decode('utf-8') for req in records)
+
+    headers = pd.read_csv(StringIO(file_str), index_col=0).columns
+
+    return headers
+
+#  function to run an s3 select query on a station file and return the csv text of the records
+def select_records_s3(s3, filename, sql_stmt, file_header_info='Use'):
+
+    resp = s3.select_object_content(
+        Bucket=os.environ['S3_BUCKET'],
+        Key=filename,
+        ExpressionType='SQL',
+        Expression=sql_stmt,
+        InputSerialization={'CSV': {"FileHeaderInfo": file_header_info}},
+        OutputSerialization={'CSV': {}},
+    )
+
+    records = []
+    for event in resp['Payload']:
+        if 'Records' in event:
+            records.append(event['Records']['Payload'])
+
+    return ''.join(req.decode('utf-8') for req in records)
+
+
+#  function to query data from s3 file. positional queries (s._1, s._2 ...) need file_header_info='Ignore'
+def query_data_s3(s3, filename, sql_stmt, col_names, file_header_info='Use'):
+
+    file_str = select_records_s3(s3, filename, sql_stmt, file_header_info)
+
+    #  parsing runs in a cpu pool process in the memory bounded worker mode so it does not block other greenlets
+    df = cpu_pool.run(output_formats.read_select_records, file_str, list(col_names))
+
+    return df
+
+#  function to list the year partitions of a station archive, empty if the station is still stored as a single csv
+def list_year_partitions(s3, station_id, frequency):
+
+    prefix = '{}_{}/'.format(station_id, frequency.lower())
+    partitions = {}
+
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=os.environ['S3_BUCKET'], Prefix=prefix):
+        for obj in page.get('Contents', []):
+            year = obj['Key'][len(prefix):].split('.')[0]
+            if year.isdigit():
+                partitions[int(year)] = obj['Key']
+
+    return partitions
+
+
+#  function to return the archive files of a station that can hold data between two dates, the single csv of a station
+#  that is not partitioned
+def station_file_keys(station_id, frequency, start_date, end_date, partitions):
+
+    if not partitions:
+        return ['_'.join([str(station_id), frequency.lower() + '.csv'])]
+
+    return [partitions[year] for year in sorted(partitions) if start_date.year <= year <= end_date.year]
+
+
+#  function to return the column names of a station archive, from the header registry when the station is registered
+def query_station_headers(s3, station_id, frequency, partitions=None):
+
+    header = stations.get_header_registry().get(stations.header_registry_key(station_id, frequency))
+    if header:
+        return pd.Index(header[1:])  # first column is read as the index, as in query_header_name_s3
+
+    #  stations missing from the registry are read once per archive generation and shared through redis
+    cache_key = 'whc:headers:{}:{}'.format(stations.get_archive_manifest().get('generation', ''),
+                                           stations.header_registry_key(station_id, frequency))
+    cached = get_redis().get(cache_key)
+    if cached is not None:
+        return pd.Index(json.loads(cached))
+
+    if partitions is None:
+        partitions = list_year_partitions(s3, station_id, frequency)
+    if partitions:
+        headers = query_header_name_s3(s3, partitions[min(partitions)])
+    else:
+        headers = query_header_name_s3(s3, '_'.join([str(station_id), frequency.lower() + '.csv']))
+
+    get_redis().set(cache_key, json.dumps(list(headers)), ex=HEADER_CACHE_SECONDS)
+
+    return headers
+
+
+#  function to return the archive columns kept for a variable selection: the row columns, the variables and their
+#  quality flags. eccc names the flag of 'Max Temp (°C)' 'Max Temp Flag'
+def projected_columns(file_headers, variables):
+
+    wanted = set(variables) | set('{} Flag'.format(variable.split(' (')[0]) for variable in variables)
+
+    return [c for c in file_headers if c.startswith(stations.ROW_COLUMNS) or c in wanted]
+
+
+#  function to return the variables of a station archive a user can choose from, without row and flag columns
+def station_variables(s3, station_id, frequency):
+
+    file_headers = query_station_headers(s3, station_id, frequency)
+
+    return [c for c in file_headers if not c.endswith('Flag') and not c.startswith(stations.ROW_COLUMNS)]
+
+
+#  function to build the s3 select statement of a station query between two dates. with a variable selection the
+#  columns are selected by position, so the first column still comes back first and is read as the index like with
+#  select *. returns the statement, the column names it returns and the file header info it needs
+def station_select_sql(file_headers, start_date, end_date, columns=None):
+
+    if columns is None:
+        sql_stmt = "SELECT * FROM s3object s WHERE s.\"Date/Time\" BETWEEN '{}' AND '{}'".format(start_date, end_date)
+        return sql_stmt, file_headers, 'Use'
+
+    position = {name: i + 2 for i, name in enumerate(file_headers)}  # s._1 is the first column, read as the index
+    col_names = projected_columns(file_headers, columns)
+    sql_stmt = "SELECT s._1, {} FROM s3object s WHERE s._{} BETWEEN '{}' AND '{}'".format(
+        ', '.join('s._{}'.format(position[c]) for c in col_names), position['Date/Time'], start_date, end_date)
+
+    return sql_stmt, pd.Index(col_names), 'Ignore'
+
+
+#  function to query station data between two dates, only year partitions inside the dates are scanned. columns limits
+#  the query to a variable selection, None returns every column
+def query_station_data(s3, station_id, frequency, start_date, end_date, columns=None):
+
+    partitions = list_year_partitions(s3, station_id, frequency)
+    file_headers = query_station_headers(s3, station_id, frequency, partitions)
+    sql_stmt, col_names, file_header_info = station_select_sql(file_headers, start_date, end_date, columns)
+
+    keys = station_file_keys(station_id, frequency, start_date, end_date, partitions)
+    if not partitions:
+        return query_data_s3(s3, keys[0], sql_stmt, col_names, file_header_info)
+
+    if not keys:
+        return pd.DataFrame(columns=list(col_names))
+
+    with ThreadPoolExecutor(max_workers=min(len(keys), PARTITION_QUERY_WORKERS)) as pool:
+        frames = list(pool.map(lambda key: query_data_s3(s3, key, sql_stmt, col_names, file_header_info), keys))
+
+    return pd.concat(frames, sort=False)
+
+#  function to extract the station data of a download between two dates, the dates are first narrowed to the populated
+#  months of the station availability index and the scan is skipped when they hold no data
+def extract_station_data(s3, station_id, frequency, start_date, end_date, columns=None):
+
+    data_range = availability.populated_range(station_id, frequency, start_date, end_date)
+
+    if data_range is None:
+        file_headers = query_station_headers(s3, station_id, frequency)
+        return pd.DataFrame(columns=file_headers if columns is None else projected_columns(file_headers, columns))
+
+    return query_station_data(s3, station_id, frequency, *data_range, columns=columns)
@@ -0,0 +1,108 @@
+import os
+import base64
+import numpy as np
+import pandas as pd
+
+######################################### SETTINGS #####################################################################
+
+#  'binary' sends the arrays of large figures as base64 typed arrays that assets/clientside.js decodes in the browser,
+#  'json' sends plain lists
+FIGURE_ENCODING = os.environ.get('FIGURE_ENCODING', 'binary')
+
+#  trace attributes holding data arrays
+ARRAY_ATTRIBUTES = ('x', 'y')
+
+#  timestamps are sent as int32 offsets from the first one, in days when every timestamp is a midnight so daily and
+#  monthly series stay small, otherwise in minutes (enough for 4000 years of hourly data)
+DAY_MS = 24 * 60 * 60 * 1000
+MINUTE_MS = 60 * 1000
+
+######################################### ARRAY ENCODING ###############################################################
+
+#  an encoded array is {'bdata': base64 little endian bytes, 'dtype': 'f4' | 'i4' | 'i1'} plus
+#    'start' and 'step' for timestamps: value = start + offset * step in epoch milliseconds, drawn on a date axis
+#    'categories' for labels: value = categories[code]
+#  float values are sent as float32, observations carry at most a few significant digits, and missing values as nan
+
+
+def is_dates(dates):
+
+    return bool(((dates.hour == 0) & (dates.minute == 0) | dates.isna()).all())
+
+
+def encode_bytes(values, dtype):
+
+    return base64.b64encode(np.ascontiguousarray(values, dtype='<' + dtype).tobytes()).decode('ascii')
+
+
+def encode_numbers(values):
+
+    return {'bdata': encode_bytes(values, 'f4'), 'dtype': 'f4'}
+
+
+#  function to encode naive timestamps as offsets from the first one. missing timestamps, which generated files do not
+#  have, are sent as the first timestamp
+def encode_timestamps(values):
+
+    dates = pd.DatetimeIndex(values)
+    valid = ~dates.isna()
+    ms = dates.values.astype('datetime64[ms]').astype(np.int64)
+    start = int(ms[valid].min()) if valid.any() else 0
+    step = DAY_MS if is_dates(dates) else MINUTE_MS
+
+    return {'bdata': encode_bytes(np.where(valid, (ms - start) // step, 0), 'i4'), 'dtype': 'i4', 'start': start, 'step': step}
+
+
+def encode_labels(values):
+
+    codes, categories = pd.factorize(pd.Series(values).astype(str))
+
+    return {'bdata': encode_bytes(codes, 'i1' if len(categories) < 128 else 'i4'),
+            'dtype': 'i1' if len(categories) < 128 else 'i4', 'categories': list(categories)}
+
+
+#  function to encode a data array by its type, None leaves arrays that are not worth encoding as they are
+def encode_array(values):
+
+    if isinstance(values, dict) or len(values) == 0:
+        return None
+
+    series = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return encode_timestamps(series)
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        return encode_numbers(series.values)
+    if pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+        return encode_labels(series)
+
+    return None
+
+######################################### FIGURE ENCODING ##############################################################
+
+
+#  function to encode the data arrays of a figure dict in the configured encoding. json mode only turns timestamps into
+#  date strings. axes of encoded timestamps are set to date, plotly would draw the decoded millisecond numbers on a
+#  linear axis otherwise
+def encode_figure(figure):
+
+    for trace in figure['data']:
+        for attribute in ARRAY_ATTRIBUTES:
+            values = trace.get(attribute)
+            if values is None or isinstance(values, (str, dict)):
+                continue
+
+            if FIGURE_ENCODING != 'binary':
+                if pd.api.types.is_datetime64_any_dtype(values):
+                    dates = pd.DatetimeIndex(values)
+                    trace[attribute] = list(dates.strftime('%Y-%m-%d' if is_dates(dates) else '%Y-%m-%d %H:%M'))
+                continue
+
+            encoded = encode_array(values)
+            if encoded is None:
+                continue
+            trace[attribute] = encoded
+            if 'start' in encoded:
+                axis = '{}axis'.format(attribute)
+                figure['layout'][axis] = dict(figure['layout'].get(axis, {}), type='date')
+
+    return figure
@@ -3,13 +3,15 @@ import dash_html_components as html
 
 from dash.dependencies import Input, Output
 from app import app
-from pages import home_page, graph_page, about
+from pages import home_page, graph_page, compare_page, about  # cheap imports, s3 and celery are loaded on first use
+import api  # registers the flask api routes on app.server
 
 app.layout = html.Div([
     dcc.Location(id='url', refresh=False),
     dcc.Store(id='filename-store', storage_type='session'),
     dcc.Store(id='variable-name-store', storage_type='session'),
     dcc.Store(id='station-metadata-store', storage_type='session'),
+    dcc.Store(id='state-token', storage_type='session'),  # key of the tab's server side state, see session_state.py
     html.Div(id='page-content')
 ])
 
@@ -18,10 +20,12 @@ app.layout = html.Div([
 def display_page(pathname):
     if pathname == '/pages/graph_page':
         return graph_page.app_layout
+    elif pathname == '/pages/compare_page':
+        return compare_page.app_layout
     elif pathname == '/pages/about':
         return about.app_layout
     else:
-        return home_page.app_layout
+        return home_page.serve_layout()
 
 if __name__ == '__main__':
-    app.run_server(debug=True)
\ No newline at end of file
+    app.run_server(debug=True)
@@ -0,0 +1,215 @@
+import os
+import io
+import json
+import numpy as np
+import pandas as pd
+import availability
+import stations
+import extraction
+import checkpoints
+
+from urllib.parse import urlencode
+from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor
+from connections import get_s3_client
+
+######################################### SETTINGS #####################################################################
+
+#  eccc bulk data endpoint, timeframe 1 returns one month of hourly data, 2 one year of daily data, 3 all monthly data
+ECCC_BULK_URL = 'https://climate.weather.gc.ca/climate_data/bulk_data_e.html'
+ECCC_TIMEFRAME = {'Hourly': 1, 'Daily': 2, 'Monthly': 3}
+
+#  raw station metadata columns holding the last date of each frequency
+LAST_DATE_COLUMNS = {'Hourly': 'last_year_hly', 'Daily': 'last_year_dly', 'Monthly': 'last_year_mly'}
+
+#  stations refreshed at the same time
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 16))
+
+######################################### HELPER FUNCTIONS #############################################################
+
+
+#  function to download station records newer than start_date from eccc, one request per month (hourly), year (daily)
+#  or station (monthly). only rows holding at least one observation are kept
+def fetch_eccc_data(station_id, frequency, start_date, end_date):
+
+    if frequency == 'Hourly':
+        periods = pd.date_range(start_date.replace(day=1), end_date, freq='MS')
+    elif frequency == 'Daily':
+        periods = pd.date_range(start_date.replace(month=1, day=1), end_date, freq='AS')
+    else:
+        periods = [start_date]
+
+    frames = []
+    for period in periods:
+        query = urlencode({'format': 'csv', 'stationID': station_id, 'Year': period.year, 'Month': period.month, 'Day': 1,
+                           'timeframe': ECCC_TIMEFRAME[frequency], 'submit': 'Download Data'})
+        with urlopen('{}?{}'.format(ECCC_BULK_URL, query), timeout=60) as resp:
+            frames.append(pd.read_csv(io.StringIO(resp.read().decode('utf-8-sig')), dtype=str))
+
+    df = pd.concat(frames, ignore_index=True, sort=False) if frames else pd.DataFrame()
+    if df.empty:
+        return df
+
+    #  eccc now suffixes local standard time columns, the archive keeps the original names
+    df.columns = [c.replace(' (LST)', '') for c in df.columns]
+
+    dates = pd.to_datetime(df['Date/Time'], errors='coerce')
+    value_cols = [c for c in df.columns if not c.endswith('Flag') and not c.startswith(stations.ROW_COLUMNS)]
+
+    return df[(dates > start_date) & (dates <= end_date) & df[value_cols].notna().any(axis=1)]
+
+
+#  function to read a year partition of a station archive, None if the year has not been written yet
+def read_partition(s3, key):
+
+    try:
+        obj = s3.get_object(Bucket=os.environ['S3_BUCKET'], Key=key)
+    except s3.exceptions.NoSuchKey:
+        return None
+
+    return pd.read_csv(obj['Body'], dtype=str)
+
+
+#  function to write rows into the year partitions they fall in, merging with rows already archived for that year
+def write_partitions(s3, station_id, frequency, df, header, merge=True):
+
+    years = pd.to_datetime(df['Date/Time'], errors='coerce').dt.year
+
+    for year, df_year in df.groupby(years.values):
+        key = stations.partition_key(station_id, frequency, int(year))
+        df_old = read_partition(s3, key) if merge else None
+
+        if df_old is not None:
+            df_year = pd.concat([df_old, df_year], ignore_index=True, sort=False)
+            df_year = df_year.drop_duplicates(subset=['Date/Time'], keep='last').sort_values('Date/Time')
+
+        s3.put_object(Bucket=os.environ['S3_BUCKET'], Key=key, Body=df_year.reindex(columns=header).to_csv(index=False),
+                      ContentType='text/csv')
+
+
+#  function to split a station still stored as one csv into year partitions, returns its header or None if the
+#  station has no archive yet. runs once per station, later refreshes only touch the partitions of new months
+def migrate_station(s3, station_id, frequency):
+
+    if extraction.list_year_partitions(s3, station_id, frequency):
+        return None
+
+    try:
+        obj = s3.get_object(Bucket=os.environ['S3_BUCKET'], Key='_'.join([str(station_id), frequency.lower() + '.csv']))
+    except s3.exceptions.NoSuchKey:
+        return None
+
+    df = pd.read_csv(obj['Body'], dtype=str)
+    write_partitions(s3, station_id, frequency, df, list(df.columns), merge=False)
+
+    return list(df.columns)
+
+######################################### PIPELINE #####################################################################
+
+
+#  function to bring one station and frequency up to date. returns the header, populated months and new last date, or
+#  None when eccc has nothing newer than the archive. stations missing from the availability index (indexed False) get
+#  the populated months of their whole archive, otherwise only the new months
+def refresh_station(station_id, frequency, last_date, header, end_date, indexed=True):
+
+    s3 = get_s3_client()
+
+    header = migrate_station(s3, station_id, frequency) or header
+
+    df_new = fetch_eccc_data(station_id, frequency, last_date, end_date)
+    if df_new.empty:
+        return None
+
+    #  new stations start their header from eccc, existing ones keep the archived column order
+    header = header or list(df_new.columns)
+    header = header + [c for c in df_new.columns if c not in header]
+
+    write_partitions(s3, station_id, frequency, df_new, header)
+
+    if indexed:
+        months = availability.observed_months(df_new)
+    else:
+        months = availability.station_populated_months(s3, station_id, frequency)
+
+    return header, months, pd.to_datetime(df_new['Date/Time']).max()
+
+
+#  function to merge newly populated months into a station's availability index entry, without an entry the months
+#  must cover the whole archive of the station (see refresh_station)
+def merge_availability(entry, new_months):
+
+    months = new_months if entry is None else np.concatenate([availability.decode_months(entry), new_months])
+
+    return availability.encode_months(months)
+
+
+#  function to refresh every station from the date of its last archived record, then publish the new metadata, header
+#  registry and availability index together. a station that fails is reported and left at its last archived date, the
+#  next refresh picks it up again
+def refresh_archive(end_date=None, max_workers=INGEST_WORKERS):
+
+    s3 = get_s3_client()
+    end_date = pd.Timestamp(end_date) if end_date else pd.Timestamp.now().normalize()
+
+    df_metadata = stations.download_csv_s3(s3, stations.archive_key('metadata'), os.environ['S3_BUCKET'])
+    station_id_column = df_metadata.columns[0]
+    header_registry = dict(stations.get_header_registry())
+    availability_index = dict(availability.get_availability_index())
+
+    jobs = []
+    for row_index, row in df_metadata.iterrows():
+        for frequency, column in LAST_DATE_COLUMNS.items():
+            last_date = pd.to_datetime(row[column], errors='coerce')
+            if pd.notna(last_date) and last_date < end_date:
+                jobs.append((row_index, row[station_id_column], frequency, last_date))
+
+    def run(job):
+        row_index, station_id, frequency, last_date = job
+        header = header_registry.get(stations.header_registry_key(station_id, frequency))
+        indexed = availability_index.get(str(station_id), {}).get(frequency) is not None
+        try:
+            return job, refresh_station(station_id, frequency, last_date, header, end_date, indexed)
+        except Exception as e:
+            print('Failed to refresh station {} {}: {}'.format(station_id, frequency, e))
+            return job, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = [(job, result) for job, result in pool.map(run, jobs) if result is not None]
+
+    for (row_index, station_id, frequency, last_date), (header, new_months, new_last_date) in results:
+        header_registry[stations.header_registry_key(station_id, frequency)] = header
+        station_index = dict(availability_index.get(str(station_id), {}))
+        station_index[frequency] = merge_availability(station_index.get(frequency), new_months)
+        availability_index[str(station_id)] = station_index
+        df_metadata.at[row_index, LAST_DATE_COLUMNS[frequency]] = new_last_date.strftime('%Y-%m-%d %H:%M:%S')
+
+    publish_archive(s3, df_metadata, header_registry, availability_index)
+
+    #  checkpoints of jobs that failed for good are left behind, and the new generation makes the older ones unusable
+    checkpoints.clear_stale_checkpoints(s3)
+
+    return len(results)
+
+
+#  function to write the metadata, header registry and availability index under a new generation and switch the
+#  archive manifest to it in one put. readers load the manifest first, so they see the old or the new generation
+#  but never a mix of the two
+def publish_archive(s3, df_metadata, header_registry, availability_index):
+
+    generation = pd.Timestamp.now().strftime('%Y%m%dT%H%M%S')
+    keys = {'metadata': 'archive/{}/env-can-wx-station-metadata.csv'.format(generation),
+            'headers': 'archive/{}/env-can-wx-header-registry.json'.format(generation),
+            'availability': 'archive/{}/env-can-wx-availability-index.json'.format(generation)}
+
+    s3.put_object(Bucket=os.environ['S3_BUCKET'], Key=keys['metadata'], Body=df_metadata.to_csv(), ContentType='text/csv')
+    s3.put_object(Bucket=os.environ['S3_BUCKET'], Key=keys['headers'], Body=json.dumps(header_registry),
+                  ContentType='application/json')
+    s3.put_object(Bucket=os.environ['S3_BUCKET'], Key=keys['availability'],
+                  Body=json.dumps(availability_index, separators=(',', ':')), ContentType='application/json')
+
+    stations.publish_archive_keys(s3, generation=generation, **keys)
+
+
+if __name__ == '__main__':
+
+    print('Refreshed {} station files'.format(refresh_archive()))
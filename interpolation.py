@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+import stations
+import extraction
+
+from concurrent.futures import ThreadPoolExecutor
+
+######################################### SETTINGS #####################################################################
+
+INTERPOLATION_METHODS = ('idw', 'nearest')
+
+#  most neighbour stations used for one location and most locations of one interpolation (point list or grid)
+MAX_NEIGHBOURS = 16
+MAX_INTERPOLATION_POINTS = 100
+
+#  stations queried at the same time, each query also scans its year partitions in parallel
+STATION_QUERY_WORKERS = 8
+
+#  time format of the interpolated series of each frequency, as in the station files
+DATE_FORMATS = {'Hourly': '%Y-%m-%d %H:%M', 'Daily': '%Y-%m-%d', 'Monthly': '%Y-%m'}
+
+#  distances are floored at this so a location on top of a station takes the station value instead of dividing by zero
+MIN_DISTANCE_KM = 0.001
+
+######################################### NEIGHBOURS ###################################################################
+
+
+#  function to return the locations of a grid over a bounding box, step in degrees, as (lat, lon) pairs
+def grid_points(south, west, north, east, step):
+
+    lats = np.arange(south, north + step / 2.0, step)
+    lons = np.arange(west, east + step / 2.0, step)
+    lat_grid, lon_grid = np.meshgrid(lats, lons, indexing='ij')
+
+    return list(zip(np.round(lat_grid.ravel(), 6), np.round(lon_grid.ravel(), 6)))
+
+
+#  function to find the k nearest stations of every location in one pass over the spatial index. returns the metadata
+#  rows of every station that is a neighbour of at least one location and a (locations x stations) distance matrix in
+#  km, inf where a station is not one of the k nearest of a location
+def neighbour_distances(points, k, mask=None, max_distance_km=None):
+
+    df = stations.get_station_metadata()
+    index = stations.get_spatial_index()
+
+    lats, lons = zip(*points)
+    cosine = stations.unit_vectors(lats, lons).dot(index['xyz'].T)
+    distance_km = stations.EARTH_RADIUS_KM * np.arccos(np.clip(cosine, -1.0, 1.0))
+    if mask is not None:
+        distance_km[:, ~mask] = np.inf
+    if max_distance_km is not None:
+        distance_km[distance_km > max_distance_km] = np.inf
+
+    k = min(int(k), distance_km.shape[1])
+    nearest = np.argpartition(distance_km, k - 1, axis=1)[:, :k]
+    neighbour = np.zeros(distance_km.shape, dtype=bool)
+    neighbour[np.arange(len(points))[:, None], nearest] = True
+    neighbour &= np.isfinite(distance_km)
+
+    columns = np.flatnonzero(neighbour.any(axis=0))
+
+    return df.iloc[columns], np.where(neighbour[:, columns], distance_km[:, columns], np.inf)
+
+######################################### STATION SERIES ###############################################################
+
+
+#  function to extract one variable of a station as a series indexed by time, empty when the station does not record it
+#  or has no archive file
+def station_series(s3, station_id, frequency, variable, start_date, end_date):
+
+    try:
+        df = extraction.extract_station_data(s3, station_id, frequency, start_date, end_date, columns=[variable])
+    except s3.exceptions.NoSuchKey:
+        return pd.Series([], index=pd.DatetimeIndex([]), dtype=np.float64)
+
+    if variable not in df.columns:
+        return pd.Series([], index=pd.DatetimeIndex([]), dtype=np.float64)
+
+    series = pd.Series(pd.to_numeric(df[variable], errors='coerce').values,
+                       index=pd.to_datetime(df['Date/Time'], errors='coerce'))
+    series = series[series.index.notna()]
+
+    return series[~series.index.duplicated()]
+
+
+#  function to load a variable of many stations in parallel and align the series on one time index, a (times x
+#  stations) frame with nan where a station has no value
+def load_station_values(s3, station_ids, frequency, variable, start_date, end_date):
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(station_ids), STATION_QUERY_WORKERS))) as pool:
+        series = list(pool.map(lambda station_id: station_series(s3, station_id, frequency, variable, start_date, end_date),
+                               station_ids))
+
+    if not series:
+        return pd.DataFrame(columns=station_ids, index=pd.DatetimeIndex([]), dtype=np.float64)
+
+    return pd.concat(series, axis=1, keys=station_ids, sort=True).sort_index()
+
+######################################### INTERPOLATION ################################################################
+
+
+#  function to interpolate station values to locations, values is a (times x stations) frame and distances the matching
+#  (locations x stations) matrix. idw weights every neighbour with a value at a time by 1 / distance ** power, nearest
+#  takes the value of the closest neighbour with a value at that time. returns (times x locations) arrays of the
+#  interpolated values and of the number of stations behind each value
+def interpolate_values(values, distances, method='idw', power=2):
+
+    observed = values.notna().values
+    data = np.where(observed, values.values, 0.0)
+    neighbour = np.isfinite(distances)
+    counts = observed.astype(np.int64).dot(neighbour.T.astype(np.int64))
+
+    if method == 'idw':
+        weights = np.where(neighbour, 1.0 / np.maximum(distances, MIN_DISTANCE_KM) ** power, 0.0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result = data.dot(weights.T) / observed.astype(np.float64).dot(weights.T)
+
+        return np.where(counts > 0, result, np.nan), counts
+
+    #  nearest: stations of each location ordered by distance, the first one observed at each time wins
+    result = np.full(counts.shape, np.nan)
+    rows = np.arange(len(data))
+    for p in range(len(distances)):
+        order = np.argsort(distances[p])[:int(neighbour[p].sum())]
+        if not len(order):
+            continue
+        first = observed[:, order].argmax(axis=1)
+        result[:, p] = np.where(observed[rows, order[first]], data[rows, order[first]], np.nan)
+
+    return result, np.minimum(counts, 1)
+
+
+#  function to find the neighbours of the locations among the stations with data of the frequency in the date range
+def interpolation_neighbours(points, frequency, start_date, end_date, k=4, max_distance_km=None):
+
+    mask = stations.coverage_mask(frequency, start_date.year, end_date.year, full_coverage=False)
+
+    return neighbour_distances(points, k, mask=mask, max_distance_km=max_distance_km)
+
+
+#  function to interpolate a variable to a list of (lat, lon) locations from their neighbours, as returned by
+#  interpolation_neighbours. returns a long table with one row per location and time, the interpolated value in a
+#  column named after the variable and the number of stations behind it in 'Stations'. times without a value are left
+#  out, so the table is empty when no station is within reach
+def interpolate_locations(s3, points, neighbours, frequency, variable, start_date, end_date, method='idw', power=2):
+
+    df_neighbours, distances = neighbours
+    values = load_station_values(s3, df_neighbours.station_id.tolist(), frequency, variable, start_date, end_date)
+    result, counts = interpolate_values(values, distances, method, power)
+
+    n_times = len(values)
+    lats, lons = zip(*points)
+    df_result = pd.DataFrame({'Latitude': np.tile(np.asarray(lats, dtype=np.float64), n_times),
+                              'Longitude': np.tile(np.asarray(lons, dtype=np.float64), n_times),
+                              'Date/Time': np.repeat(values.index.strftime(DATE_FORMATS[frequency]), len(points)),
+                              variable: result.ravel(),
+                              'Stations': counts.ravel()},
+                             columns=['Latitude', 'Longitude', 'Date/Time', variable, 'Stations'])
+
+    return df_result[df_result['Stations'] > 0].reset_index(drop=True)
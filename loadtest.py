@@ -0,0 +1,353 @@
+from gevent import monkey
+monkey.patch_all()
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from http.cookies import SimpleCookie
+
+import gevent
+import numpy as np
+import pandas as pd
+import urllib3
+
+######################################### SETTINGS #####################################################################
+
+#  load test of the deployed web app with many concurrent dash sessions. run it against the procfile processes started
+#  with local stand-ins instead of the production services, e.g.
+#
+#    redis-server --port 6379
+#    minio server /tmp/minio                       (s3 compatible and supports s3 select)
+#    export S3_ENDPOINT_URL=http://localhost:9000 S3_BUCKET=loadtest AWS_ACCESS_KEY_ID=minioadmin
+#    export AWS_SECRET_ACCESS_KEY=minioadmin REDIS_URL=redis://localhost:6379/0 CLOUDAMQP_URL=redis://localhost:6379/1
+#    python loadtest.py seed
+#    gunicorn index:app.server -k gevent --worker-connections 100 -b localhost:8000
+#    celery -A tasks worker -P gevent -Q fast,bulk,prefetch
+#    python loadtest.py run --sessions 50 --duration 120
+#
+#  every session walks through the callbacks a user triggers: filter the map, select a station, generate a download,
+#  poll it until it is done and graph it. latency and throughput are reported per callback
+
+LOADTEST_URL = os.environ.get('LOADTEST_URL', 'http://localhost:8000')
+
+#  the browser polls running downloads and the graph page at this interval (task-refresh-interval)
+POLL_SECONDS = 0.5
+
+#  seconds a session polls a download before it gives up on it
+DOWNLOAD_TIMEOUT = 300
+
+#  seconds between requests of the canary, a single greenlet timing a cheap request while the sessions run. a canary
+#  that is slow under load while the callbacks are not cpu bound points at code blocking the gevent loop of the web
+#  worker, every greenlet on the worker waits for it
+CANARY_SECONDS = 0.25
+
+#  synthetic archive written by the seed command
+SEED_PROVINCES = ['ALBERTA', 'BRITISH COLUMBIA', 'MANITOBA', 'ONTARIO', 'QUEBEC', 'SASKATCHEWAN']
+SEED_VARIABLES = ['Max Temp (°C)', 'Min Temp (°C)', 'Mean Temp (°C)', 'Total Rain (mm)', 'Total Snow (cm)',
+                  'Total Precip (mm)']
+
+######################################### SEED DATA ####################################################################
+
+
+#  function to upload a synthetic station metadata table and daily year partitions of every station to the stand-in
+#  bucket, the files have the column layout of the real archive
+def seed_archive(n_stations, first_year, last_year):
+
+    from connections import get_s3_client
+    import stations
+
+    s3 = get_s3_client()
+    bucket = os.environ['S3_BUCKET']
+    try:
+        s3.create_bucket(Bucket=bucket)
+    except (s3.exceptions.BucketAlreadyExists, s3.exceptions.BucketAlreadyOwnedByYou):
+        pass
+
+    rng = np.random.RandomState(0)
+    metadata = pd.DataFrame({'Station ID': np.arange(1, n_stations + 1),
+                             'Climate ID': ['{:07d}'.format(1000000 + i) for i in range(n_stations)],
+                             'Province': rng.choice(SEED_PROVINCES, n_stations),
+                             'Name': ['LOADTEST STATION {}'.format(i + 1) for i in range(n_stations)],
+                             'Latitude': np.round(rng.uniform(42, 60, n_stations), 2),
+                             'Longitude': np.round(rng.uniform(-130, -60, n_stations), 2),
+                             'Elevation': np.round(rng.uniform(0, 2000, n_stations), 1)})
+    #  the station table holds dates of the first and last record, like the real metadata
+    for column in ('hly', 'dly', 'mly'):
+        metadata['first_year_{}'.format(column)] = '{}-01-01'.format(first_year)
+        metadata['last_year_{}'.format(column)] = '{}-12-31'.format(last_year)
+
+    s3.put_object(Bucket=bucket, Key=stations.DEFAULT_ARCHIVE_KEYS['metadata'], Body=metadata.to_csv().encode('utf-8'))
+
+    for row in metadata.itertuples(index=False):
+        for year in range(first_year, last_year + 1):
+            dates = pd.date_range('{}-01-01'.format(year), '{}-12-31'.format(year), freq='D')
+            df = pd.DataFrame({'Longitude (x)': row.Longitude, 'Latitude (y)': row.Latitude,
+                               'Station Name': row.Name, 'Climate ID': row[1],
+                               'Date/Time': dates.strftime('%Y-%m-%d'), 'Year': dates.year,
+                               'Month': dates.month, 'Day': dates.day, 'Data Quality': ''})
+            for variable in SEED_VARIABLES:
+                df[variable] = np.round(rng.normal(5, 10, len(dates)), 1)
+                df[variable.split(' (')[0] + ' Flag'] = ''
+            s3.put_object(Bucket=bucket, Key=stations.partition_key(row[0], 'Daily', year),
+                          Body=df.to_csv(index=False).encode('utf-8'))
+
+        print('Seeded station {} of {}'.format(row[0], n_stations))
+
+######################################### DASH SESSION #################################################################
+
+
+#  one browser tab: keeps its own cookies and the values of the dash components it has seen, and calls the dash
+#  callbacks the way the dash renderer does
+class DashSession(object):
+
+    def __init__(self, http, callbacks, stats):
+
+        self.http = http
+        self.callbacks = callbacks
+        self.stats = stats
+        self.cookies = SimpleCookie()
+        self.values = {}
+
+    def request(self, method, path, name, body=None):
+
+        headers = {'Cookie': '; '.join('{}={}'.format(k, v.value) for k, v in self.cookies.items())}
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+
+        start = time.time()
+        try:
+            resp = self.http.request(method, LOADTEST_URL + path, headers=headers,
+                                     body=json.dumps(body) if body is not None else None)
+        except urllib3.exceptions.HTTPError:
+            self.stats.record(name, time.time() - start, False)
+            return None
+        self.stats.record(name, time.time() - start, resp.status < 400)
+
+        for cookie in resp.headers.getlist('Set-Cookie'):
+            self.cookies.load(cookie)
+
+        return resp
+
+    #  function to call the callback with output spec, sets the values it returns and returns them as a
+    #  {'id.property': value} dict, None when the request failed or the callback did not update anything
+    def callback(self, output, name, changed, **values):
+
+        self.values.update(values)
+        dependency = self.callbacks[output]
+        body = {'output': dependency['output'],
+                'outputs': [{'id': o.split('.')[0], 'property': o.split('.')[1]} for o in output_ids(dependency)],
+                'inputs': [dict(i, value=self.values.get('{id}.{property}'.format(**i))) for i in dependency['inputs']],
+                'state': [dict(s, value=self.values.get('{id}.{property}'.format(**s))) for s in dependency['state']],
+                'changedPropIds': [changed]}
+        if len(body['outputs']) == 1:
+            body['outputs'] = body['outputs'][0]
+
+        resp = self.request('POST', '/_dash-update-component', name, body)
+        if resp is None or resp.status != 200:
+            return None
+
+        response = json.loads(resp.data.decode('utf-8'))['response']
+        if 'props' in response:
+            response = {dependency['output'].split('.')[0]: response['props']}
+        updated = {'{}.{}'.format(component, prop): value
+                   for component, props in response.items() for prop, value in props.items()}
+        self.values.update(updated)
+
+        return updated
+
+    #  function to run one user visit, every step stops the visit when the app did not answer as a user would expect
+    def visit(self):
+
+        self.values = {}
+        self.request('GET', '/', 'page')
+
+        #  filter: open the home page, load the station tile the browser draws the map from and filter the table by a
+        #  province offered in the layout, the map itself is filtered in the browser
+        page = self.callback('page-content.children', 'display_page', 'url.pathname', **{'url.pathname': '/'})
+        if not page:
+            return
+        provinces = find_component(page['page-content.children'], 'province')['props'].get('options') or [{'value': None}]
+        province = random.choice(provinces)['value']
+        tile = self.request('GET', '/tiles/stations/0/0/0.geojson', 'tile')
+        if tile is None or tile.status != 200:
+            return
+        features = [f for f in json.loads(tile.data.decode('utf-8'))['features']
+                    if province is None or f['properties']['province'] == province]
+        filtered = self.callback(self.callbacks['selected-station'], 'filter', 'province.value',
+                                 **{'province.value': province, 'frequency.value': 'Daily'})
+        if not filtered or not features:
+            return
+
+        #  select: click a station on the map and its first row in the table
+        feature = random.choice(features)
+        click = {'points': [{'lat': feature['geometry']['coordinates'][1], 'lon': feature['geometry']['coordinates'][0],
+                             'text': feature['properties']['station_name']}]}
+        selected = self.callback(self.callbacks['selected-station'], 'select', 'station-map.clickData',
+                                 **{'station-map.clickData': click})
+        if not selected or not selected['selected-station.data']:
+            return
+        station = selected['selected-station.data'][0]
+        self.callback(self.callbacks['download-variables'], 'variables',
+                      'selected-station.selected_rows',
+                      **{'selected-station.selected_rows': [0], 'download-frequency.value': 'Daily'})
+
+        #  generate: a short daily download of the last years of the station
+        last_year = pd.Timestamp(station['last_daily_data'] or 'now').year
+        first_year = max(last_year - random.randint(0, 2), pd.Timestamp(station['first_daily_data'] or 'now').year)
+        started = self.callback(self.callbacks['task-id'], 'generate', 'generate-data-button.n_clicks',
+                                **{'download-year-start.value': first_year, 'download-year-end.value': last_year,
+                                   'download-month-start.value': 1, 'download-month-end.value': 12,
+                                   'generate-data-button.n_clicks': 1, 'message-status.children': 'PROCEED',
+                                   'download-format.value': 'csv', 'download-aggregation-stats.value': ['mean'],
+                                   'task-refresh-interval.n_intervals': 0})
+        if not started or 'task-id.children' not in started:
+            return
+
+        #  poll: the refresh interval fires until the task status is cleared or the download failed
+        deadline = time.time() + DOWNLOAD_TIMEOUT
+        while self.values.get('task-status.children') and time.time() < deadline:
+            gevent.sleep(POLL_SECONDS)
+            if self.values['task-status.children'] == 'FAILURE':
+                return
+            self.callback(self.callbacks['task-id'], 'poll', 'task-refresh-interval.n_intervals',
+                          **{'task-refresh-interval.n_intervals': self.values['task-refresh-interval.n_intervals'] + 1})
+        if self.values.get('task-status.children'):
+            return
+
+        #  graph: open the graph page and plot the first variable of the generated file. a finished download without
+        #  variables to graph is an empty extract, the visit measured neither extraction nor graphing
+        self.callback('page-content.children', 'display_page', 'url.pathname', **{'url.pathname': '/pages/graph_page'})
+        graph = self.callback(self.callbacks['variable-selector'], 'graph_variables', 'variable-name-store.data',
+                              **{'graph-mode.value': 'data', 'graph-refresh-interval.n_intervals': 0})
+        options = (graph or {}).get('variable-selector.options')
+        if not options:
+            raise ValueError('download of station {} {}-{} has no variables to graph'.format(
+                station['station_id'], first_year, last_year))
+        self.callback(self.callbacks['graph-figure-store'], 'graph', 'variable-selector.value',
+                      **{'variable-selector.value': options[0]['value']})
+
+
+#  function to list the output ids of a dash 1.x callback, multi output ids are wrapped in '..' and split by '...'
+def output_ids(dependency):
+
+    output = dependency['output']
+    if output.startswith('..'):
+        return output[2:-2].split('...')
+
+    return [output]
+
+
+#  function to find a component by id in a serialized dash layout
+def find_component(layout, component_id):
+
+    if isinstance(layout, list):
+        for child in layout:
+            found = find_component(child, component_id)
+            if found:
+                return found
+    elif isinstance(layout, dict) and 'props' in layout:
+        if layout['props'].get('id') == component_id:
+            return layout
+        return find_component(layout['props'].get('children'), component_id)
+
+    return None
+
+
+#  function to index the server callbacks of the app by their output spec and by the id of every output component, so
+#  a session can look up e.g. the download callback by 'task-id'. clientside callbacks are skipped, they never reach
+#  the server
+def load_callbacks(http):
+
+    resp = http.request('GET', LOADTEST_URL + '/_dash-dependencies')
+    callbacks = {}
+    for dependency in json.loads(resp.data.decode('utf-8')):
+        if dependency.get('clientside_function'):
+            continue
+        callbacks[dependency['output']] = dependency
+        for output in output_ids(dependency):
+            callbacks.setdefault(output.split('.')[0], dependency['output'])
+
+    return callbacks
+
+######################################### REPORT #######################################################################
+
+
+#  latencies of every request by callback name
+class LoadStats(object):
+
+    def __init__(self):
+
+        self.latencies = {}
+        self.errors = {}
+        self.started = time.time()
+
+    def record(self, name, seconds, ok):
+
+        self.latencies.setdefault(name, []).append(seconds)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self):
+
+        elapsed = time.time() - self.started
+        print('{:<18}{:>8}{:>8}{:>10}{:>10}{:>10}{:>10}'.format('callback', 'count', 'errors', 'p50 ms', 'p99 ms',
+                                                               'max ms', 'req/s'))
+        for name in sorted(self.latencies):
+            latencies = np.array(self.latencies[name]) * 1000
+            print('{:<18}{:>8}{:>8}{:>10.0f}{:>10.0f}{:>10.0f}{:>10.2f}'.format(
+                name, len(latencies), self.errors.get(name, 0), np.percentile(latencies, 50),
+                np.percentile(latencies, 99), latencies.max(), len(latencies) / elapsed))
+
+
+#  function to run the sessions for a number of seconds, each session starts a new visit until the time is up
+def run_load(n_sessions, duration, ramp_up):
+
+    http = urllib3.PoolManager(maxsize=n_sessions + 1, timeout=urllib3.Timeout(connect=10, read=DOWNLOAD_TIMEOUT))
+    callbacks = load_callbacks(http)
+    stats = LoadStats()
+    deadline = time.time() + duration
+
+    def session_loop(index):
+        gevent.sleep(ramp_up * index / float(n_sessions))
+        session = DashSession(http, callbacks, stats)
+        while time.time() < deadline:
+            try:
+                session.visit()
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                stats.record('visit_error', 0, False)
+                print('Session {} visit failed: {!r}'.format(index, e), file=sys.stderr)
+
+    def canary_loop():
+        session = DashSession(http, callbacks, stats)
+        while time.time() < deadline:
+            session.request('GET', '/_dash-layout', 'canary')
+            gevent.sleep(CANARY_SECONDS)
+
+    greenlets = [gevent.spawn(session_loop, i) for i in range(n_sessions)] + [gevent.spawn(canary_loop)]
+    gevent.joinall(greenlets)
+    stats.report()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Load test of the web app with concurrent dash sessions')
+    commands = parser.add_subparsers(dest='command')
+    seed = commands.add_parser('seed', help='upload a synthetic archive to the stand-in bucket')
+    seed.add_argument('--stations', type=int, default=50)
+    seed.add_argument('--first-year', type=int, default=2015)
+    seed.add_argument('--last-year', type=int, default=2019)
+    run = commands.add_parser('run', help='run concurrent sessions against LOADTEST_URL')
+    run.add_argument('--sessions', type=int, default=20)
+    run.add_argument('--duration', type=float, default=60)
+    run.add_argument('--ramp-up', type=float, default=10)
+    args = parser.parse_args()
+
+    if args.command == 'seed':
+        seed_archive(args.stations, args.first_year, args.last_year)
+    elif args.command == 'run':
+        run_load(args.sessions, args.duration, args.ramp_up)
+    else:
+        parser.print_help()
@@ -0,0 +1,166 @@
+import io
+import gzip
+import codecs
+import tempfile
+import pandas as pd
+
+try:
+    import zstandard
+except ImportError:  # zstd output is only offered when the zstandard package is installed
+    zstandard = None
+
+######################################### SETTINGS #####################################################################
+
+#  output files larger than this spill from memory to a temporary file on disk while being written
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+#  supported output formats keyed by the value used in the download format dropdown. compressed csv is served as a
+#  compressed file with no content encoding, a browser that decoded it would save plain csv under the .gz or .zst name
+OUTPUT_FORMATS = {
+    'csv': {'label': 'CSV', 'extension': '.csv', 'content_type': 'text/csv'},
+    'csv.gz': {'label': 'CSV (gzip)', 'extension': '.csv.gz', 'content_type': 'application/gzip'},
+    'csv.zst': {'label': 'CSV (zstd)', 'extension': '.csv.zst', 'content_type': 'application/zstd'},
+    'parquet': {'label': 'Parquet', 'extension': '.parquet', 'content_type': 'application/vnd.apache.parquet'},
+    'feather': {'label': 'Feather', 'extension': '.feather', 'content_type': 'application/vnd.apache.arrow.file'},
+}
+
+DEFAULT_FORMAT = 'csv'
+
+#  formats of the streaming data api, each written one chunk of rows at a time
+STREAM_FORMATS = {
+    'csv': {'extension': '.csv', 'content_type': 'text/csv; charset=utf-8'},
+    'ndjson': {'extension': '.ndjson', 'content_type': 'application/x-ndjson'},
+    'arrow': {'extension': '.arrow', 'content_type': 'application/vnd.apache.arrow.stream'},
+}
+
+#  rows per chunk of a streamed response
+STREAM_CHUNK_ROWS = 10000
+
+######################################### HELPER FUNCTIONS #############################################################
+
+
+#  function to list the formats that can be written with the installed packages
+def available_formats():
+
+    return [fmt for fmt in OUTPUT_FORMATS if fmt != 'csv.zst' or zstandard is not None]
+
+
+#  function to find the output format of a generated file from its extension
+def format_from_filename(filename):
+
+    for fmt in sorted(OUTPUT_FORMATS, key=lambda f: len(OUTPUT_FORMATS[f]['extension']), reverse=True):
+        if filename.endswith(OUTPUT_FORMATS[fmt]['extension']):
+            return fmt
+
+    return DEFAULT_FORMAT
+
+
+#  function to return the s3 object headers that match an output format
+def upload_args(fmt):
+
+    return {'ContentType': OUTPUT_FORMATS[fmt]['content_type']}
+
+
+#  function to return the s3 select input serialization of a format, None if s3 select cannot read it
+def select_input_serialization(fmt):
+
+    if fmt == 'csv':
+        return {'CSV': {'FileHeaderInfo': 'Use'}}
+    elif fmt == 'csv.gz':
+        return {'CSV': {'FileHeaderInfo': 'Use'}, 'CompressionType': 'GZIP'}
+    elif fmt == 'parquet':
+        return {'Parquet': {}}
+    else:
+        return None
+
+
+#  function to write a dataframe in the requested format to a file object ready for upload. csv output is compressed
+#  as it is written so the uncompressed text is never held in memory
+def write_dataframe(df, fmt):
+
+    buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+    if fmt == 'csv':
+        df.to_csv(codecs.getwriter('utf-8')(buffer))
+
+    elif fmt == 'csv.gz':
+        compressed = gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=6)
+        text = io.TextIOWrapper(compressed, encoding='utf-8', newline='')
+        df.to_csv(text)
+        text.close()  # closing writes the gzip trailer but leaves the buffer open
+
+    elif fmt == 'csv.zst':
+        if zstandard is None:
+            raise ValueError('zstandard package is required for csv.zst output')
+        compressed = zstandard.ZstdCompressor(level=3).stream_writer(buffer)
+        text = io.TextIOWrapper(compressed, encoding='utf-8', newline='')
+        df.to_csv(text)
+        text.flush()
+        text.detach()
+        compressed.flush(zstandard.FLUSH_FRAME)  # end the frame without closing the buffer
+
+    elif fmt == 'parquet':
+        df.to_parquet(buffer, compression='snappy')
+
+    elif fmt == 'feather':
+        df.reset_index().to_feather(buffer)  # feather has no index, the first column becomes a column like in csv
+
+    else:
+        raise ValueError('unknown output format {}'.format(fmt))
+
+    buffer.seek(0)
+
+    return buffer
+
+
+#  function to yield a dataframe as encoded chunks of a streaming format. the output only depends on the dataframe so
+#  the same request always produces the same bytes, which lets clients resume it with range requests
+def iter_dataframe(df, fmt, chunk_rows=STREAM_CHUNK_ROWS):
+
+    if fmt == 'csv':
+        yield df.iloc[:0].to_csv(index=False).encode('utf-8')
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start:start + chunk_rows].to_csv(index=False, header=False).encode('utf-8')
+
+    elif fmt == 'ndjson':
+        for start in range(0, len(df), chunk_rows):
+            yield (df.iloc[start:start + chunk_rows].to_json(orient='records', lines=True) + '\n').encode('utf-8')
+
+    elif fmt == 'arrow':
+        import pyarrow as pa
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        sink = io.BytesIO()
+        writer = pa.RecordBatchStreamWriter(sink, table.schema)
+        for batch in table.to_batches(max_chunksize=chunk_rows):
+            writer.write_batch(batch)
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+        writer.close()  # writes the end of stream marker
+        yield sink.getvalue()
+
+    else:
+        raise ValueError('unknown stream format {}'.format(fmt))
+
+
+#  function to parse the csv text returned by an s3 select query of a station archive, run in a cpu pool process by
+#  the workers
+def read_select_records(file_str, col_names):
+
+    return pd.read_csv(io.StringIO(file_str), index_col=None, dtype={'Weather': 'str'}, names=col_names)
+
+
+#  function to read selected columns of a generated file that s3 select cannot query
+def read_dataframe(body, fmt, columns=None):
+
+    if fmt == 'csv.zst':
+        if zstandard is None:
+            raise ValueError('zstandard package is required for csv.zst output')
+        reader = zstandard.ZstdDecompressor().stream_reader(body)
+        return pd.read_csv(io.TextIOWrapper(reader, encoding='utf-8'), usecols=columns)
+    elif fmt == 'feather':
+        return pd.read_feather(io.BytesIO(body.read()), columns=columns)
+    elif fmt == 'parquet':
+        return pd.read_parquet(io.BytesIO(body.read()), columns=columns)
+    else:
+        return pd.read_csv(body, usecols=columns, compression='gzip' if fmt == 'csv.gz' else None)
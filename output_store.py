@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import hashlib
+import stations
+
+from connections import get_redis
+
+######################################### SETTINGS #####################################################################
+
+#  generated files are written under this prefix of the bucket
+OUTPUT_PREFIX = 'tmp/'
+
+#  total size of the generated files kept in the bucket, the least recently used files are deleted beyond it
+OUTPUT_BUDGET_BYTES = int(os.environ.get('OUTPUT_BUDGET_MB', 5 * 1024)) * 1024 * 1024
+
+#  seconds a generated file is handed out again for an identical request instead of generating it again
+OUTPUT_FRESH_SECONDS = int(os.environ.get('OUTPUT_FRESH_SECONDS', 24 * 60 * 60))
+
+#  least recently used files looked at per eviction round
+EVICTION_BATCH = 20
+
+######################################### OUTPUT STORE #################################################################
+
+#  every generated file is a redis hash of its size, creation time, last access, hit count, etag and graph columns. a
+#  sorted set orders the files by last access for eviction and a counter holds their total size. requests map to the
+#  file generated for them through a key that expires when the file is no longer fresh
+
+
+def file_key(filename):
+
+    return 'whc:outputs:file:{}'.format(filename)
+
+
+def request_key(request):
+
+    return 'whc:outputs:request:{}'.format(request)
+
+
+_lru_key = 'whc:outputs:lru'
+_bytes_key = 'whc:outputs:bytes'
+
+
+#  function to return the key of a download request from everything that decides its output, files generated from an
+#  older archive generation are never handed out
+def output_key(*params):
+
+    params = (stations.get_archive_manifest().get('generation', ''),) + params
+
+    return hashlib.md5(json.dumps(params, default=str, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+#  function to record a file uploaded under the output prefix and evict the least recently used files beyond the
+#  budget. request is the output key the file answers, columns the column names the graph page offers for it
+def register(s3, filename, size, request=None, columns=None):
+
+    now = time.time()
+    etag = s3.head_object(Bucket=os.environ['S3_BUCKET'], Key=OUTPUT_PREFIX + filename)['ETag']
+
+    r = get_redis()
+    previous = int(r.hget(file_key(filename), 'size') or 0)  # a regenerated file replaces the one of the same name
+    with r.pipeline() as pipe:
+        pipe.hmset(file_key(filename), {'size': size, 'created': now, 'last_access': now, 'hits': 0, 'etag': etag,
+                                        'columns': json.dumps(columns or {})})
+        pipe.zadd(_lru_key, {filename: now})
+        pipe.incrby(_bytes_key, size - previous)
+        if request:
+            pipe.set(request_key(request), filename, ex=OUTPUT_FRESH_SECONDS)
+        pipe.execute()
+
+    enforce_budget(s3, keep=filename)
+
+
+#  function to record an access of a generated file by the graph page or a download, untracked files are ignored
+def touch(filename):
+
+    r = get_redis()
+    if not r.exists(file_key(filename)):
+        return
+
+    now = time.time()
+    with r.pipeline() as pipe:
+        pipe.hincrby(file_key(filename), 'hits', 1)
+        pipe.hset(file_key(filename), 'last_access', now)
+        pipe.zadd(_lru_key, {filename: now}, xx=True)
+        pipe.execute()
+
+
+#  function to return the etag of a generated file recorded when it was uploaded, None for untracked files
+def etag(filename):
+
+    value = get_redis().hget(file_key(filename), 'etag')
+
+    return None if value is None else value.decode('utf-8')
+
+
+#  function to return (filename, graph columns) of a fresh file generated for a request, None when there is none
+def find_fresh(request):
+
+    r = get_redis()
+    filename = r.get(request_key(request))
+    if filename is None:
+        return None
+
+    filename = filename.decode('utf-8')
+    created, columns = r.hmget(file_key(filename), 'created', 'columns')
+    if created is None or time.time() - float(created) > OUTPUT_FRESH_SECONDS:
+        return None
+
+    return filename, json.loads(columns or '{}')
+
+
+#  function to delete the least recently used files until the generated files fit the budget, keep is never deleted.
+#  removing a file from the sorted set claims it, so workers evicting at the same time never count a file twice
+def enforce_budget(s3, keep=None):
+
+    r = get_redis()
+
+    while int(r.get(_bytes_key) or 0) > OUTPUT_BUDGET_BYTES:
+        excess = int(r.get(_bytes_key) or 0) - OUTPUT_BUDGET_BYTES
+        claimed, freed = [], 0
+        for name in r.zrange(_lru_key, 0, EVICTION_BATCH - 1):
+            filename = name.decode('utf-8')
+            if freed >= excess:
+                break
+            if filename != keep and r.zrem(_lru_key, filename):
+                claimed.append(filename)
+                freed += int(r.hget(file_key(filename), 'size') or 0)
+        if not claimed:
+            break
+
+        s3.delete_objects(Bucket=os.environ['S3_BUCKET'],
+                          Delete={'Objects': [{'Key': OUTPUT_PREFIX + filename} for filename in claimed]})
+
+        with r.pipeline() as pipe:
+            pipe.delete(*[file_key(filename) for filename in claimed])
+            pipe.decrby(_bytes_key, freed)
+            pipe.execute()
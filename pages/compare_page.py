@@ -0,0 +1,280 @@
+import os
+import dash
+import dash_core_components as dcc
+import dash_html_components as html
+import pandas as pd
+import numpy as np
+import stations
+import extraction
+import scheduling
+import aggregation
+
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from dash.dependencies import Input, Output, State
+from app import app
+from connections import get_s3_client
+from pages.graph_page import query_csv_s3
+
+######################################### SETTINGS #####################################################################
+
+#  most stations and generated files compared at once, and the points drawn per trace after decimation
+MAX_SERIES = 8
+MAX_POINTS_PER_TRACE = 4000
+
+#  most station archive rows one compare reads in the web process, and the series loaded at the same time
+COMPARE_MAX_ROWS = int(os.environ.get('COMPARE_MAX_ROWS', scheduling.FAST_LANE_MAX_ROWS))
+COMPARE_WORKERS = 4
+
+#  common variables of each data frequency offered in the variable dropdown
+FREQUENCY_VARIABLES = {
+    'Hourly': ['Temp (°C)', 'Dew Point Temp (°C)', 'Rel Hum (%)', 'Wind Spd (km/h)', 'Stn Press (kPa)', 'Visibility (km)'],
+    'Daily': ['Max Temp (°C)', 'Min Temp (°C)', 'Mean Temp (°C)', 'Total Rain (mm)', 'Total Snow (cm)', 'Total Precip (mm)',
+              'Snow on Grnd (cm)', 'Spd of Max Gust (km/h)'],
+    'Monthly': ['Mean Max Temp (°C)', 'Mean Min Temp (°C)', 'Mean Temp (°C)', 'Extr Max Temp (°C)', 'Extr Min Temp (°C)',
+                'Total Rain (mm)', 'Total Snow (cm)', 'Total Precip (mm)'],
+}
+
+#  pandas resample rules of the common time grid
+RESAMPLE_RULES = {'Source': None, 'Daily': 'D', 'Monthly': 'MS'}
+
+######################################### HELPER FUNCTIONS #############################################################
+
+
+#  accumulated variables are summed when resampled to a coarser grid, everything else is averaged
+def resample_method(variable_name):
+
+    return 'sum' if aggregation.is_accumulated(variable_name) else 'mean'
+
+
+#  function to load one variable of a station or generated file as a time indexed series
+def load_series(s3, entry, frequency, variable_name, start_date, end_date):
+
+    if entry.startswith('WHC_'):
+        name = entry
+        sql_stmt = 'SELECT \"{}\", \"{}\" FROM s3Object'.format('Date/Time', variable_name)
+    else:
+        metadata = stations.get_station_metadata()
+        match = metadata[metadata.station_id.astype(str) == entry]
+        name = '{} ({})'.format(match.station_name.iloc[0], entry) if not match.empty else entry
+
+    #  station archives are narrowed to their populated months and only the variable is selected. a missing file, or a
+    #  generated file without the variable that s3 select rejects, leaves the entry empty instead of failing the compare
+    try:
+        if entry.startswith('WHC_'):
+            df = query_csv_s3(s3, entry, sql_stmt, variable_name)
+        else:
+            df = extraction.extract_station_data(s3, entry, frequency, start_date, end_date, columns=[variable_name])
+    except s3.exceptions.ClientError:
+        return name, pd.Series(dtype=float)
+
+    if variable_name not in df:
+        return name, pd.Series(dtype=float)
+
+    series = pd.Series(pd.to_numeric(df[variable_name], errors='coerce').values,
+                       index=pd.to_datetime(df['Date/Time'], errors='coerce'))
+    series = series[series.index.notna()].sort_index()
+
+    return name, series[start_date:end_date]
+
+
+#  function to align series on a common time grid, each series is resampled with one vectorized pass
+def align_series(series_by_name, rule, variable_name):
+
+    if rule is not None:
+        method = resample_method(variable_name)
+        series_by_name = {name: getattr(series.resample(rule), method)(**({'min_count': 1} if method == 'sum' else {}))
+                          for name, series in series_by_name.items()}
+
+    return pd.concat(series_by_name, axis=1, sort=True)
+
+
+#  function to thin a series to at most max_points while keeping the min and max of every bucket so peaks survive
+def decimate(series, max_points=MAX_POINTS_PER_TRACE):
+
+    series = series.dropna()
+    if len(series) <= max_points:
+        return series
+
+    bucket = int(np.ceil(len(series) / (max_points / 2.0)))
+    n_buckets = len(series) // bucket
+    values = series.values[:n_buckets * bucket].reshape(n_buckets, bucket)
+    offsets = np.arange(n_buckets) * bucket
+
+    keep = np.unique(np.concatenate([offsets + values.argmin(axis=1), offsets + values.argmax(axis=1),
+                                     np.arange(n_buckets * bucket, len(series))]))
+
+    return series.iloc[keep]
+
+
+def comparison_graph(aligned, title, yname):
+    return {'data': [
+            {'x': list(decimated.index.strftime('%Y-%m-%d %H:%M')),
+             'y': list(decimated.values),
+             'name': name,
+             'mode': 'lines'}
+            for name, decimated in ((name, decimate(aligned[name])) for name in aligned.columns)],
+            'layout': {
+                'height': 600,
+                'title': title,
+                'yaxis': {'title': yname},
+                'xaxis': {'title': 'Date'},
+                'legend': {'orientation': 'h'}
+            }
+    }
+
+######################################### LAYOUT #######################################################################
+
+
+app_layout = html.Div(
+    [
+        # header
+        html.Div(
+            [
+                html.Div(
+                    [
+                        html.H3("Weather History Canada"),
+                    ], className='app_header_title',
+                ),
+                html.Div(
+                    [
+                        dcc.Link('Home Page', href='/pages/home_page')
+                    ], className='app_header_link',
+                ),
+            ],
+            className='twelve columns app_header',
+        ),
+        html.Div(
+            [
+                html.Div(
+                    [
+                        html.Div(
+                            [
+                                dcc.Loading(
+                                    id='load-compare-graph',
+                                    children=
+                                    [
+                                        dcc.Graph(
+                                            id='compare-graph',
+                                            figure=comparison_graph(pd.DataFrame(), 'No Data Selected', ''))
+                                    ], type='circle',
+                                ),
+                            ], className='graph_style', style={'height': '600px'},
+                        ),
+                    ],
+                    className='nine columns'
+                ),
+                html.Div(
+                    [
+                        html.Div(
+                            [
+                                html.Label("Station IDs or Generated Files:", className='filter_box_labels'),
+                                dcc.Textarea(
+                                    id='compare-entries',
+                                    placeholder='One station ID or WHC_ file name per line',
+                                    style={'width': '100%', 'height': '10rem'},
+                                ),
+                                html.Label("Data Interval:", className='filter_box_labels'),
+                                dcc.Dropdown(
+                                    id='compare-frequency',
+                                    options=[{'label': frequency, 'value': frequency} for frequency in FREQUENCY_VARIABLES],
+                                    value='Daily',
+                                    clearable=False,
+                                ),
+                                html.Label("Variable to Graph:", className='filter_box_labels'),
+                                dcc.Dropdown(
+                                    id='compare-variable',
+                                    placeholder='Variable To Plot',
+                                ),
+                                html.Label("Common Time Step:", className='filter_box_labels'),
+                                dcc.Dropdown(
+                                    id='compare-resample',
+                                    options=[{'label': rule, 'value': rule} for rule in RESAMPLE_RULES],
+                                    value='Monthly',
+                                    clearable=False,
+                                ),
+                                html.Label("Years:", className='filter_box_labels'),
+                                html.Div(
+                                    [
+                                        dcc.Input(id='compare-year-start', type='number', placeholder='Start Year',
+                                                  value=datetime.now().year - 30),
+                                        dcc.Input(id='compare-year-end', type='number', placeholder='End Year',
+                                                  value=datetime.now().year),
+                                    ], className='flex_container_row',
+                                ),
+                                html.Div(
+                                    [
+                                        html.A(id='compare-button', children='COMPARE')
+                                    ], className='data_buttons', style={'border': '2px blue dashed', 'margin-top': '1rem'},
+                                ),
+                                html.Label(id='compare-message', children=''),
+                            ], className='filter_box_position',
+                        ),
+                    ],
+                    className='three columns',
+                ),
+            ],
+            className='row')
+    ],
+)
+
+######################################### INTERACTION CALLBACKS ########################################################
+
+
+@app.callback(
+    [Output(component_id='compare-variable', component_property='options'),
+     Output(component_id='compare-variable', component_property='value')],
+    [Input(component_id='compare-frequency', component_property='value')]
+)
+def update_compare_variables(frequency):
+
+    variables = FREQUENCY_VARIABLES[frequency]
+
+    return [{'label': variable, 'value': variable} for variable in variables], variables[0]
+
+
+@app.callback(
+    [Output(component_id='compare-graph', component_property='figure'),
+     Output(component_id='compare-message', component_property='children')],
+    [Input(component_id='compare-button', component_property='n_clicks')],
+    [State(component_id='compare-entries', component_property='value'),
+     State(component_id='compare-frequency', component_property='value'),
+     State(component_id='compare-variable', component_property='value'),
+     State(component_id='compare-resample', component_property='value'),
+     State(component_id='compare-year-start', component_property='value'),
+     State(component_id='compare-year-end', component_property='value')]
+)
+def update_compare_graph(n_clicks, entries, frequency, variable_name, resample, start_year, end_year):
+
+    if not n_clicks or not entries or not variable_name or not start_year or not end_year:
+        raise dash.exceptions.PreventUpdate
+
+    entries = [entry.strip() for entry in entries.replace(',', '\n').split('\n') if entry.strip()]
+    if len(entries) > MAX_SERIES:
+        return dash.no_update, 'Compare at most {} stations or files at once'.format(MAX_SERIES)
+
+    start_date = pd.Timestamp(year=int(start_year), month=1, day=1)
+    end_date = pd.Timestamp(year=int(end_year), month=12, day=31, hour=23)
+
+    #  the station archives are read in the web process, so compares estimated above the row budget are rejected before
+    #  any data is read. generated files were already cut to their own download and are not counted
+    n_rows = sum(scheduling.estimate_job_rows(entry, frequency, start_date, end_date)
+                 for entry in entries if not entry.startswith('WHC_'))
+    if n_rows > COMPARE_MAX_ROWS:
+        return dash.no_update, ('About {} station rows needed, a compare reads at most {}, use fewer years, fewer stations '
+                                'or a coarser frequency'.format(n_rows, COMPARE_MAX_ROWS))
+
+    #  load a few series at the same time, each one is a separate s3 select
+    s3 = get_s3_client()
+    with ThreadPoolExecutor(max_workers=COMPARE_WORKERS) as pool:
+        results = list(pool.map(lambda entry: load_series(s3, entry, frequency, variable_name, start_date, end_date), entries))
+
+    series_by_name = {name: series for name, series in results if not series.dropna().empty}
+    missing = [name for name, series in results if series.dropna().empty]
+    if not series_by_name:
+        return dash.no_update, 'No {} data found for the selected stations and years'.format(variable_name)
+
+    aligned = align_series(series_by_name, RESAMPLE_RULES[resample], variable_name)
+    message = 'No data for: {}'.format(', '.join(missing)) if missing else ''
+
+    return comparison_graph(aligned, '{} ({})'.format(variable_name, resample), variable_name), message
@@ -3,24 +3,38 @@ import dash_core_components as dcc
 import dash_html_components as html
 import pandas as pd
 import os
-import boto3
 import io
-import plotly.graph_objs as go
-
-from dash.dependencies import Input, Output
+import output_formats
+import climatology
+import aggregation
+import session_state
+import figure_encoding
+import output_store
+
+from dash.dependencies import Input, Output, State, ClientsideFunction
 from app import app
+from caching import cache
+from connections import get_s3_client
 
 ######################################### HELPER FUNCTIONS #############################################################
 
 def query_csv_s3(s3, filename, sql_stmt, variable_name):
 
+    #  generated files that s3 select cannot read (zstd csv and feather) are downloaded and read directly
+    output_format = output_formats.format_from_filename(filename)
+    input_serialization = output_formats.select_input_serialization(output_format)
+
+    if input_serialization is None:
+        obj = s3.get_object(Bucket=os.environ['S3_BUCKET'], Key='tmp/' + filename)
+        return output_formats.read_dataframe(obj['Body'], output_format, columns=['Date/Time', variable_name])
+
     #  request object data from S3 bucket
     req = s3.select_object_content(
         Bucket=os.environ['S3_BUCKET'],
         Key='tmp/' + filename,
         ExpressionType='SQL',
         Expression=sql_stmt,
-        InputSerialization={'CSV': {"FileHeaderInfo": "Use"}},
+        InputSerialization=input_serialization,
         OutputSerialization={'CSV': {}},
     )
 
@@ -55,32 +69,94 @@ def timeseries_graph(x, y, title, yname, xname):
 
 
 def boxplot_graph(x, y, title, yname, xname):
-    data = go.Box(
-        y=y,
-        x=x
-    )
-    layout = go.Layout(
-        title={'text': title, 'x': 0.5},
-        yaxis={'title': yname},
-        xaxis={'title': xname},
-        height=400
-    )
-    return go.Figure(data=data, layout=layout)
+    return {'data': [
+            {'type': 'box',
+             'y': y,
+             'x': x
+             }],
+            'layout': {
+                'height': 400,
+                'title': {'text': title, 'x': 0.5},
+                'yaxis': {'title': yname},
+                'xaxis': {'title': xname}
+            }
+    }
 
 
 def histogram_graph(x, title, xname):
-    data = go.Histogram(
-        x=x,
-        histnorm='percent',
-        nbinsx=30
-    )
-    layout = go.Layout(
-        title={'text': title, 'x': 0.5},
-        yaxis={'title': 'Percent (%)'},
-        xaxis={'title': xname},
-        height=500
-    )
-    return go.Figure(data=data, layout=layout)
+    return {'data': [
+            {'type': 'histogram',
+             'x': x,
+             'histnorm': 'percent',
+             'nbinsx': 30
+             }],
+            'layout': {
+                'height': 500,
+                'title': {'text': title, 'x': 0.5},
+                'yaxis': {'title': 'Percent (%)'},
+                'xaxis': {'title': xname}
+            }
+    }
+
+
+MONTH_NAMES = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+#  climatology figures are drawn from the precomputed monthly tables of climatology.py
+def climatology_range_graph(table, title, yname):
+    months = [MONTH_NAMES[m - 1] for m in table['month']]
+    return {'data': [
+            {'x': months, 'y': list(table['max']), 'name': 'Max', 'mode': 'lines', 'line': {'color': 'red'}},
+            {'x': months, 'y': list(table['mean']), 'name': 'Mean', 'mode': 'lines+markers', 'line': {'color': 'black'}},
+            {'x': months, 'y': list(table['min']), 'name': 'Min', 'mode': 'lines', 'line': {'color': 'blue'}},
+            ],
+            'layout': {
+                'height': 300,
+                'title': title,
+                'yaxis': {'title': yname},
+                'xaxis': {'title': 'Month'}
+            }
+    }
+
+
+#  monthly totals are only meaningful for accumulated variables, the others get an empty figure with a note
+def climatology_totals_graph(table, title, yname):
+    if not aggregation.is_accumulated(yname):
+        return {'data': [],
+                'layout': {
+                    'height': 400,
+                    'title': {'text': title, 'x': 0.5},
+                    'annotations': [{'text': 'Monthly totals are drawn for precipitation, snow and degree days only',
+                                     'showarrow': False, 'xref': 'paper', 'yref': 'paper', 'x': 0.5, 'y': 0.5}],
+                    'xaxis': {'visible': False},
+                    'yaxis': {'visible': False}
+                }
+        }
+    return {'data': [
+            {'type': 'bar',
+             'x': [MONTH_NAMES[m - 1] for m in table['month']],
+             'y': list(table['monthly_total'])
+             }],
+            'layout': {
+                'height': 400,
+                'title': {'text': title, 'x': 0.5},
+                'yaxis': {'title': 'Monthly Total of ' + yname},
+                'xaxis': {'title': 'Month'}
+            }
+    }
+
+
+def climatology_percentile_graph(table, title, xname):
+    months = [MONTH_NAMES[m - 1] for m in table['month']]
+    return {'data': [
+            {'x': list(table[p]), 'y': months, 'name': p.upper(), 'mode': 'lines+markers'} for p in ['p05', 'p50', 'p95']],
+            'layout': {
+                'height': 500,
+                'title': {'text': title, 'x': 0.5},
+                'yaxis': {'title': 'Month', 'autorange': 'reversed'},
+                'xaxis': {'title': xname}
+            }
+    }
 
 ######################################### LAYOUT #######################################################################
 
@@ -93,6 +169,12 @@ app_layout = html.Div(
             interval=500,  # in milliseconds
             n_intervals=0
         ),
+        # figures of the graphs, possibly with encoded arrays, decoded in the browser
+        dcc.Store(
+            id='graph-figure-store',
+            data=[timeseries_graph([], [], 'No Data Selected', '', ''), boxplot_graph([], [], 'No Data Selected', '', ''),
+                  histogram_graph([], 'No Data Selected', '')]
+        ),
         # header
         html.Div(
             [
@@ -103,6 +185,7 @@ app_layout = html.Div(
                 ),
                 html.Div(
                     [
+                        dcc.Link('Compare Stations', href='/pages/compare_page', style={'margin-right': '2rem'}),
                         dcc.Link('Home Page', href='/pages/home_page')
                     ], className='app_header_link',
                 ),
@@ -149,6 +232,14 @@ app_layout = html.Div(
                         # dropdown data selector
                         html.Div(
                             [
+                                html.Label("Graph:", className='filter_box_labels'),
+                                dcc.RadioItems(
+                                    id='graph-mode',
+                                    options=[{'label': 'Generated Data', 'value': 'data'},
+                                             {'label': 'Station Climatology', 'value': 'climatology'}],
+                                    value='data',
+                                    labelStyle={'display': 'inline-block', 'margin-right': '1rem'},
+                                ),
                                 html.Label("Variable to Graph:", className='filter_box_labels'),
                                 dcc.Dropdown(
                                     id='variable-selector',
@@ -185,32 +276,70 @@ app_layout = html.Div(
     [Output(component_id='graph-refresh-interval', component_property='interval'),
      Output(component_id='variable-selector', component_property='options')],
     [Input(component_id='variable-name-store', component_property='data'),
-     Input(component_id='graph-refresh-interval', component_property='n_intervals')]
+     Input(component_id='graph-refresh-interval', component_property='n_intervals'),
+     Input(component_id='graph-mode', component_property='value'),
+     Input(component_id='station-metadata-store', component_property='data')],
+    [State(component_id='state-token', component_property='data')]
 )
-def update_interval_time(variable_names, n_int):
+def update_interval_time(variable_task_id, n_int, graph_mode, station_metadata, token):
 
-    variable_dropdown = [{'label': variable, 'value': variable} for variable in list(variable_names.keys())[1:]]
+    #  climatology variables come from the station's precomputed table instead of the generated file
+    if graph_mode == 'climatology' and station_metadata and len(station_metadata) > 3:
+        variables = climatology.climatology_variables(list(station_metadata.keys())[3])
+    else:
+        #  column names of the last generated file, kept in the tab's server side state by the download callback
+        variable_names = session_state.load(token, 'variables', {})
+        variables = list(variable_names.keys())[1:]
+
+    variable_dropdown = [{'label': variable, 'value': variable} for variable in variables]
     interval = 24*60*60*1*1000  # in milliseconds
 
     return interval, variable_dropdown
 
 
 @app.callback(
-    [Output(component_id='timeseries-graph', component_property='figure'),
-     Output(component_id='boxplot-graph', component_property='figure'),
-     Output(component_id='histogram-graph', component_property='figure')],
+    Output(component_id='graph-figure-store', component_property='data'),
     [Input(component_id='filename-store', component_property='data'),
      Input(component_id='station-metadata-store', component_property='data'),
      Input(component_id='variable-selector', component_property='value'),
-     Input(component_id='graph-refresh-interval', component_property='n_intervals')]
+     Input(component_id='graph-refresh-interval', component_property='n_intervals'),
+     Input(component_id='graph-mode', component_property='value')]
 )
-def update_data_graph(filename, station_metadata, variable_name, n_int):
+def update_data_graph(filename, station_metadata, variable_name, n_int, graph_mode):
 
     if variable_name is None:
         raise dash.exceptions.PreventUpdate
 
-    s3 = boto3.client('s3', region_name='us-east-1', aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-                        aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'])
+    if graph_mode == 'climatology':
+        return list(update_climatology_graph(station_metadata, variable_name))
+
+    # define metadata
+    station_metadata = list(station_metadata.keys())
+    title = '{}: {}N, {}W'.format(station_metadata[2], station_metadata[0], station_metadata[1])
+
+    #  the etag of the generated file keys the cached figures, a regenerated file with the same name is drawn again. the
+    #  output store recorded it at upload, files it does not track are asked from s3
+    output_store.touch(filename)
+    etag = output_store.etag(filename) or \
+        get_s3_client().head_object(Bucket=os.environ['S3_BUCKET'], Key=output_store.OUTPUT_PREFIX + filename)['ETag']
+
+    return list(data_graph_figures(filename, etag, variable_name, title))
+
+# graph figures decoded from the figure store, runs in the browser (assets/clientside.js)
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='decode_figures'),
+    [Output(component_id='timeseries-graph', component_property='figure'),
+     Output(component_id='boxplot-graph', component_property='figure'),
+     Output(component_id='histogram-graph', component_property='figure')],
+    [Input(component_id='graph-figure-store', component_property='data')]
+)
+
+
+#  function to build the three figures of a variable of a generated file, memoized per file and variable
+@cache.memoize()
+def data_graph_figures(filename, etag, variable_name, title):
+
+    s3 = get_s3_client()
 
     #  sql statement to select date and chosen variable
     sql_stmt = 'SELECT \"{}\", \"{}\" FROM s3Object'.format('Date/Time', variable_name)
@@ -230,19 +359,55 @@ def update_data_graph(filename, station_metadata, variable_name, n_int):
     #  boxplot months
     boxplot_months = pd.to_datetime(df_box['Date/Time']).dt.strftime('%b')
 
-    # define metadata
-    station_metadata = list(station_metadata.keys())
-
-    #  assign data to graphs
-    figure1 = timeseries_graph(df['Date/Time'],
+    #  assign data to graphs, the arrays are encoded compactly (figure_encoding.py) and decoded in the browser
+    figure1 = timeseries_graph(pd.to_datetime(df['Date/Time'], errors='coerce'),
                                df[variable_name],
-                               '{}: {}N, {}W'.format(station_metadata[2], station_metadata[0], station_metadata[1]), variable_name, 'Date')
+                               title, variable_name, 'Date')
 
     figure2 = boxplot_graph(list(boxplot_months),
                             list(df_box[variable_name]),
-                            '{}: {}N, {}W'.format(station_metadata[2], station_metadata[0], station_metadata[1]), variable_name, 'Month')
+                            title, variable_name, 'Month')
 
     figure3 = histogram_graph(df[variable_name],
-                              '{}: {}N, {}W'.format(station_metadata[2], station_metadata[0], station_metadata[1]), variable_name)
+                              title, variable_name)
+
+    return figure_encoding.encode_figure(figure1), figure_encoding.encode_figure(figure2), \
+        figure_encoding.encode_figure(figure3)
+
+
+#  climatology mode draws the monthly normals and extremes of a station without touching its raw data
+def update_climatology_graph(station_metadata, variable_name):
+
+    station_metadata = list(station_metadata.keys())
+    if len(station_metadata) < 4:
+        raise dash.exceptions.PreventUpdate
+
+    #  the etag of the station's table keys the cached figures, a rebuilt table is drawn again
+    etag = climatology.station_climatology(station_metadata[3])[0]
+    if etag is None:
+        raise dash.exceptions.PreventUpdate
+
+    figures = climatology_figures(station_metadata[3], variable_name,
+                                  '{}: {}N, {}W'.format(station_metadata[2], station_metadata[0], station_metadata[1]), etag)
+    if figures is None:
+        raise dash.exceptions.PreventUpdate
+
+    return figures
+
+
+#  function to build the climatology figures of a station variable, None if the station has no table for it. etag is
+#  the etag of the table the figures are drawn from
+@cache.memoize()
+def climatology_figures(station_id, variable_name, title, etag):
+
+    table = climatology.get_station_climatology(station_id)
+    if table is None or variable_name not in set(table['variable']):
+        return None
+
+    table = table[table['variable'] == variable_name].sort_values('month')
+
+    figure1 = climatology_range_graph(table, title, variable_name)
+    figure2 = climatology_totals_graph(table, title, variable_name)
+    figure3 = climatology_percentile_graph(table, title, variable_name)
 
     return figure1, figure2, figure3
@@ -5,17 +5,26 @@ import dash_html_components as html
 import pandas as pd
 import numpy as np
 import os
-import tasks
-import boto3
+import output_formats
+import extraction
+import aggregation
+import stations
+import availability
+import scheduling
+import session_state
+import event_search
+import prefetch
+import output_store
 import base64
 import time
+import uuid
 
-from datetime import datetime, timedelta
-from celery.result import AsyncResult
+from datetime import datetime
 from flask import redirect
-from tasks import celery_app
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
 from app import app
+from caching import cache
+from connections import get_s3_client
 
 ######################################### HELPER FUNCTIONS #############################################################
 
@@ -32,34 +41,22 @@ def compute_great_circle_distance(lat_user, lon_user, lat_station, lon_station):
     return earth_radius_km * 2 * np.arcsin(np.sqrt(a))
 
 
-#  this function downloads a file from s3
-def download_csv_s3(s3, filepath, bucket):
+#  celery is imported by the first download callback rather than when the web server starts
+def get_task_result(task_id):
 
-    obj = s3.get_object(Bucket=bucket, Key=filepath)
-    df = pd.read_csv(obj['Body'], index_col=0)
+    from celery.result import AsyncResult
+    from tasks import celery_app
 
-    return df
+    return AsyncResult(id=task_id, app=celery_app)
 
 ######################################### DATA INPUTS AND LINKS ########################################################
 
 
-#  setup s3 client to bucket that stores user download data
-s3 = boto3.client('s3', region_name='us-east-1', aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-                  aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'])
+#  loading spinner as a base64 data url, read when the layout is first built
+def spinner_image():
 
-#  create dataframe from weather station metadata
-df = download_csv_s3(s3, 'env-can-wx-station-metadata.csv', os.environ['S3_BUCKET'])
-
-#  convert times to datetime format
-df[['first_year_hly', 'last_year_hly', 'first_year_dly', 'last_year_dly', 'first_year_mly', 'last_year_mly']] = \
-    df[['first_year_hly', 'last_year_hly', 'first_year_dly', 'last_year_dly', 'first_year_mly', 'last_year_mly']].apply(pd.to_datetime, errors='coerce')
-
-#  rename columns
-df.columns = ['station_id', 'climate_id', 'province', 'station_name', 'latitude', 'longitude', 'elevation',
-              'first_hourly_data', 'last_hourly_data', 'first_daily_data', 'last_daily_data', 'first_monthly_data', 'last_monthly_data']
-
-#  preload loading spinner to base64 encode
-spinner = base64.b64encode(open(os.path.join('assets', 'spinner.gif'), 'rb').read())
+    with open(os.path.join('assets', 'spinner.gif'), 'rb') as f:
+        return 'data:image/gif;base64,{}'.format(base64.b64encode(f.read()).decode())
 
 ######################################### PLOTS ########################################################################
 
@@ -102,312 +99,433 @@ def station_map(stations, lat_selected, lon_selected, name_selected, color):
 ######################################### LAYOUT #######################################################################
 
 
-app_layout = html.Div(
-    [
-        #  hidden div to store celery background job task-idtask-status, and message-status
-        html.Div(id='task-id',
-                 children=None,
-                 style={'display': 'none'}
-                 ),
-        #  hidden div to store celery background job task-status
-        html.Div(id='task-status',
-                 children=None,
-                 style={'display': 'none'}
-                 ),
-        #  hidden div to store status of download message
-        html.Div(id='message-status',
-                 children=None,
-                 style={'display': 'none'}
-                 ),
-        #  hidden div to store trigger to force table update, this is a "workaround" since Dash Datatable will not
-        #  update on row_select
-        html.Div(id='false-trigger',
-                 children=None,
-                 style={'display': 'none'}
-                 ),
-        #  page refresh interval
-        dcc.Interval(
-            id='task-refresh-interval',
-            interval=24*60*60*1*1000,  # in milliseconds
-            n_intervals=0
-        ),
-
-        #  header
-        html.Div(
-            [
-                html.Div(
-                    [
-                        html.H3("Weather History Canada"),
-                    ], className='app_header_title',
-                ),
-                html.Div(
-                    [
-                        dcc.Link('About', href='/pages/about')
-                    ], className='app_header_link',
-                ),
-            ],
-            className='twelve columns app_header',
-        ),
-        html.Div(
-            [
-                html.Div(
-                    [
-                        #  weather station map
-                        html.Div(
-                            [
-                                dcc.Graph(id='station-map',
-                                          figure=station_map(df, [], [], [], 'blue'))
-                            ], className='graph_style', style={'height': '450px'},
-                        ),
-                        #  Dash datatable container
-                        html.Div(
-                            [
-                                html.H6('Click on station in map and select in table below prior to generating data', className='filter_box_labels'),
-                                dash_table.DataTable(
-                                    id='selected-station',
-                                    columns=[{"name": col, "id": col} for col in df.columns],
-                                    data=[],
-                                    style_table={'overflowX': 'scroll'},
-                                    style_header={'border': '1px solid black', 'backgroundColor': 'rgb(200, 200, 200)'},
-                                    style_cell={'border': '1px solid grey'},
-                                    row_selectable='single',
-                                ),
-                                html.Label('(Multiple stations at the same location may exist)', className='table_subtitle'),
-                            ], style={'margin-top': '1rem'},
-                        ),
-                    ],
-                    className='seven columns',
-                ),
-                html.Div(
-                    [
-                        html.Div(
-                            [
-                                #  station name input
-                                html.Label("Station Name:", className='filter_box_labels'),
-                                html.Div(
-                                    [
-                                        dcc.Input(
-                                            id='station-name',
-                                            value='', type='text',
-                                            placeholder='Enter Station Name',
-                                            className='station_name'),
-                                    ],
-                                ),
-                                #  province input
-                                html.Label("Province:", className='filter_box_labels'),
-                                html.Div(
-                                    [
-                                        dcc.Dropdown(
-                                            id='province',
-                                            options=[{'label': province, 'value': province} for province in df.province.unique()],
-                                            style={'width': '90%'}),
-                                    ], className='flex_container_row',
-                                ),
-                                #  data interval input
-                                html.Label("Data Interval:", className='filter_box_labels'),
-                                html.Div(
-                                    [
-                                        dcc.Dropdown(
-                                            id='frequency',
-                                            options=[{'label': frequency, 'value': frequency} for frequency in ['Hourly', 'Daily', 'Monthly']],
-                                            style={'width': '90%'}),
-                                    ], className='flex_container_row',
-                                ),
-                                #  date available input
-                                html.Label("Data Available Between:", className='filter_box_labels'),
-                                html.Div(
-                                    [
-                                        html.Div(
-                                            [
-                                                dcc.Dropdown(
-                                                    id='first-year',
-                                                    options=[{'label': str(year), 'value': str(year)} for year in range(1840, datetime.now().year + 1, 1)],
-                                                    placeholder='First Year'),
-                                            ], style={'width': '40%'},
-                                        ),
-                                        html.Div(
-                                            [
-                                                dcc.Dropdown(
-                                                    id='last-year',
-                                                    options=[{'label': str(year), 'value': str(year)} for year in range(1840, datetime.now().year + 1, 1)],
-                                                    placeholder='Last Year'),
-                                            ], style={'width': '40%'},
-                                        ),
-                                    ], className='flex_container_row',
-                                ),
-                                #  distance and location input
-                                html.Label("Distance Filter:", className='filter_box_labels'),
-                                html.Div(
-                                    [
-                                        html.Div(
-                                            [
-                                                dcc.Input(
-                                                    id='latitude',
-                                                    value='', type='text',
-                                                    placeholder='Latitude')
-                                            ],
-                                        ),
-                                        html.Div(
-                                            [
-                                                dcc.Input(
-                                                    id='longitude',
-                                                    value='',
-                                                    type='text',
-                                                    placeholder='Longitude')
-                                            ],
-                                        ),
-                                        html.Div(
-                                            [
-                                                dcc.Dropdown(
-                                                    id='radius',
-                                                    options=[{'label': radius, 'value': radius} for radius in ['10', '25', '50', '100']],
-                                                    placeholder='Kilometers From Location')
-                                            ], style={'width': '20%'},
-                                        ),
-                                    ], className='flex_container_row',
-                                ),
-                            ], className='filter_box_position',
-                        ),
-                        html.Div(
-                            [
-                                #  download dates and message
-                                html.Div(
-                                    [
-                                        html.Label('Download Dates:', className='filter_box_labels'),
-                                        html.Div(
-                                            [
-                                                html.Div(
-                                                    [
-                                                        dcc.Dropdown(
-                                                            id='download-year-start',
-                                                            options=[{'label': year, 'value': year} for year in ['Select A Station']],
-                                                            placeholder='Start Year')
-                                                    ], style={'width': '40%'},
-                                                ),
-                                                html.Div(
-                                                    [
-                                                        dcc.Dropdown(
-                                                            id='download-month-start',
-                                                            options=[{'label': month, 'value': month} for month in ['Select A Station']],
-                                                            placeholder='Start Month')
-                                                    ], style={'width': '40%'},
-                                                ),
-                                            ], className='flex_container_row', style={'margin-bottom': '1rem'},
-                                        ),
-                                        html.Div(
-                                            [
-                                                html.Div(
-                                                    [
-                                                        dcc.Dropdown(
-                                                            id='download-year-end',
-                                                            options=[{'label': year, 'value': year} for year in ['Select A Station']],
-                                                            placeholder='End Year')
-                                                    ], style={'width': '40%'},
-                                                ),
-                                                html.Div(
-                                                    [
-                                                        dcc.Dropdown(
-                                                            id='download-month-end',
-                                                            options=[{'label': month, 'value': month} for month in ['Select A Station']],
-                                                            placeholder='End Month')
-                                                    ], style={'width': '40%'},
-                                                ),
-                                            ], className='flex_container_row',
-                                        ),
-                                        html.Div(
-                                            [
-                                                html.Label(id='download-message', children='')
-                                            ], style={'width': '82%', 'margin-left': '0.5rem'},
-                                        ),
-                                    ], style={'width': '55%'},
-                                ),
-                                html.Div(
-                                    [
-                                        #  download interval and buttons
-                                        html.Label('Download Interval:', className='filter_box_labels', style={'margin-left': '3rem'}),
-                                        html.Div(
-                                            [
-                                                html.Div(
-                                                    [
-                                                        dcc.Dropdown(
-                                                            id='download-frequency',
-                                                            options=[{'label': frequency, 'value': frequency} for frequency in ['Select A Station']],
-                                                            placeholder='Frequency')
-                                                    ], style={'width': '85%'},
-                                                ),
-                                                html.Div(
-                                                    [
-                                                        html.A(id='generate-data-button', children='1. GENERATE DATA')
-                                                    ], className='data_buttons', style={'border': '2px red dashed','width': '85%'},
-                                                ),
-                                                html.Div(
-                                                    id='toggle-button-vis',
-                                                    children=
-                                                    [
-                                                        html.Div(
-                                                            [
-                                                                html.A(id='download-data-button', children='2. DOWNLOAD DATA')
-                                                            ], className='data_buttons', style={'border': '2px green dashed'},
-                                                        ),
-                                                        html.Div(
-                                                            [
-                                                                html.A('3. GRAPH DATA', id='graph-data-button', href="/pages/graph_page")
-                                                            ], className='data_buttons', style={'border': '2px blue dashed','margin-top': '1.5rem'},
-                                                        ),
-                                                    ], style={'display': 'none', 'width': '85%'},
-                                                ),
-                                                html.Div(
-                                                    id='spinner',
-                                                    children=
-                                                    [
-                                                        html.Img(src='data:image/gif;base64,{}'.format(spinner.decode())),
-                                                        html.Label(
-                                                            id='spinner-label',
-                                                            children='Download Progress: Pending....',
-                                                            style={'font-weight': 'bold', 'font-size': '16px'}),
-                                                    ], style={'display': 'none'},
-                                                ),
-                                            ], className='flex_container_column',
-                                        ),
-
-                                    ], style={'width': '40%'},
-                                ),
-                            ], className='download_box_position',
-                        ),
-                    ],
-                    className='five columns',
-                ),
-            ],
-            className='row',
-        ),
-    ],
-)
-
-
-######################################### INTERACTION CALLBACKS ########################################################
+#  the layout needs the station metadata from s3, so it is built on the first page view instead of at import and new
+#  gunicorn workers start serving straight away
+app_layout = None
+
+
+def serve_layout():
+
+    global app_layout
+
+    if app_layout is None:
+        app_layout = build_layout()
+
+    return app_layout
+
+
+def build_layout():
+
+    #  dataframe of weather station metadata, cached per process by stations.py
+    df = stations.get_station_metadata()
+
+    return html.Div(
+        [
+            #  hidden div to store celery background job task-idtask-status, and message-status
+            html.Div(id='task-id',
+                     children=None,
+                     style={'display': 'none'}
+                     ),
+            #  hidden div to store celery background job task-status
+            html.Div(id='task-status',
+                     children=None,
+                     style={'display': 'none'}
+                     ),
+            #  hidden div to store status of download message
+            html.Div(id='message-status',
+                     children=None,
+                     style={'display': 'none'}
+                     ),
+            #  hidden div to store trigger to force table update, this is a "workaround" since Dash Datatable will not
+            #  update on row_select
+            html.Div(id='false-trigger',
+                     children=None,
+                     style={'display': 'none'}
+                     ),
+            #  populated years of each station in the selected station table from the availability index
+            dcc.Store(id='station-availability-store', data={}),
+            #  the station map is drawn in the browser from the station tiles (assets/clientside.js), these hold the map
+            #  layout and the ids of the stations passing the nearest station filter, which needs the whole station table
+            dcc.Store(id='station-map-layout', data=station_map(df.iloc[:0], [], [], [], 'blue')['layout']),
+            dcc.Store(id='nearest-stations-store', data=None),
+            #  page refresh interval
+            dcc.Interval(
+                id='task-refresh-interval',
+                interval=24*60*60*1*1000,  # in milliseconds
+                n_intervals=0
+            ),
+            #  station frequencies the last selection queued a prefetch for
+            dcc.Store(id='prefetch-store', data=[]),
+            #  id and result filename of the running extreme event search and its refresh interval
+            dcc.Store(id='search-task', data=None),
+            dcc.Interval(
+                id='search-refresh-interval',
+                interval=24*60*60*1*1000,  # in milliseconds
+                n_intervals=0
+            ),
+
+            #  header
+            html.Div(
+                [
+                    html.Div(
+                        [
+                            html.H3("Weather History Canada"),
+                        ], className='app_header_title',
+                    ),
+                    html.Div(
+                        [
+                            dcc.Link('About', href='/pages/about')
+                        ], className='app_header_link',
+                    ),
+                ],
+                className='twelve columns app_header',
+            ),
+            html.Div(
+                [
+                    html.Div(
+                        [
+                            #  weather station map
+                            html.Div(
+                                [
+                                    dcc.Graph(id='station-map',
+                                              figure=station_map(df.iloc[:0], [], [], [], 'blue'))
+                                ], className='graph_style', style={'height': '450px'},
+                            ),
+                            #  Dash datatable container
+                            html.Div(
+                                [
+                                    html.H6('Click on station in map and select in table below prior to generating data', className='filter_box_labels'),
+                                    dash_table.DataTable(
+                                        id='selected-station',
+                                        columns=[{"name": col, "id": col} for col in df.columns],
+                                        data=[],
+                                        style_table={'overflowX': 'scroll'},
+                                        style_header={'border': '1px solid black', 'backgroundColor': 'rgb(200, 200, 200)'},
+                                        style_cell={'border': '1px solid grey'},
+                                        row_selectable='single',
+                                    ),
+                                    html.Label('(Multiple stations at the same location may exist)', className='table_subtitle'),
+                                ], style={'margin-top': '1rem'},
+                            ),
+                        ],
+                        className='seven columns',
+                    ),
+                    html.Div(
+                        [
+                            html.Div(
+                                [
+                                    #  station name input
+                                    html.Label("Station Name:", className='filter_box_labels'),
+                                    html.Div(
+                                        [
+                                            dcc.Input(
+                                                id='station-name',
+                                                value='', type='text',
+                                                placeholder='Enter Station Name',
+                                                className='station_name'),
+                                        ],
+                                    ),
+                                    #  province input
+                                    html.Label("Province:", className='filter_box_labels'),
+                                    html.Div(
+                                        [
+                                            dcc.Dropdown(
+                                                id='province',
+                                                options=[{'label': province, 'value': province} for province in df.province.unique()],
+                                                style={'width': '90%'}),
+                                        ], className='flex_container_row',
+                                    ),
+                                    #  data interval input
+                                    html.Label("Data Interval:", className='filter_box_labels'),
+                                    html.Div(
+                                        [
+                                            dcc.Dropdown(
+                                                id='frequency',
+                                                options=[{'label': frequency, 'value': frequency} for frequency in ['Hourly', 'Daily', 'Monthly']],
+                                                style={'width': '90%'}),
+                                        ], className='flex_container_row',
+                                    ),
+                                    #  date available input
+                                    html.Label("Data Available Between:", className='filter_box_labels'),
+                                    html.Div(
+                                        [
+                                            html.Div(
+                                                [
+                                                    dcc.Dropdown(
+                                                        id='first-year',
+                                                        options=[{'label': str(year), 'value': str(year)} for year in range(1840, datetime.now().year + 1, 1)],
+                                                        placeholder='First Year'),
+                                                ], style={'width': '40%'},
+                                            ),
+                                            html.Div(
+                                                [
+                                                    dcc.Dropdown(
+                                                        id='last-year',
+                                                        options=[{'label': str(year), 'value': str(year)} for year in range(1840, datetime.now().year + 1, 1)],
+                                                        placeholder='Last Year'),
+                                                ], style={'width': '40%'},
+                                            ),
+                                        ], className='flex_container_row',
+                                    ),
+                                    #  distance and location input
+                                    html.Label("Distance Filter:", className='filter_box_labels'),
+                                    html.Div(
+                                        [
+                                            html.Div(
+                                                [
+                                                    dcc.Input(
+                                                        id='latitude',
+                                                        value='', type='text',
+                                                        placeholder='Latitude')
+                                                ],
+                                            ),
+                                            html.Div(
+                                                [
+                                                    dcc.Input(
+                                                        id='longitude',
+                                                        value='',
+                                                        type='text',
+                                                        placeholder='Longitude')
+                                                ],
+                                            ),
+                                            html.Div(
+                                                [
+                                                    dcc.Dropdown(
+                                                        id='radius',
+                                                        options=[{'label': radius, 'value': radius} for radius in ['10', '25', '50', '100']],
+                                                        placeholder='Kilometers From Location')
+                                                ], style={'width': '20%'},
+                                            ),
+                                            html.Div(
+                                                [
+                                                    dcc.Dropdown(
+                                                        id='nearest-count',
+                                                        options=[{'label': 'Nearest {}'.format(k), 'value': k} for k in [1, 5, 10, 25]],
+                                                        placeholder='Nearest Stations')
+                                                ], style={'width': '20%'},
+                                            ),
+                                        ], className='flex_container_row',
+                                    ),
+                                    #  extreme event search over the stations of the province, data interval and years above
+                                    html.Label("Extreme Event Search:", className='filter_box_labels'),
+                                    html.Div(
+                                        [
+                                            html.Div(
+                                                [
+                                                    dcc.Dropdown(
+                                                        id='search-variable',
+                                                        options=[],
+                                                        placeholder='Variable')
+                                                ], style={'width': '40%'},
+                                            ),
+                                            html.Div(
+                                                [
+                                                    dcc.Dropdown(
+                                                        id='search-operator',
+                                                        options=[{'label': operator, 'value': operator} for operator in event_search.SEARCH_OPERATORS],
+                                                        value='>',
+                                                        clearable=False)
+                                                ], style={'width': '15%'},
+                                            ),
+                                            html.Div(
+                                                [
+                                                    dcc.Input(
+                                                        id='search-threshold',
+                                                        type='number',
+                                                        placeholder='Threshold')
+                                                ], style={'width': '20%'},
+                                            ),
+                                            html.Div(
+                                                [
+                                                    html.A(id='search-button', children='SEARCH')
+                                                ], className='data_buttons', style={'border': '2px red dashed', 'width': '20%', 'margin-top': '0'},
+                                            ),
+                                        ], className='flex_container_row',
+                                    ),
+                                    html.Div(
+                                        [
+                                            html.Label(id='search-status', children=None, style={'font-weight': 'bold'}),
+                                            html.A('DOWNLOAD SEARCH RESULTS', id='search-download-link', href=None, style={'display': 'none'}),
+                                        ], className='flex_container_row',
+                                    ),
+                                ], className='filter_box_position',
+                            ),
+                            html.Div(
+                                [
+                                    #  download dates and message
+                                    html.Div(
+                                        [
+                                            html.Label('Download Dates:', className='filter_box_labels'),
+                                            html.Div(
+                                                [
+                                                    html.Div(
+                                                        [
+                                                            dcc.Dropdown(
+                                                                id='download-year-start',
+                                                                options=[{'label': year, 'value': year} for year in ['Select A Station']],
+                                                                placeholder='Start Year')
+                                                        ], style={'width': '40%'},
+                                                    ),
+                                                    html.Div(
+                                                        [
+                                                            dcc.Dropdown(
+                                                                id='download-month-start',
+                                                                options=[{'label': month, 'value': month} for month in ['Select A Station']],
+                                                                placeholder='Start Month')
+                                                        ], style={'width': '40%'},
+                                                    ),
+                                                ], className='flex_container_row', style={'margin-bottom': '1rem'},
+                                            ),
+                                            html.Div(
+                                                [
+                                                    html.Div(
+                                                        [
+                                                            dcc.Dropdown(
+                                                                id='download-year-end',
+                                                                options=[{'label': year, 'value': year} for year in ['Select A Station']],
+                                                                placeholder='End Year')
+                                                        ], style={'width': '40%'},
+                                                    ),
+                                                    html.Div(
+                                                        [
+                                                            dcc.Dropdown(
+                                                                id='download-month-end',
+                                                                options=[{'label': month, 'value': month} for month in ['Select A Station']],
+                                                                placeholder='End Month')
+                                                        ], style={'width': '40%'},
+                                                    ),
+                                                ], className='flex_container_row',
+                                            ),
+                                            html.Div(
+                                                [
+                                                    html.Label(id='download-message', children='')
+                                                ], style={'width': '82%', 'margin-left': '0.5rem'},
+                                            ),
+                                        ], style={'width': '55%'},
+                                    ),
+                                    html.Div(
+                                        [
+                                            #  download interval and buttons
+                                            html.Label('Download Interval:', className='filter_box_labels', style={'margin-left': '3rem'}),
+                                            html.Div(
+                                                [
+                                                    html.Div(
+                                                        [
+                                                            dcc.Dropdown(
+                                                                id='download-frequency',
+                                                                options=[{'label': frequency, 'value': frequency} for frequency in ['Select A Station']],
+                                                                placeholder='Frequency')
+                                                        ], style={'width': '85%'},
+                                                    ),
+                                                    html.Div(
+                                                        [
+                                                            dcc.Dropdown(
+                                                                id='download-format',
+                                                                options=[{'label': output_formats.OUTPUT_FORMATS[fmt]['label'], 'value': fmt}
+                                                                         for fmt in output_formats.available_formats()],
+                                                                value=output_formats.DEFAULT_FORMAT,
+                                                                clearable=False,
+                                                                placeholder='File Format')
+                                                        ], style={'width': '85%', 'margin-top': '1rem'},
+                                                    ),
+                                                    html.Div(
+                                                        [
+                                                            dcc.Dropdown(
+                                                                id='download-variables',
+                                                                options=[],
+                                                                value=[],
+                                                                multi=True,
+                                                                placeholder='All Variables')
+                                                        ], style={'width': '85%', 'margin-top': '1rem'},
+                                                    ),
+                                                    html.Div(
+                                                        [
+                                                            dcc.Dropdown(
+                                                                id='download-aggregation',
+                                                                options=[],
+                                                                placeholder='No Aggregation'),
+                                                            dcc.Checklist(
+                                                                id='download-aggregation-stats',
+                                                                options=[{'label': stat.title(), 'value': stat} for stat in aggregation.AGGREGATION_STATS],
+                                                                value=aggregation.AGGREGATION_STATS,
+                                                                labelStyle={'display': 'inline-block', 'margin-right': '0.5rem'})
+                                                        ], style={'width': '85%', 'margin-top': '1rem'},
+                                                    ),
+                                                    html.Div(
+                                                        [
+                                                            html.A(id='generate-data-button', children='1. GENERATE DATA')
+                                                        ], className='data_buttons', style={'border': '2px red dashed','width': '85%'},
+                                                    ),
+                                                    html.Div(
+                                                        id='toggle-button-vis',
+                                                        children=
+                                                        [
+                                                            html.Div(
+                                                                [
+                                                                    html.A(id='download-data-button', children='2. DOWNLOAD DATA')
+                                                                ], className='data_buttons', style={'border': '2px green dashed'},
+                                                            ),
+                                                            html.Div(
+                                                                [
+                                                                    html.A('3. GRAPH DATA', id='graph-data-button', href="/pages/graph_page")
+                                                                ], className='data_buttons', style={'border': '2px blue dashed','margin-top': '1.5rem'},
+                                                            ),
+                                                        ], style={'display': 'none', 'width': '85%'},
+                                                    ),
+                                                    html.Div(
+                                                        id='spinner',
+                                                        children=
+                                                        [
+                                                            html.Img(src=spinner_image()),
+                                                            html.Label(
+                                                                id='spinner-label',
+                                                                children='Download Progress: Pending....',
+                                                                style={'font-weight': 'bold', 'font-size': '16px'}),
+                                                        ], style={'display': 'none'},
+                                                    ),
+                                                ], className='flex_container_column',
+                                            ),
+
+                                        ], style={'width': '40%'},
+                                    ),
+                                ], className='download_box_position',
+                            ),
+                        ],
+                        className='five columns',
+                    ),
+                ],
+                className='row',
+            ),
+        ],
+    )
+
+######################################### CACHED RESULTS ###############################################################
+
+
+#  function to normalize the map filters so equivalent inputs share one cache entry. blank inputs become None, the
+#  year filter only applies when both years are set and the location is rounded to about 10 m
+def normalize_filters(prov, frequency, first_year, end_year, lat, lon, radius, nearest, stn_name):
+
+    try:
+        lat, lon = round(float(lat), 4), round(float(lon), 4)
+    except (TypeError, ValueError):
+        lat, lon = None, None
+
+    if not (first_year and end_year):
+        first_year, end_year = None, None
+
+    return (prov or None, frequency or None, first_year, end_year, lat, lon, float(radius) if radius else None,
+            int(nearest) if nearest else None, stn_name.upper() if stn_name else None)
+
+
+#  function to return the index of the stations passing the map filters. metadata_key is the s3 key of the station table
+#  the index points into, so a new generation of the table is filtered again
+@cache.memoize()
+def filter_stations(filters, metadata_key):
+
+    prov, frequency, first_year, end_year, lat, lon, radius, nearest, stn_name = filters
+    df = stations.get_station_metadata()
 
-# map filter and selected station table callback
-@app.callback(
-    [Output(component_id='station-map', component_property='figure'),
-     Output(component_id='selected-station', component_property='data'),
-     Output(component_id='selected-station', component_property='selected_rows'),
-     Output(component_id='download-frequency', component_property='value'),
-     Output(component_id='download-month-start', component_property='value'),
-     Output(component_id='download-month-end', component_property='value'),
-     Output(component_id='download-year-start', component_property='value'),
-     Output(component_id='download-year-end', component_property='value'),
-     Output(component_id='false-trigger', component_property='children')],
-    [Input(component_id='province', component_property='value'),
-     Input(component_id='frequency', component_property='value'),
-     Input(component_id='first-year', component_property='value'),
-     Input(component_id='last-year', component_property='value'),
-     Input(component_id='latitude', component_property='value'),
-     Input(component_id='longitude', component_property='value'),
-     Input(component_id='radius', component_property='value'),
-     Input(component_id='station-name', component_property='value'),
-     Input(component_id='station-map', component_property='clickData')]
-)
-def data_filter(prov, frequency, first_year, end_year, lat, lon, radius, stn_name, on_map_click):
     #  don't use global variable to filter weather station data on map
     df_filter = df.copy()
 
@@ -427,40 +545,115 @@ def data_filter(prov, frequency, first_year, end_year, lat, lon, radius, stn_nam
     else:
         df_filter = df_filter
 
-    # filter to limit mapped data between specified dates
+    # filter to limit mapped data between specified years, compared by year like the map filters in the browser
     if first_year and end_year and frequency == 'Hourly':
-        df_filter = df_filter[(df_filter.first_hourly_data <= end_year) & (df_filter.last_hourly_data >= first_year)]
+        df_filter = df_filter[(df_filter.first_hourly_data.dt.year <= int(end_year)) & (df_filter.last_hourly_data.dt.year >= int(first_year))]
     elif first_year and end_year and frequency == 'Daily':
-        df_filter = df_filter[(df_filter.first_daily_data <= end_year) & (df_filter.last_daily_data >= first_year)]
+        df_filter = df_filter[(df_filter.first_daily_data.dt.year <= int(end_year)) & (df_filter.last_daily_data.dt.year >= int(first_year))]
     elif first_year and end_year and frequency == 'Monthly':
-        df_filter = df_filter[(df_filter.first_monthly_data <= end_year) & (df_filter.last_monthly_data >= first_year)]
+        df_filter = df_filter[(df_filter.first_monthly_data.dt.year <= int(end_year)) & (df_filter.last_monthly_data.dt.year >= int(first_year))]
     elif first_year and end_year:
         first_data_record = df_filter[['first_hourly_data', 'first_daily_data', 'first_monthly_data']].min(axis=1)
         last_data_record = df_filter[['last_hourly_data', 'last_daily_data', 'last_monthly_data']].max(axis=1)
-        df_filter = df_filter[(first_data_record <= end_year) & (last_data_record >= first_year)]
+        df_filter = df_filter[(first_data_record.dt.year <= int(end_year)) & (last_data_record.dt.year >= int(first_year))]
     else:
         df_filter = df_filter
 
     # filter to limit mapped data by radius from a specified point
-    if lat and lon and radius:
+    if lat is not None and radius:
         df_filter = df_filter[
             compute_great_circle_distance(lat, lon, df_filter.latitude, df_filter.longitude) <= np.float64(radius)]
     else:
         df_filter = df_filter
 
+    # filter to limit mapped data to the stations nearest a specified point, ranked on the prebuilt spatial index
+    if lat is not None and nearest:
+        df_filter = stations.nearest_stations(lat, lon, nearest, mask=df.index.isin(df_filter.index)).drop(columns='distance_km')
+    else:
+        df_filter = df_filter
+
     # filter to limit mapped data by search name
     if stn_name:
         df_filter = df_filter[df_filter.station_name.str.contains(stn_name.upper())]
     else:
         df_filter = df_filter
 
-    # highlight selected station and populate selected station data to a table
+
+    return list(df_filter.index)
+
+
+#  function to return the years holding data for each frequency of a station, keyed by the availability index in use
+#  so a newly published index is never shadowed by cached years
+@cache.memoize()
+def station_available_years(station_id, availability_key):
+
+    years = {freq: availability.available_years(station_id, freq) for freq in availability.FREQUENCIES}
+
+    return {freq: year for freq, year in years.items() if year is not None}
+
+#  function to list the variables a station file offers for download, they only change when the archive does
+@cache.memoize()
+def station_download_variables(station_id, frequency, headers_key):
+
+    return extraction.station_variables(get_s3_client(), station_id, frequency)
+
+######################################### INTERACTION CALLBACKS ########################################################
+
+# station map drawn in the browser from the geojson station tiles of the visible area, filtered there on every change
+# of the filters so the web dyno never builds or sends the map figure (assets/clientside.js)
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='update_station_map'),
+    Output(component_id='station-map', component_property='figure'),
+    [Input(component_id='province', component_property='value'),
+     Input(component_id='frequency', component_property='value'),
+     Input(component_id='first-year', component_property='value'),
+     Input(component_id='last-year', component_property='value'),
+     Input(component_id='latitude', component_property='value'),
+     Input(component_id='longitude', component_property='value'),
+     Input(component_id='radius', component_property='value'),
+     Input(component_id='station-name', component_property='value'),
+     Input(component_id='nearest-stations-store', component_property='data'),
+     Input(component_id='selected-station', component_property='data'),
+     Input(component_id='station-map', component_property='relayoutData')],
+    [State(component_id='station-map-layout', component_property='data')]
+)
+
+# selected station table callback, the clicked station must pass the same filters as the stations drawn on the map
+@app.callback(
+    [Output(component_id='selected-station', component_property='data'),
+     Output(component_id='selected-station', component_property='selected_rows'),
+     Output(component_id='download-frequency', component_property='value'),
+     Output(component_id='download-month-start', component_property='value'),
+     Output(component_id='download-month-end', component_property='value'),
+     Output(component_id='download-year-start', component_property='value'),
+     Output(component_id='download-year-end', component_property='value'),
+     Output(component_id='false-trigger', component_property='children'),
+     Output(component_id='station-availability-store', component_property='data'),
+     Output(component_id='nearest-stations-store', component_property='data'),
+     Output(component_id='state-token', component_property='data')],
+    [Input(component_id='province', component_property='value'),
+     Input(component_id='frequency', component_property='value'),
+     Input(component_id='first-year', component_property='value'),
+     Input(component_id='last-year', component_property='value'),
+     Input(component_id='latitude', component_property='value'),
+     Input(component_id='longitude', component_property='value'),
+     Input(component_id='radius', component_property='value'),
+     Input(component_id='nearest-count', component_property='value'),
+     Input(component_id='station-name', component_property='value'),
+     Input(component_id='station-map', component_property='clickData')],
+    [State(component_id='state-token', component_property='data')]
+)
+def data_filter(prov, frequency, first_year, end_year, lat, lon, radius, nearest, stn_name, on_map_click, token):
+    #  stations passing the filters, shared through the cache by every user with the same filters
+    filters = normalize_filters(prov, frequency, first_year, end_year, lat, lon, radius, nearest, stn_name)
+    df_filter = stations.get_station_metadata().loc[filter_stations(filters, stations.archive_key('metadata'))]
+
+    #  the nearest station filter ranks the whole station table, the map only draws the stations it kept
+    nearest_ids = [str(station_id) for station_id in df_filter.station_id] if filters[7] and filters[4] is not None else None
+
+    # populate selected station data to a table, the map highlights the stations of the table
     if on_map_click and not df_filter[(df_filter.latitude == on_map_click['points'][0]['lat']) &
                                              (df_filter.longitude == on_map_click['points'][0]['lon'])].empty:
-        selected_lat = on_map_click['points'][0]['lat']
-        selected_lon = on_map_click['points'][0]['lon']
-        selected_station_name = on_map_click['points'][0]['text']
-
         df_table = df_filter.copy()
         df_table[['first_hourly_data', 'last_hourly_data', 'first_daily_data', 'last_daily_data', 'first_monthly_data', 'last_monthly_data']] = \
             df_table[['first_hourly_data', 'last_hourly_data', 'first_daily_data', 'last_daily_data', 'first_monthly_data', 'last_monthly_data']].apply(lambda x: x.dt.date)
@@ -469,17 +662,25 @@ def data_filter(prov, frequency, first_year, end_year, lat, lon, radius, stn_nam
                               (df_table.longitude == on_map_click['points'][0]['lon'])].to_dict('records')
         selected_row = []
 
+        #  years that actually hold data for each station in the table, used by the download year dropdowns
+        station_availability = {str(row['station_id']): station_available_years(row['station_id'], stations.archive_key('availability'))
+                                for row in table_data}
+
     else:
-        selected_lat = []
-        selected_lon = []
-        selected_station_name = []
         table_data = []
         selected_row = []
+        station_availability = {}
 
-    return station_map(df_filter, selected_lat, selected_lon, selected_station_name, 'blue'), table_data, selected_row, None, None, None, None, None, None
+    #  the table records are kept server side for the download callback, which only receives the selected row
+    new_token = session_state.ensure_token(token)
+    session_state.save(new_token, selection=table_data)
 
-# download options based on selected station callback
-@app.callback(
+    return table_data, selected_row, None, None, None, None, None, None, \
+        station_availability, nearest_ids, new_token if new_token != token else dash.no_update
+
+# download options based on selected station callback, runs in the browser (assets/clientside.js)
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='update_download_dropdowns'),
     [Output(component_id='download-frequency', component_property='options'),
      Output(component_id='download-month-start', component_property='options'),
      Output(component_id='download-month-end', component_property='options'),
@@ -488,55 +689,13 @@ def data_filter(prov, frequency, first_year, end_year, lat, lon, radius, stn_nam
     [Input(component_id='selected-station', component_property='data'),
      Input(component_id='selected-station', component_property='selected_rows'),
      Input(component_id='download-frequency', component_property='value'),
-     Input(component_id='false-trigger', component_property='children')]
+     Input(component_id='false-trigger', component_property='children'),
+     Input(component_id='station-availability-store', component_property='data')]
 )
-def update_download_dropdowns(selected_station, selected_station_row, selected_frequency, false_trigger):
-
-    if selected_station and selected_station_row:
-
-        #  attributes of selected station
-        df_selected_data = pd.DataFrame(selected_station).iloc[selected_station_row[0]]
-
-        #  populate dropdown tab with available frequency of data to download
-        available_frequency = df_selected_data[['first_hourly_data', 'first_daily_data', 'first_monthly_data']].dropna().index.to_list()
-        download_frequency = [{'label': freq.split('_')[1].capitalize(), 'value': freq.split('_')[1].capitalize()} for freq in available_frequency]
-
-        if not any(freq['value'] == selected_frequency for freq in download_frequency):
-            selected_frequency = None
-
-        #  populate dropdown tab with available months of data to download
-        download_month_start = [{'label': year, 'value': year} for year in range(1, 13, 1)]
-        download_month_end = download_month_start  # same month range for downloads
-
-        #  populate dropdown tab with available years of data to download corresponding to map filter data frequency
-        if selected_frequency == 'Hourly':
-            download_year_start = [{'label': year, 'value': year} for year in
-                                   set(pd.date_range(df_selected_data.first_hourly_data, df_selected_data.last_hourly_data, freq='MS').year)]
-            download_year_end = download_year_start  # same year range for downloads
-        elif selected_frequency == 'Daily':
-            download_year_start = [{'label': year, 'value': year} for year in
-                                   set(pd.date_range(df_selected_data.first_daily_data, df_selected_data.last_daily_data, freq='MS').year)]
-            download_year_end = download_year_start  # same year range for downloads
-        elif selected_frequency == 'Monthly':
-            download_year_start = [{'label': year, 'value': year} for year in
-                                   set(pd.date_range(df_selected_data.first_monthly_data, df_selected_data.last_monthly_data, freq='MS').year)]
-            download_year_end = download_year_start  # same year range for downloads
-        else:
-            first_data_record = pd.to_datetime(df_selected_data[['first_hourly_data', 'first_daily_data', 'first_monthly_data']]).min().year
-            last_data_record = pd.to_datetime(df_selected_data[['last_hourly_data', 'last_daily_data', 'last_monthly_data']]).max().year
-            download_year_start = [{'label': year, 'value': year} for year in
-                                   set(pd.date_range(str(first_data_record), str(last_data_record), freq='MS').year)]
-            download_year_end = download_year_start  # same year range for downloads
-
-    else:
-        no_station_selected = [{'label': year, 'value': year} for year in ['Select A Station']]
-        download_frequency, download_month_start, download_month_end, download_year_start, download_year_end = \
-            no_station_selected, no_station_selected, no_station_selected, no_station_selected, no_station_selected
-
-    return download_frequency, download_month_start, download_month_end, download_year_start, download_year_end
 
-# download message based on download settings selected callback
-@app.callback(
+# download message based on download settings selected callback, runs in the browser (assets/clientside.js)
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='update_download_message'),
     [Output(component_id='download-message', component_property='children'),
      Output(component_id='download-message', component_property='style'),
      Output(component_id='message-status', component_property='children')],
@@ -549,63 +708,64 @@ def update_download_dropdowns(selected_station, selected_station_row, selected_f
      Input(component_id='selected-station', component_property='selected_rows'),
      Input(component_id='false-trigger', component_property='children')]
 )
-def update_download_message(selected_station, download_start_year, download_end_year, download_start_month, download_end_month, selected_frequency, selected_station_row, false_trigger):
-
-    # if all the necessary download settings have been selected then display download message
-    if selected_station and selected_frequency and download_start_year and download_start_month and download_end_year and download_end_month:
-
-        #  dataframe of tabledata
-        df_selected_data = pd.DataFrame(selected_station).iloc[selected_station_row[0]]
-
-        #  hack to reset message status if frequency is not in available frequncy, otherwise error in download
-        available_frequency = df_selected_data[['first_hourly_data', 'first_daily_data', 'first_monthly_data']].dropna().index.to_list()
-        download_frequency = [freq.split('_')[1].capitalize() for freq in available_frequency]
-
-        #  if the same start and end data are chose advise user to select something else
-        if download_start_year == download_end_year and download_start_month == download_end_month:
-            message = 'Download dates must be different'
-            message_style = {'width': '100%', 'margin-right': '1rem', 'margin-top': '1rem', 'border': '2px red dashed'}
-            message_status = None
-
-        # if the start year is after the end year advise the user to select something else
-        elif download_start_year > download_end_year:
-            message = 'Download start date must preceed download end date'
-            message_style = {'width': '100%', 'margin-right': '1rem', 'margin-top': '1rem', 'border': '2px red dashed'}
-            message_status = None
-
-        # if the start date is after the end date advise the user to select something else
-        elif download_start_year == download_end_year and download_start_month > download_end_month:
-            message = 'Download start date must preceed download end date'
-            message_style = {'width': '100%', 'margin-right': '1rem', 'margin-top': '1rem', 'border': '2px red dashed'}
-            message_status = None
-
-        # if no station is selected remove message
-        elif not selected_station_row:
-            message = []
-            message_style = {'width': '100%', 'margin-right': '1rem', 'margin-top': '1rem'}
-            message_status = None
-
-        elif selected_frequency not in download_frequency:
-            message = []
-            message_style = {'width': '100%', 'margin-right': '1rem', 'margin-top': '1rem'}
-            message_status = None
-
-        # if all the options are correct and present then provide the download message
-        else:
-            start_date = datetime.strptime(str(download_start_year) + str(download_start_month) + '1', '%Y%m%d').date()
-            end_date = datetime.strptime(str(download_end_year) + str(download_end_month) + '1', '%Y%m%d').date() - timedelta(1)
-            message = 'First select GENERATE DATA and once loading is complete select DOWNLOAD DATA to begin downloading {} ' \
-                      'data from {} to {} for station {} (station ID {})' \
-                    .format(download_frequency, start_date, end_date, df_selected_data.station_name, df_selected_data.station_id)
-            message_style = {'width': '100%', 'margin-right': '1rem', 'margin-top': '1rem', 'border': '2px red dashed'}
-            message_status = 'PROCEED'
 
-    else:
-        message = []
-        message_style = {'width': '100%', 'margin-right': '1rem', 'margin-top': '1rem'}
-        message_status = None
+# variables of the selected station and frequency offered in the download panel, none selected downloads every column
+@app.callback(
+    [Output(component_id='download-variables', component_property='options'),
+     Output(component_id='download-variables', component_property='value')],
+    [Input(component_id='selected-station', component_property='selected_rows'),
+     Input(component_id='download-frequency', component_property='value')],
+    [State(component_id='state-token', component_property='data')]
+)
+def update_download_variables(selected_station_row, download_frequency, token):
+
+    selection = session_state.load(token, 'selection', [])
+    if not selected_station_row or selected_station_row[0] >= len(selection) or download_frequency not in availability.FREQUENCIES:
+        return [], []
+
+    station_id = selection[selected_station_row[0]]['station_id']
+    try:
+        variables = station_download_variables(station_id, download_frequency, stations.archive_key('headers'))
+    except get_s3_client().exceptions.NoSuchKey:
+        variables = []
 
-    return message, message_style, message_status
+    return [{'label': variable, 'value': variable} for variable in variables], []
+
+# aggregation periods coarser than the selected download frequency
+@app.callback(
+    [Output(component_id='download-aggregation', component_property='options'),
+     Output(component_id='download-aggregation', component_property='value')],
+    [Input(component_id='download-frequency', component_property='value')]
+)
+def update_download_aggregation(download_frequency):
+
+    periods = aggregation.AGGREGATION_PERIODS.get(download_frequency, [])
+
+    return [{'label': 'Aggregate To {}'.format(period), 'value': period} for period in periods], None
+
+# speculative warm up of the selected station while the user sets up the download, the dropdowns themselves are
+# filled in the browser so the prefetch is queued from this server callback on the same selection
+@app.callback(
+    Output(component_id='prefetch-store', component_property='data'),
+    [Input(component_id='selected-station', component_property='selected_rows')],
+    [State(component_id='state-token', component_property='data')]
+)
+def prefetch_selected_station(selected_station_row, token):
+
+    selection = session_state.load(token, 'selection', [])
+    if not selected_station_row or selected_station_row[0] >= len(selection):
+        raise dash.exceptions.PreventUpdate
+    station = selection[selected_station_row[0]]
+
+    queued = []
+    for frequency in availability.FREQUENCIES:
+        if prefetch.record_range(station['station_id'], frequency) and prefetch.claim(station['station_id'], frequency):
+            from tasks import prefetch_station_data
+            prefetch_station_data.apply_async([station['station_id'], frequency], queue=scheduling.PREFETCH_QUEUE,
+                                              expires=prefetch.PREFETCH_EXPIRES)
+            queued.append(frequency)
+
+    return queued
 
 # Send download to Celery background worker on Heroku and link to download button
 @app.callback(
@@ -619,8 +779,7 @@ def update_download_message(selected_station, download_start_year, download_end_
      Output(component_id='spinner', component_property='style'),
      Output(component_id='variable-name-store', component_property='data'),
      Output(component_id='spinner-label', component_property='children')],
-    [Input(component_id='selected-station', component_property='data'),
-     Input(component_id='download-year-start', component_property='value'),
+    [Input(component_id='download-year-start', component_property='value'),
      Input(component_id='download-year-end', component_property='value'),
      Input(component_id='download-month-start', component_property='value'),
      Input(component_id='download-month-end', component_property='value'),
@@ -630,11 +789,17 @@ def update_download_message(selected_station, download_start_year, download_end_
      Input(component_id='task-refresh-interval', component_property='n_intervals'),
      Input(component_id='selected-station', component_property='selected_rows')],
     [State(component_id='task-status', component_property='children'),
-     State(component_id='task-id', component_property='children')]
+     State(component_id='task-id', component_property='children'),
+     State(component_id='download-format', component_property='value'),
+     State(component_id='download-variables', component_property='value'),
+     State(component_id='download-aggregation', component_property='value'),
+     State(component_id='download-aggregation-stats', component_property='value'),
+     State(component_id='state-token', component_property='data')]
 )
-def background_download_task(selected_station, download_start_year, download_end_year, download_start_month,
+def background_download_task(download_start_year, download_end_year, download_start_month,
                              download_end_month, download_frequency, generate_button_click, message_status,
-                             n_int, selected_station_row, task_status_state, task_id_state):
+                             n_int, selected_station_row, task_status_state, task_id_state, download_format,
+                             download_variables, aggregation_period, aggregation_stats, token):
 
     #  look for specific click event
     ctx = dash.callback_context
@@ -642,33 +807,68 @@ def background_download_task(selected_station, download_start_year, download_end
     #  if the user has set the download timeframe, frequency, and no current task is running then launch celery
     if ctx.triggered[0]['prop_id'] == 'generate-data-button.n_clicks' and generate_button_click and message_status == 'PROCEED' and task_status_state is None:
 
-        #  create data frame of selected station metadata
-        df_selected_data = pd.DataFrame(selected_station).iloc[selected_station_row[0]]
-        station_metadata = {k: v for v, k in enumerate([df_selected_data.latitude, df_selected_data.longitude, df_selected_data.station_name])}
-
-        #  create filename link for S3 download following background task
-        if download_frequency == 'Hourly':
-            output_filename = '_'.join(['WHC', df_selected_data.station_name.replace(' ', '_'), str(df_selected_data.station_id),
-                                 str(download_start_year), str(download_end_year), 'hourly.csv'])
-        elif download_frequency == 'Daily':
-            output_filename = '_'.join(['WHC', df_selected_data.station_name.replace(' ', '_'), str(df_selected_data.station_id),
-                                 str(download_start_year), str(download_end_year), 'daily.csv'])
-        elif download_frequency == 'Monthly':
-            output_filename = '_'.join(['WHC', df_selected_data.station_name.replace(' ', '_'), str(df_selected_data.station_id),
-                                 str(download_start_year), str(download_end_year), 'monthly.csv'])
+        #  selected station record from the tab's server side state
+        selection = session_state.load(token, 'selection', [])
+        if not selected_station_row or selected_station_row[0] >= len(selection):
+            raise dash.exceptions.PreventUpdate
+        station = selection[selected_station_row[0]]
+        station_metadata = {k: v for v, k in enumerate([station['latitude'], station['longitude'], station['station_name'],
+                                                          str(station['station_id'])])}
+
+        #  key of everything that decides the generated file, an identical request answered recently is handed the file
+        #  already generated for it and no job is queued
+        output_key = output_store.output_key(station['station_id'], download_frequency, download_start_year, download_start_month,
+                                             download_end_year, download_end_month, download_format, download_variables,
+                                             aggregation_period, aggregation_stats)
+
+        #  create filename link for S3 download following background task. the filename carries the start of the output
+        #  key, requests differing only in months, variables or statistics never write to the same file
+        output_filename = '_'.join(['WHC', station['station_name'].replace(' ', '_'), str(station['station_id']),
+                                    str(download_start_year), str(download_end_year), download_frequency.lower()] +
+                                   (['to', aggregation_period.lower()] if aggregation_period else []) + [output_key[:10]]) + \
+            output_formats.OUTPUT_FORMATS[download_format]['extension']
 
         relative_filename = os.path.join('download', output_filename)
         link_path = '/{}'.format(relative_filename)
 
+        fresh_output = output_store.find_fresh(output_key)
+        if fresh_output is not None:
+            output_filename, variable_names = fresh_output
+            session_state.save(token, variables=variable_names)
+            link_path = '/download/{}'.format(output_filename)
+            interval = 24*60*60*1*1000
+            current_task_progress = 'Download Complete!!!'
+
+            return link_path, None, output_filename, station_metadata, None, interval, {'display': 'block'}, {'display': 'none'}, uuid.uuid4().hex, current_task_progress
+
+        #  fair share admission, each browser session may only have a few download jobs queued or running at once
+        session_key = scheduling.session_id()
+        task_id = uuid.uuid4().hex
+        if not scheduling.admit_job(session_key, task_id):
+            loading_div_viz = {'display': 'inline-block', 'text-align': 'center'}
+            current_task_progress = 'Too many downloads in progress. Please wait for one to finish and try again.'
+
+            return dash.no_update, dash.no_update, dash.no_update, dash.no_update, None, dash.no_update, dash.no_update, loading_div_viz, dash.no_update, current_task_progress
+
+        #  route the job to the fast or bulk lane from its estimated size
+        job_rows = scheduling.estimate_job_rows(station['station_id'], download_frequency,
+                                                pd.Timestamp(year=int(download_start_year), month=int(download_start_month), day=1),
+                                                pd.Timestamp(year=int(download_end_year), month=int(download_end_month), day=1))
+
         #  start background task in Celery and Redis
-        download_task = tasks.download_remote_data.apply_async([df_selected_data.station_name, output_filename, str(df_selected_data.station_id), str(download_start_year),
-                                                                str(download_start_month), str(download_end_year), str(download_end_month), download_frequency])
+        from tasks import download_remote_data
+        download_task = download_remote_data.apply_async([station['station_name'], output_filename, str(station['station_id']), str(download_start_year),
+                                                          str(download_start_month), str(download_end_year), str(download_end_month), download_frequency, download_format],
+                                                         {'session_key': session_key, 'variables': download_variables or None,
+                                                          'aggregation_period': aggregation_period, 'aggregation_stats': aggregation_stats,
+                                                          'output_key': output_key},
+                                                         task_id=task_id, queue=scheduling.choose_queue(job_rows))
 
         #  task id of current celery task
         task_id = download_task.id
         time.sleep(0.5)  # Need a short sleep for task_id to catch up
 
-        task = AsyncResult(id=task_id, app=celery_app)
+        task = get_task_result(task_id)
         current_task_status = task.state
         current_task_progress = 'Download Starting...'
         interval = 500  # set refresh interval short and to update task status
@@ -677,9 +877,9 @@ def background_download_task(selected_station, download_start_year, download_end
 
         return link_path, task_id, output_filename, station_metadata, current_task_status, interval, button_visibility, loading_div_viz, dash.no_update, current_task_progress
 
-    #  task will be pending if it's waiting in the queue
-    elif task_status_state == 'PENDING':
-        task = AsyncResult(id=task_id_state, app=celery_app)
+    #  task will be pending if it's waiting in the queue, or retrying while it waits for a slot or resumes from a checkpoint
+    elif task_status_state in ('PENDING', 'RETRY'):
+        task = get_task_result(task_id_state)
         current_task_status = task.state
         current_task_progress = 'Download Pending...'
 
@@ -687,21 +887,23 @@ def background_download_task(selected_station, download_start_year, download_end
 
     #  task will be in progress if a worker has accepted it
     elif task_status_state == 'PROGRESS':
-        task = AsyncResult(id=task_id_state, app=celery_app)
+        task = get_task_result(task_id_state)
         current_task_status = task.state
         current_task_progress = 'Downloading...May Take A Few Minutes'
+        if isinstance(task.info, dict) and task.info.get('total', 0) > 1:
+            current_task_progress = 'Downloading...{} of {} Years Done'.format(task.info['done'], task.info['total'])
 
         return dash.no_update, dash.no_update, dash.no_update, dash.no_update, current_task_status, dash.no_update, dash.no_update, dash.no_update, dash.no_update, current_task_progress
 
     #  task will be successful once the worker releases it. DOES NOT MEAN REDIS HAS RESULTS YET
     elif task_status_state == 'SUCCESS':
-        task = AsyncResult(id=task_id_state, app=celery_app)
+        task = get_task_result(task_id_state)
         current_task_status = task.state
         current_task_progress = 'Download Complete!!!'
         interval = 500
         loading_div_viz = {'display': 'inline-block', 'text-align': 'center'}
         button_visibility = {'display': 'none'}
-        task_result = {}
+        task_result = dash.no_update
 
         #  just because status is SUCCESS doesnt mean the results made it to redis, need to wait for redis results
         if 'result' in task.info:
@@ -713,12 +915,16 @@ def background_download_task(selected_station, download_start_year, download_end
             task_result.pop('result', None)  # remove key
             task.forget()
 
+            #  the column names stay server side, the variable name store only receives the task id
+            session_state.save(token, variables=task_result)
+            task_result = task_id_state
+
         return dash.no_update, dash.no_update, dash.no_update, dash.no_update, current_task_status, interval, button_visibility, loading_div_viz, task_result, current_task_progress
 
     #  task will fail if celery indicates an error
     elif task_status_state == 'FAILURE':
-        task = AsyncResult(id=task_id_state, app=celery_app)
-        current_task_progress = 'Download Failed. Please refresh page and try again.'
+        task = get_task_result(task_id_state)
+        current_task_progress = 'Download Failed. Please try again, finished years will not be downloaded twice.'
         interval = 24 * 60 * 60 * 1 * 1000
         task.forget()
 
@@ -732,11 +938,100 @@ def background_download_task(selected_station, download_start_year, download_end
     else:
         raise dash.exceptions.PreventUpdate
 
+# variables the extreme event search offers for the selected data interval, daily when none is selected
+@app.callback(
+    [Output(component_id='search-variable', component_property='options'),
+     Output(component_id='search-variable', component_property='value')],
+    [Input(component_id='frequency', component_property='value')]
+)
+def update_search_variables(frequency):
+
+    return [{'label': variable, 'value': variable} for variable in event_search.SEARCH_VARIABLES[frequency or 'Daily']], None
+
+# Send extreme event search of the filtered stations to Celery background worker and link to its results
+@app.callback(
+    [Output(component_id='search-task', component_property='data'),
+     Output(component_id='search-refresh-interval', component_property='interval'),
+     Output(component_id='search-status', component_property='children'),
+     Output(component_id='search-download-link', component_property='href'),
+     Output(component_id='search-download-link', component_property='style')],
+    [Input(component_id='search-button', component_property='n_clicks'),
+     Input(component_id='search-refresh-interval', component_property='n_intervals')],
+    [State(component_id='province', component_property='value'),
+     State(component_id='frequency', component_property='value'),
+     State(component_id='first-year', component_property='value'),
+     State(component_id='last-year', component_property='value'),
+     State(component_id='search-variable', component_property='value'),
+     State(component_id='search-operator', component_property='value'),
+     State(component_id='search-threshold', component_property='value'),
+     State(component_id='search-task', component_property='data')]
+)
+def background_search_task(search_click, n_int, prov, frequency, first_year, last_year, variable, operator, threshold,
+                           search_task):
+
+    ctx = dash.callback_context
+    link_hidden = {'display': 'none'}
+    no_refresh = 24 * 60 * 60 * 1 * 1000
+
+    #  start a search when none is running, it needs the province and years of the filters above
+    if ctx.triggered[0]['prop_id'] == 'search-button.n_clicks' and search_click and search_task is None:
+        if not prov or not first_year or not last_year or not variable or threshold is None:
+            return dash.no_update, dash.no_update, 'Select a province, the years data is available between, a variable and a threshold', None, link_hidden
+        if int(first_year) > int(last_year):
+            return dash.no_update, dash.no_update, 'First year must not be after last year', None, link_hidden
+
+        session_key = scheduling.session_id()
+        task_id = uuid.uuid4().hex
+        if not scheduling.admit_job(session_key, task_id):
+            return dash.no_update, dash.no_update, 'Too many downloads in progress. Please wait for one to finish and try again.', None, link_hidden
+
+        frequency = frequency or 'Daily'
+        output_filename = '_'.join(['WHC', 'search', prov.replace(' ', '_'), frequency.lower(), str(first_year), str(last_year),
+                                    task_id[:8]]) + '.csv'
+
+        from tasks import search_extreme_events
+        search_extreme_events.apply_async([output_filename, variable, operator, threshold, frequency, str(first_year), str(last_year)],
+                                          {'province': prov, 'session_key': session_key},
+                                          task_id=task_id, queue=scheduling.BULK_QUEUE)
+
+        return {'id': task_id, 'filename': output_filename}, 1000, 'Search Pending...', None, link_hidden
+
+    elif ctx.triggered[0]['prop_id'] == 'search-refresh-interval.n_intervals' and search_task:
+        task = get_task_result(search_task['id'])
+
+        if task.state == 'SUCCESS':
+            info = task.info
+            task.forget()
+            status = 'Search Complete: {} Matches in {} Stations'.format(info['matches'], info['stations'])
+            if info.get('stations_found', 0) > info['stations']:
+                status += ' (first {} of {} stations searched, narrow the years or province)'.format(
+                    info['stations'], info['stations_found'])
+            return None, no_refresh, status, '/download/{}'.format(search_task['filename']), {'display': 'inline-block'}
+
+        elif task.state == 'FAILURE':
+            task.forget()
+            return None, no_refresh, 'Search Failed. Please try again.', None, link_hidden
+
+        elif task.state == 'PROGRESS' and isinstance(task.info, dict) and task.info.get('total'):
+            status = 'Searching...{} of {} Stations Done, {} Matches'.format(task.info['done'], task.info['total'], task.info['matches'])
+            return dash.no_update, dash.no_update, status, dash.no_update, dash.no_update
+
+        return dash.no_update, dash.no_update, 'Search Pending...', dash.no_update, dash.no_update
+
+    else:
+        raise dash.exceptions.PreventUpdate
+
 #  flask route for file download
 @app.server.route('/download/<filename>')
 def serve_static(filename):
 
-    #  presigned url for user to download file directly from s3, removes storage from memory
-    url = s3.generate_presigned_url('get_object', Params={'Bucket': os.environ['S3_BUCKET'], 'Key': 'tmp/' + filename}, ExpiresIn=100)
+    #  a download keeps the file from being evicted from the output store
+    output_store.touch(filename)
+
+    #  presigned url for user to download file directly from s3, removes storage from memory. the object already carries
+    #  the content type of its format so only the saved filename is set here
+    url = get_s3_client().generate_presigned_url('get_object', Params={'Bucket': os.environ['S3_BUCKET'], 'Key': output_store.OUTPUT_PREFIX + filename,
+                                                                       'ResponseContentDisposition': 'attachment; filename="{}"'.format(filename)},
+                                                 ExpiresIn=100)
 
     return redirect(url, code=302)
\ No newline at end of file
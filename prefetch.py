@@ -0,0 +1,108 @@
+import os
+import pandas as pd
+import stations
+import extraction
+import scheduling
+import output_formats
+import output_store
+
+from connections import get_redis
+
+######################################### SETTINGS #####################################################################
+
+#  station files expected to hold at most this many rows are extracted whole when the station is selected, downloads
+#  from them are then cut from the prefetched extract instead of queried
+PREFETCH_MAX_ROWS = int(os.environ.get('PREFETCH_MAX_ROWS', 20000))
+
+#  frequencies small enough to prefetch whole, hourly stations only get their headers warmed
+PREFETCH_FREQUENCIES = ('Daily', 'Monthly')
+
+#  prefetched extracts are parquet files tracked by the output store, under its prefix, so they count towards its byte
+#  budget and the least recently used ones are evicted like generated files
+PREFETCH_PREFIX = 'prefetch/'
+
+#  seconds a station is not prefetched again after it was requested, and seconds a queued prefetch is still worth
+#  running, a user who selected a station longer ago has downloaded or moved on
+PREFETCH_CLAIM_SECONDS = 60 * 60
+PREFETCH_EXPIRES = 120
+
+######################################### PREFETCH #####################################################################
+
+
+#  name of a prefetched extract in the output store. extracts belong to an archive generation, a refresh leaves the old
+#  ones behind instead of serving them and, no longer read, they are the first to be evicted
+def extract_key(station_id, frequency):
+
+    return '{}{}/{}_{}.parquet'.format(PREFETCH_PREFIX, stations.get_archive_manifest().get('generation', 'current'),
+                                      station_id, frequency.lower())
+
+
+#  function to claim the prefetch of a station frequency, False when it was already requested recently
+def claim(station_id, frequency):
+
+    key = 'whc:prefetch:{}'.format(extract_key(station_id, frequency))
+
+    return bool(get_redis().set(key, 1, nx=True, ex=PREFETCH_CLAIM_SECONDS))
+
+
+#  function to return the first and last day of the record of a station frequency from the station table, None without
+#  data
+def record_range(station_id, frequency):
+
+    df = stations.get_station_metadata()
+    row = df[df.station_id == int(station_id)]
+    prefix = stations.FREQUENCY_COLUMNS[frequency]
+    if row.empty or pd.isnull(row['first_{}_data'.format(prefix)].iloc[0]) or pd.isnull(row['last_{}_data'.format(prefix)].iloc[0]):
+        return None
+
+    first, last = row['first_{}_data'.format(prefix)].iloc[0], row['last_{}_data'.format(prefix)].iloc[0]
+
+    return pd.Timestamp(year=first.year, month=1, day=1), pd.Timestamp(year=last.year, month=12, day=31, hour=23, minute=59)
+
+
+#  function to warm everything a download of a station frequency needs: the header schema (shared through redis), the
+#  availability index of this worker process and, for small daily and monthly files, the whole extract. returns the
+#  rows prefetched
+def warm_station(s3, station_id, frequency):
+
+    extraction.query_station_headers(s3, station_id, frequency)
+
+    date_range = record_range(station_id, frequency)
+    if frequency not in PREFETCH_FREQUENCIES or date_range is None:
+        return 0
+    if scheduling.estimate_job_rows(station_id, frequency, *date_range) > PREFETCH_MAX_ROWS:
+        return 0
+
+    df = extraction.extract_station_data(s3, station_id, frequency, *date_range)
+    buffer = output_formats.write_dataframe(df, 'parquet')
+    buffer.seek(0, os.SEEK_END)
+    size = buffer.tell()
+    buffer.seek(0)
+
+    filename = extract_key(station_id, frequency)
+    s3.upload_fileobj(buffer, os.environ['S3_BUCKET'], output_store.OUTPUT_PREFIX + filename)
+    buffer.close()
+    output_store.register(s3, filename, size)
+
+    return len(df)
+
+
+#  function to cut a download from the prefetched extract of a station, None when the station was not prefetched. dates
+#  are compared as text like the s3 select query does, so the rows are the ones a query would have returned
+def cached_extract(s3, station_id, frequency, start_date, end_date, variables=None):
+
+    if frequency not in PREFETCH_FREQUENCIES:
+        return None
+
+    filename = extract_key(station_id, frequency)
+    try:
+        obj = s3.get_object(Bucket=os.environ['S3_BUCKET'], Key=output_store.OUTPUT_PREFIX + filename)
+    except s3.exceptions.NoSuchKey:
+        return None
+
+    output_store.touch(filename)
+    df = output_formats.read_dataframe(obj['Body'], 'parquet')
+    dates = df['Date/Time'].astype(str)
+    df = df[(dates >= str(start_date)) & (dates <= str(end_date))]
+
+    return df[extraction.projected_columns(df.columns, variables)] if variables else df
@@ -0,0 +1,53 @@
+import os
+import sys
+import subprocess
+
+######################################### SETTINGS #####################################################################
+
+#  seconds the web app may take to import, a recycled gunicorn worker is not serving until this is done
+IMPORT_TIME_BUDGET = float(os.environ.get('IMPORT_TIME_BUDGET', 3.0))
+
+#  modules that must not be imported at startup, they are loaded on first use
+LAZY_MODULES = ('celery', 'boto3', 'botocore', 'plotly.graph_objs', 'tasks')
+
+######################################### IMPORT PROFILE ###############################################################
+
+
+#  function to import a module in a fresh interpreter with -X importtime, returns (cumulative seconds, module) for every
+#  imported module
+def profile_import(module):
+
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    timings = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        timings.append((int(cumulative) / 1e6, name[1:].rstrip()))  # nested imports keep their extra indent
+
+    if proc.returncode != 0:
+        raise RuntimeError('importing {} failed:\n{}'.format(module, proc.stderr[-2000:]))
+
+    return timings
+
+
+#  profile of the web app import, prints the slowest top level imports and exits with an error when the import is over
+#  budget or pulls in a module that should be lazy. e.g. python profile_imports.py index
+if __name__ == '__main__':
+
+    module = sys.argv[1] if len(sys.argv) > 1 else 'index'
+    timings = profile_import(module)
+    total = max(seconds for seconds, name in timings)
+
+    print('Import of {}: {:.2f}s'.format(module, total))
+    for seconds, name in sorted([t for t in timings if not t[1].startswith(' ')], reverse=True)[:15]:
+        print('{:8.3f}s  {}'.format(seconds, name))
+
+    eager = sorted(set(name.strip() for seconds, name in timings if name.strip() in LAZY_MODULES))
+    if eager:
+        print('Imported at startup but should be lazy: {}'.format(', '.join(eager)))
+
+    sys.exit(1 if total > IMPORT_TIME_BUDGET or eager else 0)
@@ -0,0 +1,201 @@
+import os
+import time
+import uuid
+import redis
+import threading
+import availability
+import cpu_pool
+
+from flask import session
+from connections import get_redis
+
+######################################### SETTINGS #####################################################################
+
+#  download jobs are sent to the fast lane unless they are expected to return more rows than this
+FAST_LANE_MAX_ROWS = int(os.environ.get('FAST_LANE_MAX_ROWS', 250000))
+
+#  fair share limits, jobs one browser session may have queued or running and bulk jobs running on the workers at once
+MAX_JOBS_PER_SESSION = int(os.environ.get('MAX_JOBS_PER_SESSION', 2))
+MAX_RUNNING_BULK_JOBS = int(os.environ.get('MAX_RUNNING_BULK_JOBS', 4))
+
+#  speculative prefetch jobs running on the workers at once, prefetches beyond this are dropped rather than queued
+MAX_RUNNING_PREFETCH_JOBS = int(os.environ.get('MAX_RUNNING_PREFETCH_JOBS', 2))
+
+#  seconds after which a job slot is released even if its task never reported back, longer than the longest task time
+#  limit (the 30 minute search limit). running jobs refresh their slots (refresh_slots), so a download resumed from its
+#  checkpoints keeps its session slot across retries
+JOB_SLOT_TTL = 35 * 60
+
+#  expected rows per month of each data frequency
+ROWS_PER_MONTH = {'Hourly': 730, 'Daily': 30, 'Monthly': 1}
+
+#  memory budget of a worker dyno in megabytes, 0 turns the memory bounded worker mode off
+WORKER_MEMORY_BUDGET_MB = int(os.environ.get('WORKER_MEMORY_BUDGET_MB', 0))
+
+#  bytes a download job holds per row at its peak: the select text, the parsed dataframe and the encoded output
+TASK_BYTES_PER_ROW = int(os.environ.get('TASK_BYTES_PER_ROW', 2048))
+
+#  seconds a job waits before asking for memory again
+MEMORY_RETRY_SECONDS = 5
+
+FAST_QUEUE = 'fast'
+BULK_QUEUE = 'bulk'
+PREFETCH_QUEUE = 'prefetch'
+
+######################################### JOB COST #####################################################################
+
+
+#  function to estimate the rows a download job will return from the populated months in its date range
+def estimate_job_rows(station_id, frequency, start_date, end_date):
+
+    months = availability.populated_months(station_id, frequency)
+
+    if months is None:
+        n_months = (end_date.year - start_date.year) * 12 + end_date.month - start_date.month + 1
+    else:
+        n_months = int(((months >= availability.month_number(start_date)) & (months <= availability.month_number(end_date))).sum())
+
+    return max(n_months, 0) * ROWS_PER_MONTH.get(frequency, 1)
+
+
+#  function to pick the celery queue of a download job from its estimated size
+def choose_queue(n_rows):
+
+    return FAST_QUEUE if n_rows <= FAST_LANE_MAX_ROWS else BULK_QUEUE
+
+######################################### ADMISSION CONTROL ############################################################
+
+
+#  function to return a stable id for the current browser session, stored in the signed flask session cookie
+def session_id():
+
+    if 'whc_session_id' not in session:
+        session['whc_session_id'] = uuid.uuid4().hex
+
+    return session['whc_session_id']
+
+
+#  job slots are redis sorted sets of task ids scored by the time the slot was taken, so slots of tasks that were
+#  killed without releasing them expire on their own
+def _take_slot(key, task_id, limit):
+
+    r = get_redis()
+
+    with r.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                pipe.zremrangebyscore(key, 0, time.time() - JOB_SLOT_TTL)
+                if pipe.zcard(key) >= limit:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.zadd(key, {task_id: time.time()})
+                pipe.expire(key, JOB_SLOT_TTL)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                continue
+
+
+#  function to reserve a job slot for a session, returns False when the session already has its fair share of jobs
+def admit_job(session_key, task_id):
+
+    return _take_slot('whc:jobs:session:{}'.format(session_key), task_id, MAX_JOBS_PER_SESSION)
+
+
+#  function to release the job slot of a finished or failed task
+def release_job(session_key, task_id):
+
+    get_redis().zrem('whc:jobs:session:{}'.format(session_key), task_id)
+
+
+#  function to take one of the limited bulk lane running slots, returns False when all are in use
+def acquire_bulk_slot(task_id):
+
+    return _take_slot('whc:jobs:bulk-running', task_id, MAX_RUNNING_BULK_JOBS)
+
+
+def release_bulk_slot(task_id):
+
+    get_redis().zrem('whc:jobs:bulk-running', task_id)
+
+
+#  function to restart the expiry of the session and bulk lane slots a running job holds, slots it does not hold are
+#  left alone
+def refresh_slots(task_id, session_key=None):
+
+    keys = ['whc:jobs:bulk-running'] + (['whc:jobs:session:{}'.format(session_key)] if session_key else [])
+    now = time.time()
+
+    with get_redis().pipeline() as pipe:
+        for key in keys:
+            pipe.zadd(key, {task_id: now}, xx=True)
+            pipe.expire(key, JOB_SLOT_TTL)
+        pipe.execute()
+
+
+#  function to take one of the prefetch running slots, returns False when all are in use
+def acquire_prefetch_slot(task_id):
+
+    return _take_slot('whc:jobs:prefetch-running', task_id, MAX_RUNNING_PREFETCH_JOBS)
+
+
+def release_prefetch_slot(task_id):
+
+    get_redis().zrem('whc:jobs:prefetch-running', task_id)
+
+######################################### MEMORY BUDGET ################################################################
+
+#  memory reserved by the download jobs running in this worker process, keyed by task id. the rss of the idle worker is
+#  the baseline the reservations are added to
+_memory_lock = threading.Lock()
+_memory_reserved = {}
+_baseline_rss = 0
+
+
+#  function to read the resident memory of a process in bytes, 0 where /proc is not available
+def process_rss(pid='self'):
+
+    try:
+        with open('/proc/{}/statm'.format(pid)) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return 0
+
+
+#  function to return the resident memory of the worker and its cpu pool processes
+def worker_rss():
+
+    return process_rss() + sum(process_rss(pid) for pid in cpu_pool.worker_pids())
+
+
+#  function to reserve memory for a job expected to return n_rows, returns False when the live rss or the reservations
+#  of the running jobs leave no room for it under the budget. a job is always admitted when nothing else is running so
+#  jobs larger than the budget still run, one at a time
+def reserve_memory(task_id, n_rows):
+
+    global _baseline_rss
+
+    if WORKER_MEMORY_BUDGET_MB <= 0:
+        return True
+
+    with _memory_lock:
+        rss = worker_rss()
+        if not _memory_reserved:
+            _baseline_rss = rss
+
+        estimate = n_rows * TASK_BYTES_PER_ROW
+        projected = max(rss, _baseline_rss + sum(_memory_reserved.values())) + estimate
+        if _memory_reserved and projected > WORKER_MEMORY_BUDGET_MB * 1024 * 1024:
+            return False
+
+        _memory_reserved[task_id] = estimate
+
+    return True
+
+
+def release_memory(task_id):
+
+    with _memory_lock:
+        _memory_reserved.pop(task_id, None)
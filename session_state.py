@@ -0,0 +1,47 @@
+import json
+import uuid
+
+from connections import get_redis
+
+######################################### SETTINGS #####################################################################
+
+#  seconds the state of a browser tab is kept after it was last written
+STATE_TTL = 24 * 60 * 60
+
+######################################### SESSION STATE ################################################################
+
+#  per browser tab state kept in redis so callbacks only pass a short token instead of sending the selected station
+#  records and task results back and forth. the token lives in the state-token store of the tab (index.py), each value
+#  is a json field of one redis hash
+
+
+def state_key(token):
+
+    return 'whc:state:{}'.format(token)
+
+
+#  function to return the token of a tab, a new one when the tab does not have one yet
+def ensure_token(token):
+
+    return token or uuid.uuid4().hex
+
+
+#  function to save values into the state of a token and renew its expiry
+def save(token, **values):
+
+    r = get_redis()
+    with r.pipeline() as pipe:
+        pipe.hmset(state_key(token), {name: json.dumps(value, default=str) for name, value in values.items()})
+        pipe.expire(state_key(token), STATE_TTL)
+        pipe.execute()
+
+
+#  function to load one value of the state of a token, default when it was never saved or has expired
+def load(token, name, default=None):
+
+    if not token:
+        return default
+
+    value = get_redis().hget(state_key(token), name)
+
+    return default if value is None else json.loads(value)
@@ -0,0 +1,325 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+
+from connections import get_s3_client
+
+######################################### SETTINGS #####################################################################
+
+#  the archive manifest points at the current generation of the station metadata, header registry and availability
+#  index. keys missing from the manifest fall back to the original single objects
+ARCHIVE_MANIFEST_KEY = 'env-can-wx-archive-manifest.json'
+DEFAULT_ARCHIVE_KEYS = {'metadata': 'env-can-wx-station-metadata.csv', 'headers': None,
+                        'availability': 'env-can-wx-availability-index.json'}
+
+#  columns of the station csv files that describe a row rather than hold an observation
+ROW_COLUMNS = ('Longitude', 'Latitude', 'Station Name', 'Climate ID', 'Date/Time', 'Year', 'Month', 'Day', 'Time', 'Data Quality')
+
+#  tiles up to this zoom level are generated once per process, deeper tiles are cut from the station table on request
+MAX_TILE_ZOOM = 10
+
+#  station metadata column prefixes of each data frequency
+FREQUENCY_COLUMNS = {'Hourly': 'hourly', 'Daily': 'daily', 'Monthly': 'monthly'}
+
+EARTH_RADIUS_KM = 6371
+
+######################################### HELPER FUNCTIONS #############################################################
+
+
+#  this function downloads a file from s3
+def download_csv_s3(s3, filepath, bucket):
+
+    obj = s3.get_object(Bucket=bucket, Key=filepath)
+    df = pd.read_csv(obj['Body'], index_col=0)
+
+    return df
+
+
+#  this function converts station locations to web mercator tile indices at a zoom level
+def lonlat_to_tile(lon, lat, zoom):
+
+    n = 2 ** zoom
+    lat_rad = np.radians(np.clip(np.asarray(lat, dtype=np.float64), -85.0511, 85.0511))
+    x = np.floor((np.asarray(lon, dtype=np.float64) + 180.0) / 360.0 * n)
+    y = np.floor((1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n)
+
+    return np.clip(x, 0, n - 1).astype(np.int64), np.clip(y, 0, n - 1).astype(np.int64)
+
+
+#  key of the year partition holding one year of a station's data
+def partition_key(station_id, frequency, year):
+
+    return '{}_{}/{}.csv'.format(station_id, frequency.lower(), year)
+
+
+#  key of a station file in the header registry
+def header_registry_key(station_id, frequency):
+
+    return '{}_{}'.format(station_id, frequency.lower())
+
+######################################### ARCHIVE MANIFEST #############################################################
+
+
+#  seconds between checks for a newly published archive generation
+MANIFEST_REFRESH_SECONDS = 600
+
+_lock = threading.RLock()
+_manifest = None
+_manifest_read_at = 0
+_header_registry = (None, None)
+_metadata = (None, None)
+_spatial_index = None
+_features = None
+_tiles = {}
+
+
+#  function to read the archive manifest from s3, an empty manifest before the first incremental refresh
+def read_archive_manifest(s3):
+
+    try:
+        obj = s3.get_object(Bucket=os.environ['S3_BUCKET'], Key=ARCHIVE_MANIFEST_KEY)
+    except s3.exceptions.NoSuchKey:
+        return {}
+
+    return json.loads(obj['Body'].read())
+
+
+#  function to return the archive manifest, re-read every few minutes so long running workers pick up a refresh
+def get_archive_manifest():
+
+    global _manifest, _manifest_read_at
+
+    if _manifest is None or time.time() - _manifest_read_at > MANIFEST_REFRESH_SECONDS:
+        with _lock:
+            if _manifest is None or time.time() - _manifest_read_at > MANIFEST_REFRESH_SECONDS:
+                _manifest = read_archive_manifest(get_s3_client())
+                _manifest_read_at = time.time()
+
+    return _manifest
+
+
+#  function to return the s3 key of an archive object in the current generation
+def archive_key(name):
+
+    return get_archive_manifest().get(name) or DEFAULT_ARCHIVE_KEYS[name]
+
+
+#  function to switch the manifest to new archive objects in a single put, so readers never see a mix of generations
+def publish_archive_keys(s3, **keys):
+
+    manifest = read_archive_manifest(s3)
+    manifest.update(keys)
+    manifest['updated'] = pd.Timestamp.now().strftime('%Y-%m-%dT%H:%M:%S')
+
+    s3.put_object(Bucket=os.environ['S3_BUCKET'], Key=ARCHIVE_MANIFEST_KEY, Body=json.dumps(manifest),
+                  ContentType='application/json')
+
+
+#  function to load the registry of station file column names, empty until the first incremental refresh. the
+#  registry is cached with the key it was read from and reloaded when the manifest points at a new generation
+def get_header_registry():
+
+    global _header_registry
+
+    key = archive_key('headers')
+    if _header_registry[0] != key:
+        with _lock:
+            if _header_registry[0] != key:
+                if key is None:
+                    registry = {}
+                else:
+                    obj = get_s3_client().get_object(Bucket=os.environ['S3_BUCKET'], Key=key)
+                    registry = json.loads(obj['Body'].read())
+                _header_registry = (key, registry)
+
+    return _header_registry[1]
+
+######################################### STATION METADATA #############################################################
+
+
+#  function to load the weather station metadata from s3. the table is cached with the key it was read from and
+#  reloaded when the manifest points at a new generation, the spatial index and tiles built from it are rebuilt then
+def get_station_metadata():
+
+    global _metadata, _spatial_index, _features
+
+    key = archive_key('metadata')
+    if _metadata[0] != key:
+        with _lock:
+            if _metadata[0] != key:
+                df = download_csv_s3(get_s3_client(), key, os.environ['S3_BUCKET'])
+
+                #  convert times to datetime format
+                df[['first_year_hly', 'last_year_hly', 'first_year_dly', 'last_year_dly', 'first_year_mly', 'last_year_mly']] = \
+                    df[['first_year_hly', 'last_year_hly', 'first_year_dly', 'last_year_dly', 'first_year_mly', 'last_year_mly']].apply(pd.to_datetime, errors='coerce')
+
+                #  rename columns
+                df.columns = ['station_id', 'climate_id', 'province', 'station_name', 'latitude', 'longitude', 'elevation',
+                              'first_hourly_data', 'last_hourly_data', 'first_daily_data', 'last_daily_data', 'first_monthly_data', 'last_monthly_data']
+
+                _spatial_index, _features = None, None
+                _tiles.clear()
+                _metadata = (key, df)
+
+    return _metadata[1]
+
+######################################### NEAREST STATIONS #############################################################
+
+
+#  function to convert latitudes and longitudes in degrees to unit vectors on the sphere, the dot product of two unit
+#  vectors is the cosine of the angle between the locations
+def unit_vectors(lat, lon):
+
+    lat, lon = np.radians(np.asarray(lat, dtype=np.float64)), np.radians(np.asarray(lon, dtype=np.float64))
+
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+#  function to build the spatial index of the station table once per process: unit vectors of every station location
+#  on the sphere and the first and last year of each frequency as float arrays (nan when there is no data)
+def get_spatial_index():
+
+    global _spatial_index
+
+    get_station_metadata()  # a new metadata generation clears the index
+    if _spatial_index is not None:
+        return _spatial_index
+
+    with _lock:
+        if _spatial_index is None:
+            df = get_station_metadata()
+            index = {'xyz': unit_vectors(df.latitude.values, df.longitude.values),
+                     'province': df.province.values}
+
+            for frequency, prefix in FREQUENCY_COLUMNS.items():
+                index[('first', frequency)] = df['first_{}_data'.format(prefix)].dt.year.values.astype(np.float64)
+                index[('last', frequency)] = df['last_{}_data'.format(prefix)].dt.year.values.astype(np.float64)
+
+            _spatial_index = index
+
+    return _spatial_index
+
+
+#  function to return a boolean mask of stations with data of a frequency between two years. full coverage requires the
+#  record to span both years, otherwise any overlap with the years is enough. without a frequency any frequency counts
+def coverage_mask(frequency=None, start_year=None, end_year=None, full_coverage=True, province=None):
+
+    index = get_spatial_index()
+    frequencies = [frequency] if frequency else list(FREQUENCY_COLUMNS)
+    mask = np.zeros(len(index['xyz']), dtype=bool)
+
+    for freq in frequencies:
+        first, last = index[('first', freq)], index[('last', freq)]
+        freq_mask = ~np.isnan(first)
+        if start_year is not None and end_year is not None:
+            with np.errstate(invalid='ignore'):
+                if full_coverage:
+                    freq_mask &= (first <= start_year) & (last >= end_year)
+                else:
+                    freq_mask &= (first <= end_year) & (last >= start_year)
+        mask |= freq_mask
+
+    if province:
+        mask &= index['province'] == province
+
+    return mask
+
+
+#  function to return the k stations nearest to a point among those selected by mask, closest first, with their great
+#  circle distance in a distance_km column
+def nearest_stations(lat, lon, k, mask=None, max_distance_km=None):
+
+    df = get_station_metadata()
+    index = get_spatial_index()
+
+    distance_km = EARTH_RADIUS_KM * np.arccos(np.clip(index['xyz'].dot(unit_vectors(float(lat), float(lon))), -1.0, 1.0))
+
+    candidates = np.arange(len(df)) if mask is None else np.flatnonzero(mask)
+    if max_distance_km is not None:
+        candidates = candidates[distance_km[candidates] <= max_distance_km]
+
+    k = min(int(k), len(candidates))
+    if k <= 0:
+        return df.iloc[[]].assign(distance_km=[])
+
+    nearest = candidates[np.argpartition(distance_km[candidates], k - 1)[:k]]
+    nearest = nearest[np.argsort(distance_km[nearest])]
+
+    return df.iloc[nearest].assign(distance_km=distance_km[nearest])
+
+######################################### STATION TILES ################################################################
+
+
+#  function to build one geojson point feature per station with the period of record of each frequency as attributes
+def station_features():
+
+    global _features
+
+    df = get_station_metadata()  # a new metadata generation clears the features
+    if _features is not None:
+        return _features
+
+    properties = df[['station_id', 'climate_id', 'province', 'station_name', 'elevation']].copy()
+    properties['station_id'] = properties['station_id'].astype(str)
+    properties['climate_id'] = properties['climate_id'].astype(str)
+    properties['elevation'] = properties['elevation'].astype(float)
+
+    for prefix in FREQUENCY_COLUMNS.values():
+        #  years are stored as numbers (-1 when there is no data) so clients can filter with plain comparisons
+        properties['first_{}_year'.format(prefix)] = df['first_{}_data'.format(prefix)].dt.year.fillna(-1).astype(int)
+        properties['last_{}_year'.format(prefix)] = df['last_{}_data'.format(prefix)].dt.year.fillna(-1).astype(int)
+        properties['has_{}'.format(prefix)] = df['first_{}_data'.format(prefix)].notna()
+
+    properties = properties.astype(object).where(properties.notna(), None)
+    features = [{'type': 'Feature',
+                 'geometry': {'type': 'Point', 'coordinates': [float(lon), float(lat)]},
+                 'properties': {k: (v.item() if isinstance(v, np.generic) else v) for k, v in record.items()}}
+                for lon, lat, record in zip(df.longitude, df.latitude, properties.to_dict('records'))]
+
+    _features = features
+
+    return _features
+
+
+#  function to encode a list of features as a geojson tile with an etag
+def encode_tile(features):
+
+    body = json.dumps({'type': 'FeatureCollection', 'features': features}, separators=(',', ':')).encode('utf-8')
+
+    return body, hashlib.md5(body).hexdigest()
+
+
+#  function to generate every non empty tile of a zoom level in one vectorized pass over the station table
+def build_zoom_tiles(zoom):
+
+    df = get_station_metadata()
+    features = station_features()
+    tile_x, tile_y = lonlat_to_tile(df.longitude.values, df.latitude.values, zoom)
+
+    tiles = {}
+    for (x, y), index in pd.Series(np.arange(len(df))).groupby([tile_x, tile_y]).groups.items():
+        tiles[(int(x), int(y))] = encode_tile([features[i] for i in index])
+
+    return tiles
+
+
+#  function to return the encoded geojson tile and etag of stations inside tile z/x/y
+def get_station_tile(z, x, y):
+
+    if z <= MAX_TILE_ZOOM:
+        get_station_metadata()  # a new metadata generation clears the tiles
+        if z not in _tiles:
+            with _lock:
+                if z not in _tiles:
+                    _tiles[z] = build_zoom_tiles(z)
+        return _tiles[z].get((x, y)) or encode_tile([])
+
+    df = get_station_metadata()
+    features = station_features()
+    tile_x, tile_y = lonlat_to_tile(df.longitude.values, df.latitude.values, z)
+
+    return encode_tile([features[i] for i in np.flatnonzero((tile_x == x) & (tile_y == y))])
@@ -1,68 +1,39 @@
 import celery
+import time
 import pandas as pd
 import os
-import boto3
+import tempfile
 import numpy as np
-
-from io import StringIO
+import output_formats
+import scheduling
+import extraction
+import aggregation
+import availability
+import checkpoints
+import event_search
+import prefetch
+import output_store
+
+from kombu import Queue
+from celery.signals import task_postrun
+from connections import get_s3_client
 
 ######################################### HELPER FUNCTIONS #############################################################
 
-#  function to query column names of s3 file
-def query_header_name_s3(s3, filename):
-
-    resp = s3.select_object_content(
-        Bucket=os.environ['S3_BUCKET'],
-        Key=filename,
-        ExpressionType='SQL',
-        Expression='SELECT * FROM s3object s LIMIT 1',
-        InputSerialization={'CSV': {"FileHeaderInfo": "None"}},
-        OutputSerialization={'CSV': {}},
-    )
-
-    records = []
-    for event in resp['Payload']:
-        if 'Records' in event:
-            records.append(event['Records']['Payload'])
-
-    file_str = ''.join(req.decode('utf-8') for req in records)
-
-    headers = pd.read_csv(StringIO(file_str), index_col=0).columns
-
-    return headers
-
-#  function to query data from s3 file
-def query_data_s3(s3, filename, sql_stmt, col_names):
-
-    resp = s3.select_object_content(
-        Bucket=os.environ['S3_BUCKET'],
-        Key=filename,
-        ExpressionType='SQL',
-        Expression=sql_stmt,
-        InputSerialization={'CSV': {"FileHeaderInfo": "Use"}},
-        OutputSerialization={'CSV': {}},
-    )
-
-    records = []
-    for event in resp['Payload']:
-        if 'Records' in event:
-            records.append(event['Records']['Payload'])
-
-    file_str = ''.join(req.decode('utf-8') for req in records)
-
-    df = pd.read_csv(StringIO(file_str), index_col=None, dtype={'Weather': 'str'}, names=list(col_names))
-
-    return df
+#  function to upload file to s3 in the requested output format, returns the size of the file in bytes
+def upload_csv_S3(df, filename, output_format=output_formats.DEFAULT_FORMAT):
 
-#  function to upload file to s3
-def upload_csv_S3(df, filename):
+    buffer = output_formats.write_dataframe(df, output_format)
+    buffer.seek(0, os.SEEK_END)
+    size = buffer.tell()
+    buffer.seek(0)
 
-    csv_buffer = StringIO()
-    df.to_csv(csv_buffer)
+    s3 = get_s3_client()
+    s3.upload_fileobj(buffer, os.environ['S3_BUCKET'], output_store.OUTPUT_PREFIX + filename,
+                      ExtraArgs=output_formats.upload_args(output_format))
+    buffer.close()
 
-    s3_resource = boto3.resource('s3')
-    obj = s3_resource.Object(os.environ['S3_BUCKET'], 'tmp/' + filename)
-    obj.put(Body=csv_buffer.getvalue())
+    return size
 
 ######################################### CELERY TASK ##################################################################
 
@@ -78,48 +49,87 @@ celery_app.conf.update(
     worker_concurrency=16,
     worker_enable_remote_control=False,  # need this to reduce connections
     result_backend=os.environ['REDIS_URL'],
-    redis_max_connections=20
+    redis_max_connections=20,
+    # small jobs go to the fast lane and large jobs to the bulk lane, see scheduling.choose_queue
+    task_queues=(Queue(scheduling.FAST_QUEUE), Queue(scheduling.BULK_QUEUE), Queue(scheduling.PREFETCH_QUEUE)),
+    task_default_queue=scheduling.FAST_QUEUE,
 )
 
 
-@celery_app.task(bind=True, time_limit=300)
-def download_remote_data(self, station_name, output_filename, station_id, start_year, start_month, end_year, end_month, frequency):
+#  seconds after which a download stops at the next checkpoint and resumes as a retry, well inside the time limit
+DOWNLOAD_TIME_LIMIT = 300
+CHECKPOINT_DEADLINE = 240
 
-    #  setup s3 client
-    s3 = boto3.client('s3', region_name='us-east-1', aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-                      aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'])
+#  downloads estimated at no more rows than this finish in a single attempt and are queried without checkpoints
+CHECKPOINT_MIN_ROWS = int(os.environ.get('CHECKPOINT_MIN_ROWS', scheduling.FAST_LANE_MAX_ROWS))
 
-    #  update state to progress and give a status message
-    self.update_state(state='PROGRESS', meta={'status': 'WORKING'})
-
-    #  user requested download dates
-    start_date = pd.to_datetime('-'.join([start_year, start_month]))
-    end_date = pd.to_datetime('-'.join([end_year, end_month]))
 
-    #  format sql statement
-    sql_stmt = "SELECT * FROM s3object s WHERE s.\"Date/Time\" BETWEEN '{}' AND '{}'".format(start_date, end_date)
+@celery_app.task(bind=True, time_limit=DOWNLOAD_TIME_LIMIT)
+def download_remote_data(self, station_name, output_filename, station_id, start_year, start_month, end_year, end_month, frequency,
+                         output_format=output_formats.DEFAULT_FORMAT, session_key=None, variables=None, aggregation_period=None,
+                         aggregation_stats=None, output_key=None, resumes=0):
 
-    if frequency == 'Hourly':
+    started = time.time()
 
-        input_filename = '_'.join([station_id, 'hourly.csv'])
-        # output_filename = '_'.join(['WHC', station_name.replace(' ', '_'), station_id, start_year, end_year, 'hourly.csv'])
+    #  every attempt, including retries waiting for a slot or resuming from checkpoints, keeps the session slot alive
+    scheduling.refresh_slots(self.request.id, session_key)
 
-    elif frequency == 'Daily':
+    #  bulk lane jobs wait for a running slot so they can never take every worker away from the fast lane
+    if self.request.delivery_info and self.request.delivery_info.get('routing_key') == scheduling.BULK_QUEUE:
+        if not scheduling.acquire_bulk_slot(self.request.id):
+            raise self.retry(countdown=10, max_retries=None)
 
-        input_filename = '_'.join([station_id, 'daily.csv'])
-        # output_filename = '_'.join(['WHC', station_name.replace(' ', '_'), station_id, start_year, end_year, 'daily.csv'])
+    #  user requested download dates
+    start_date = pd.to_datetime('-'.join([start_year, start_month]))
+    end_date = pd.to_datetime('-'.join([end_year, end_month]))
 
-    else:
+    #  jobs wait while the worker is near its memory budget instead of running it out of memory
+    n_rows = scheduling.estimate_job_rows(station_id, frequency, start_date, end_date)
+    if not scheduling.reserve_memory(self.request.id, n_rows):
+        raise self.retry(countdown=scheduling.MEMORY_RETRY_SECONDS, max_retries=None)
 
-        input_filename = '_'.join([station_id, 'monthly.csv'])
-        # output_filename = '_'.join(['WHC', station_name.replace(' ', '_'), station_id, start_year, end_year, 'monthly.csv'])
+    #  shared s3 client for this worker process
+    s3 = get_s3_client()
 
-    #  download file headers and csv from s3
-    file_headers = query_header_name_s3(s3, input_filename)
-    df = query_data_s3(s3, input_filename, sql_stmt, file_headers)
+    #  update state to progress and give a status message
+    self.update_state(state='PROGRESS', meta={'status': 'WORKING'})
 
-    #  send csv to s3
-    upload_csv_S3(df, output_filename)
+    #  stop at the next checkpoint once the deadline has passed, the retry loads the finished segments and carries on
+    def progress(done, total):
+        self.update_state(state='PROGRESS', meta={'status': 'WORKING', 'done': done, 'total': total})
+        scheduling.refresh_slots(self.request.id, session_key)
+        if done < total and time.time() - started > CHECKPOINT_DEADLINE:
+            if resumes >= checkpoints.MAX_RESUMES:
+                checkpoints.clear_checkpoints(s3, job_key)
+                raise RuntimeError('download did not finish after {} resumes'.format(resumes))
+            raise self.retry(countdown=0, max_retries=None, kwargs=dict(self.request.kwargs, resumes=resumes + 1))
+
+    #  download csv from the station archive on s3, only the selected variables are scanned when the user chose some.
+    #  large jobs are queried in batches of year partitions and every finished batch is checkpointed so a resumed or
+    #  resubmitted job never queries it again, jobs that fit in a single attempt skip the checkpoint requests
+    data_range = availability.populated_range(station_id, frequency, start_date, end_date)
+    job_key = checkpoints.job_key(station_id, frequency, start_date, end_date, variables)
+    checkpointed = False
+    if data_range is None:
+        df = extraction.extract_station_data(s3, station_id, frequency, start_date, end_date, columns=variables or None)
+    else:
+        #  small station files prefetched when the user selected the station are cut instead of queried
+        df = prefetch.cached_extract(s3, station_id, frequency, *data_range, variables=variables or None)
+        if df is None and n_rows <= CHECKPOINT_MIN_ROWS:
+            df = extraction.query_station_data(s3, station_id, frequency, *data_range, columns=variables or None)
+        elif df is None:
+            df = checkpoints.extract_with_checkpoints(s3, job_key, station_id, frequency, *data_range, columns=variables or None,
+                                                      progress=progress)
+            checkpointed = True
+
+    #  aggregate to a coarser period on the worker so only the aggregated rows are uploaded
+    if aggregation_period:
+        df = aggregation.aggregate_station_data(df, aggregation_period, aggregation_stats or aggregation.AGGREGATION_STATS)
+
+    #  send file to s3 in the format the user selected
+    size = upload_csv_S3(df, output_filename, output_format)
+    if checkpointed:
+        checkpoints.clear_checkpoints(s3, job_key)
 
     #  keep only relevant columns and store to plot in graphing and make flagged values NaN so plotting looks good
     df_filt = df[[x for x in df if not x.endswith('Flag')]]
@@ -129,6 +139,81 @@ def download_remote_data(self, station_name, output_filename, station_id, start_
     df_filt = df_filt.replace(vals_to_remove, np.nan)
     df_filt = df_filt.dropna(how='all', axis=1)
     df_filt_col_names = {c: i for i, c in enumerate(df_filt.columns)}
+
+    #  track the file in the output store, an identical request is handed this file while it is fresh
+    output_store.register(s3, output_filename, size, request=output_key, columns=df_filt_col_names)
     df_filt_col_names['result'] = 'COMPLETE'
 
     return df_filt_col_names
+
+
+#  seconds a search of many stations may run
+SEARCH_TIME_LIMIT = 30 * 60
+
+
+#  scan the archives of every station of a province for values of a variable passing a threshold, e.g. daily max temp
+#  above 35 between 1990 and 2020. the stations are scanned in parallel and their matching rows are written to the
+#  result file as each station finishes, so only the matches are ever held by the worker
+@celery_app.task(bind=True, time_limit=SEARCH_TIME_LIMIT)
+def search_extreme_events(self, output_filename, variable, operator, threshold, frequency, start_year, end_year,
+                          province=None, session_key=None):
+
+    scheduling.refresh_slots(self.request.id, session_key)
+
+    #  searches always run in the bulk lane and wait for a running slot like large downloads
+    if self.request.delivery_info and self.request.delivery_info.get('routing_key') == scheduling.BULK_QUEUE:
+        if not scheduling.acquire_bulk_slot(self.request.id):
+            raise self.retry(countdown=10, max_retries=None)
+
+    s3 = get_s3_client()
+    self.update_state(state='PROGRESS', meta={'status': 'WORKING'})
+
+    start_date = pd.Timestamp(year=int(start_year), month=1, day=1)
+    end_date = pd.Timestamp(year=int(end_year), month=12, day=31, hour=23, minute=59)
+    #  searches over more stations than one search may scan are cut to the first ones, the result reports it
+    df_found = event_search.search_stations(frequency, start_year, end_year, province)
+    df_stations = df_found[:event_search.MAX_SCAN_STATIONS]
+
+    n_matches = 0
+    with tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024) as buffer:
+        buffer.write(pd.DataFrame(columns=event_search.STATION_COLUMNS + ['Date/Time', variable]).to_csv(index=False).encode('utf-8'))
+        for done, total, df_matches in event_search.scan_stations(s3, df_stations, frequency, variable, operator, threshold,
+                                                                   start_date, end_date):
+            buffer.write(df_matches.to_csv(index=False, header=False).encode('utf-8'))
+            n_matches += len(df_matches)
+            self.update_state(state='PROGRESS', meta={'status': 'WORKING', 'done': done, 'total': total, 'matches': n_matches})
+            scheduling.refresh_slots(self.request.id, session_key)
+
+        size = buffer.tell()
+        buffer.seek(0)
+        s3.upload_fileobj(buffer, os.environ['S3_BUCKET'], output_store.OUTPUT_PREFIX + output_filename,
+                          ExtraArgs=output_formats.upload_args('csv'))
+
+    output_store.register(s3, output_filename, size)
+
+    return {'stations': len(df_stations), 'stations_found': len(df_found), 'matches': n_matches, 'result': 'COMPLETE'}
+
+
+#  speculative warm up of a station the user selected, runs in the low priority prefetch lane. a prefetch that finds
+#  every prefetch slot taken is dropped, it would only compete with real downloads
+@celery_app.task(bind=True, time_limit=DOWNLOAD_TIME_LIMIT, ignore_result=True)
+def prefetch_station_data(self, station_id, frequency):
+
+    if not scheduling.acquire_prefetch_slot(self.request.id):
+        return
+
+    try:
+        prefetch.warm_station(get_s3_client(), station_id, frequency)
+    finally:
+        scheduling.release_prefetch_slot(self.request.id)
+
+
+#  release the scheduler slots and memory reservation of a download or search job once it has finished or failed, a retried job keeps its session slot
+@task_postrun.connect(sender=download_remote_data)
+@task_postrun.connect(sender=search_extreme_events)
+def release_download_slots(task_id=None, kwargs=None, state=None, **extra):
+
+    scheduling.release_bulk_slot(task_id)
+    scheduling.release_memory(task_id)
+    if state != 'RETRY' and kwargs and kwargs.get('session_key'):
+        scheduling.release_job(kwargs['session_key'], task_id)